@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+'''
+# ggrep
+Get a geany command to go to the line in the file for each match of a
+string in code (searching within file(s)). Recursively search
+directories by default. Unlike grep, matches inside of quotes or
+comments are skipped unless you include them with the options below.
+
+ggrep <string> [<file or directory> ...] [options]
+
+If no file or directory is specified, the current directory is
+searched.
+
+
+OPTIONS:
+--quoted                 Include matches inside of quotes.
+--commented              Include matches inside of comments.
+--language <name>        Use the quote and comment rules for a language
+                         (one of: {}) instead of guessing from each
+                         file extension. A file with an unknown
+                         extension is otherwise searched as plain text
+                         (matches in quotes and comments are found).
+--jobs <count>           Search files in this many processes (default:
+                         the number of CPUs).
+--hidden                 Also search hidden files and directories (such
+                         as .git).
+--verbose                Show more messages.
+--debug                  Show debugging messages.
+
+'''
+import os
+import sys
+
+from concurrent.futures import ProcessPoolExecutor
+
+from pycodetool import (
+    echo0,
+    echo1,
+    set_verbosity,
+)
+from pycodetool.parsing import (
+    LANGUAGE_PROFILES,
+    LanguageProfile,
+    search_file_in_code,
+)
+
+LANGUAGE_EXTENSIONS = {
+    ".py": "python",
+    ".pyw": "python",
+    ".c": "c",
+    ".h": "c",
+    ".cpp": "cpp",
+    ".cc": "cpp",
+    ".cxx": "cpp",
+    ".hpp": "cpp",
+    ".hh": "cpp",
+    ".cs": "csharp",
+    ".php": "php",
+    ".sh": "bash",
+    ".bash": "bash",
+}
+
+PLAIN_PROFILE = LanguageProfile(None, comment_delimiters=(),
+                                quote_marks=())
+# ^ For files in an unknown language, since guessing quote and comment
+#   rules (such as an apostrophe in prose starting a quote) hides matches.
+
+BINARY_CHECK_SIZE = 8192
+
+
+def usage():
+    echo0(__doc__.format(", ".join(sorted(LANGUAGE_PROFILES))))
+
+
+def iter_source_paths(path, include_hidden=False):
+    '''
+    Generate the path of each file in path (or path itself if it is a
+    file) using os.scandir, recursively.
+    '''
+    if not os.path.isdir(path):
+        yield path
+        return
+    try:
+        entries = sorted(os.scandir(path), key=lambda entry: entry.name)
+    except OSError as ex:
+        echo0("Error: {}".format(ex))
+        return
+    for entry in entries:
+        if (not include_hidden) and entry.name.startswith("."):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            for sub_path in iter_source_paths(entry.path,
+                                              include_hidden=include_hidden):
+                yield sub_path
+        elif entry.is_file():
+            yield entry.path
+
+
+def is_binary(path):
+    with open(path, 'rb') as stream:
+        return b"\0" in stream.read(BINARY_CHECK_SIZE)
+
+
+def ggrep_file(args):
+    '''
+    Get a list of (line_n, col, line) for each match in the file (See
+    ggrep for args), or an empty list if it is binary or can't be read.
+    A file in an unknown language (See LANGUAGE_EXTENSIONS) is searched
+    as plain text.
+    '''
+    path, needle, language, allow_quoted, allow_commented = args
+    if language is None:
+        language = LANGUAGE_EXTENSIONS.get(os.path.splitext(path)[1].lower(),
+                                           PLAIN_PROFILE)
+    try:
+        if is_binary(path):
+            return []
+        return list(search_file_in_code(
+            path,
+            needle,
+            profile=language,
+            allow_quoted=allow_quoted,
+            allow_commented=allow_commented,
+            include_line=True,
+        ))
+    except (OSError, ValueError) as ex:
+        # ValueError: a file changed while being searched
+        echo0('Error: "{}": {}'.format(path, ex))
+        return []
+
+
+def ggrep(needle, paths, language=None, allow_quoted=False,
+          allow_commented=False, processes=None, include_hidden=False):
+    '''
+    Search each file in paths (searching directories recursively) in a
+    process pool.
+
+    Returns:
+    a generator of (path, line_n, col, line) for each match, in order
+    of path (then line_n and col) as soon as each file is done.
+    '''
+    all_args = []
+    for path in paths:
+        for sub_path in iter_source_paths(path,
+                                          include_hidden=include_hidden):
+            all_args.append((sub_path, needle, language, allow_quoted,
+                             allow_commented))
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = executor.map(ggrep_file, all_args, chunksize=32)
+        for args, hits in zip(all_args, results):
+            for hit in hits:
+                yield (args[0],) + hit
+
+
+def geany_command(path, line_n):
+    return 'geany "{}" -l {}'.format(path, line_n)
+
+
+def main():
+    needle = None
+    paths = []
+    key = None
+    options = {}
+    flags = {
+        "--quoted": "allow_quoted",
+        "--commented": "allow_commented",
+        "--hidden": "include_hidden",
+    }
+    for argI in range(1, len(sys.argv)):
+        arg = sys.argv[argI]
+        if key is not None:
+            options[key] = arg
+            key = None
+        elif arg.startswith("--"):
+            if arg == "--verbose":
+                set_verbosity(1)
+            elif arg == "--debug":
+                set_verbosity(2)
+            elif arg in flags:
+                options[flags[arg]] = True
+            elif arg == "--language":
+                key = "language"
+            elif arg == "--jobs":
+                key = "processes"
+            else:
+                echo0("Error: {} is not a valid argument.".format(arg))
+                return 1
+        elif needle is None:
+            needle = arg
+        else:
+            if not os.path.exists(arg):
+                echo0('Error: "{}" is neither a file nor directory.'
+                      ''.format(arg))
+                return 1
+            paths.append(arg)
+    if key is not None:
+        echo0("Error: {} must be followed by a value.".format(key))
+        return 1
+    if not needle:
+        usage()
+        echo0("Error: Provide a string to find.")
+        return 1
+    if "language" in options:
+        if options["language"].lower() not in LANGUAGE_PROFILES:
+            echo0("Error: There is no language named {}."
+                  "".format(options["language"]))
+            return 1
+    if "processes" in options:
+        try:
+            options["processes"] = int(options["processes"])
+        except ValueError:
+            echo0("Error: --jobs must be followed by a number.")
+            return 1
+    if not paths:
+        paths.append(".")
+    match_count = 0
+    prev_line = None
+    for path, line_n, col, line in ggrep(needle, paths, **options):
+        match_count += 1
+        if (path, line_n) == prev_line:
+            continue  # Show each line once as grep does.
+        prev_line = (path, line_n)
+        print("{}  # {}".format(geany_command(path, line_n), line.strip()))
+    echo1("{} match(es)".format(match_count))
+    if match_count < 1:
+        return 1  # as grep does
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,7 +10,6 @@ python3 bash2python.py <bash_script_path>
 """
 import sys
 import os
-import re  # regex
 import platform
 import bashlex
 
@@ -24,6 +23,8 @@ REPO_DIR = os.path.dirname(MODULE_DIR)
 if __name__ == "__main__":
     sys.path.insert(0, REPO_DIR)
 
+from pycodetool.parsing import compile_pattern  # noqa: E402
+
 bash_to_python_header = """#!/usr/bin/env python3
 import sys
 import os
@@ -100,13 +101,13 @@ class DeprecatedBashToPyTranslator(BashToPyTranslator):
             string at the beginning of a line closes it.
     """
     def __init__(self):
-        streamAppendQuotedRE = re.compile(r'cat\s*>>\s*"')
-        streamOpenQuotedRE = re.compile(r'cat\s*>\s*"')
-        streamOpenEndQuotedRE = re.compile(r'"\s*<<')
+        streamAppendQuotedRE = compile_pattern(r'cat\s*>>\s*"')
+        streamOpenQuotedRE = compile_pattern(r'cat\s*>\s*"')
+        streamOpenEndQuotedRE = compile_pattern(r'"\s*<<')
         # ^ assumes not still inside quotes!
-        streamAppendRE = re.compile(r'cat\s*>>\s*')
-        streamOpenRE = re.compile(r'cat\s*>\s*')
-        streamOpenEndRE = re.compile(r'\s*<<')
+        streamAppendRE = compile_pattern(r'cat\s*>>\s*')
+        streamOpenRE = compile_pattern(r'cat\s*>\s*')
+        streamOpenEndRE = compile_pattern(r'\s*<<')
         # ^ assumes not still inside quotes!
         self.streamEnclosureRegexes = [
             [streamAppendQuotedRE, streamOpenEndQuotedRE],
@@ -27,7 +27,21 @@ import traceback
 import copy
 # import chardet  # not built-in
 import codecs
+import io
+import mmap
 import re
+import threading
+
+from array import array
+from bisect import (
+    bisect_left,
+    bisect_right,
+)
+from collections import (
+    Counter,
+    OrderedDict,
+)
+from concurrent.futures import ProcessPoolExecutor
 
 from .find_hierosoft import hierosoft
 # ^ also works for submodules since changes sys.path
@@ -47,6 +61,11 @@ from pycodetool import (
 from pycodetool.exactconfig import (
     ECLineInfo,
 )
+from pycodetool.tracing import (
+    TRACE_STEPS,
+    get_trace_level,
+    trace,
+)
 me = "pycodetool.parsing"
 
 try:
@@ -54,6 +73,13 @@ try:
 except NameError:
     pass
 
+try:
+    import numpy
+    # ^ optional: only used to scan very long lines (See
+    #   set_numpy_min_length)
+except ImportError:
+    numpy = None
+
 # os_name is deprecated--use: import platform, then
 # if "windows" in platform.system().lower(): do windows things
 
@@ -73,7 +99,20 @@ alpha_chars = alpha_upper_chars+alpha_lower_chars
 alnum_chars = alpha_chars+digit_chars
 identifier_chars = alnum_chars+"_"
 identifier_and_dot_chars = identifier_chars+"."
+# Precompiled forms of the above for the character-class primitives:
+_identifier_char_set = frozenset(identifier_chars)
+_delete_identifier_chars = {ord(c): None for c in identifier_chars}
+_delete_identifier_and_dot_chars = {ord(c): None
+                                    for c in identifier_and_dot_chars}
+_whitespace_rx = re.compile(r"\s")
+_non_whitespace_rx = re.compile(r"\S")
+_last_whitespace_rx = re.compile(r"\s\S*\Z")
 entries_modified_count = 0
+# ^ Deprecated (See read_conf_file). Each function that sets a global like
+#   this also keeps its result in _call_results, so the get_* function
+#   for it is correct in each thread, but a global is shared by every
+#   thread.
+_call_results = threading.local()
 DEFAULT_CO = "UTF-8"
 # DEFAULT_CO = "cp437"
 # DEFAULT_DEC = "UTF-8"
@@ -94,12 +133,34 @@ class AbstractFn:
         contain an open parenthesis.
     raw_params -- a list where each element is a recieved function
         parameter stored as a string (using the syntax of the source
-        language to appropriately represent the type).
+        language to appropriately represent the type). The parameters
+        are only split the first time this (or raw_params_slices) is
+        used.
+    raw_params_slices -- a list of the (start, end) slice of the line
+        for each element of raw_params, or None after raw_params is
+        set (or set_param is called) since the parameters no longer
+        come from the line.
     source_path -- the source code file that produced the function,
         otherwise None.
     line_n -- the source code line number that produced the function,
         starting at 1, otherwise None.
+
+    To parse many lines without an object for each, see parse_calls.
     '''
+    __slots__ = (
+        "raw_name",
+        "source_path",
+        "line_n",
+        "after",
+        "_line",
+        "_code",
+        "_args_index",
+        "_args_end",
+        "_allow_escaping_quotes",
+        "_raw_params",
+        "_raw_params_slices",
+    )
+
     def __init__(self, line, comment_delimiters=['#'],
                  allow_bare_args=False,
                  source_path=None, line_n=None):
@@ -115,8 +176,13 @@ class AbstractFn:
         )
 
     def clear(self):
-        self.raw_params = None
-        self.raw_params_slices = None
+        self._raw_params = None
+        self._raw_params_slices = None
+        self._line = None
+        self._code = None
+        self._args_index = None
+        self._args_end = None
+        self._allow_escaping_quotes = True
         self.source_path = None
         self.line_n = None
         self.after = None
@@ -127,6 +193,12 @@ class AbstractFn:
               source_path=None, line_n=None,
               allow_escaping_quotes=True):
         '''
+        Sequential arguments:
+        line -- The code, or a LogicalLine (See iter_logical_lines) for
+            a call that continues onto other lines (or a CodeView, in
+            which case its context is used and comment_delimiters and
+            allow_escaping_quotes are ignored).
+
         Keyword arguments:
         allow_bare_args -- Allow a line without the opening
             parenthesis (If False, raise ValueError if no
@@ -135,86 +207,75 @@ class AbstractFn:
             (for debugging purposes, stored).
         line_n -- The source code line number, starting with 1,
             that contains the function (for debugging purposes, stored).
+            For a LogicalLine, the default is its first line.
         '''
         self.clear()
         self.source_path = source_path
         self.line_n = line_n
-        if comment_delimiters is None:
-            comment_delimiters = []
-        if isinstance(comment_delimiters, str):
-            raise ValueError(
-                "comment_delimiters should be a list-like object."
-            )
         if line is None:
             return
-        open_paren_i = find_unquoted_not_commented(
+        if isinstance(line, LogicalLine):
+            if line_n is None:
+                self.line_n = line.line_index + 1
+            line = line.code
+        open_paren_i, close_paren_i = _call_bounds(
             line,
-            "(",
+            comment_delimiters=comment_delimiters,
+            allow_bare_args=allow_bare_args,
             allow_escaping_quotes=allow_escaping_quotes,
         )
-        start = 0
-        close_paren_i = None
+        if isinstance(line, CodeView):
+            self._code = line
+            line = line.text
         if open_paren_i >= 0:
-            start = open_paren_i + 1
             self.raw_name = line[:open_paren_i]
-            if len(self.name) == 0:
-                raise ValueError(
-                    'There is no function name in `{}`'
-                    ''.format(line)
-                )
-            close_paren_i = find_in_code(
-                line,
-                ")",
-                start=start,
-                # endbefore=endbefore,
-                comment_delimiters=comment_delimiters,
-                enclosures=["()"],
-                allow_quoted=False,
-                allow_escaping_quotes=allow_escaping_quotes,
-            )
-            # ^ find the end parenthesis accounting for nesting
-            if close_paren_i <= open_paren_i:
-                raise ValueError(
-                    'There is no closing ")" in `{}`'
-                    ''.format(line)
-                )
-        else:
-            if not allow_bare_args:
-                raise ValueError(
-                    'allow_bare_args is False but there is no'
-                    ' uncommented "(" in `{}`'
-                    ''.format(line)
-                )
-        args_index = open_paren_i + 1
-        args_part = line[args_index:close_paren_i]
-        results = explode_unquoted(
-            args_part,
-            ",",
-            get_str_i_tuple=True,
-            strip=False,
-            allow_escaping_quotes=allow_escaping_quotes,
-        )
-        self.raw_params = []
-        self.raw_params_slices = []
-        for t in results:
-            param, p_start, p_end = t
-            self.raw_params.append(param)
-            self.raw_params_slices.append(
-                (p_start+args_index, p_end+args_index)
-            )
+        self._line = line
+        self._args_index = open_paren_i + 1
+        self._args_end = close_paren_i
+        self._allow_escaping_quotes = allow_escaping_quotes
         self.after = line[close_paren_i+1:]
 
+    def _parse_params(self):
+        self._raw_params = []
+        self._raw_params_slices = []
+        if self._line is None:
+            return
+        for p_start, p_end in _param_slices(
+                self._code or self._line,
+                self._args_index,
+                self._args_end,
+                self._allow_escaping_quotes):
+            self._raw_params.append(self._line[p_start:p_end])
+            self._raw_params_slices.append((p_start, p_end))
+
+    @property
+    def raw_params(self):
+        if self._raw_params is None:
+            self._parse_params()
+        return self._raw_params
+
+    @raw_params.setter
+    def raw_params(self, raw_params):
+        self._raw_params = raw_params
+        self._raw_params_slices = None
+
+    @property
+    def raw_params_slices(self):
+        if self._raw_params is None:
+            self._parse_params()
+        return self._raw_params_slices
+
+    @raw_params_slices.setter
+    def raw_params_slices(self, raw_params_slices):
+        self._raw_params_slices = raw_params_slices
+
     @property
     def name(self):
         return self.raw_name.strip()
 
     @name.setter
     def name(self, name):
-        prev_raw_name = self.raw_name
         self.raw_name = name
-        self.name = name.strip()
-        # if prev_raw_name is not None:
-        #     delta = len(self.raw_name) - len(prev_raw_name)
 
     def line_error(self, error):
         result = ""
@@ -233,6 +294,7 @@ class AbstractFn:
             value (Examples: `"Hello"`, `True`, 100)
         '''
         self.raw_params[index] = code
+        self._raw_params_slices = None
 
     def to_string(self):
         result = ""
@@ -253,6 +315,202 @@ class AbstractFn:
         return result
 
 
+def _call_bounds(line, comment_delimiters=['#'], allow_bare_args=False,
+                 allow_escaping_quotes=True):
+    '''
+    Find the parentheses of a call (See AbstractFn.parse). The line can
+    also be a CodeView (then comment_delimiters and
+    allow_escaping_quotes are ignored).
+
+    Returns:
+    a tuple of the index of the opening parenthesis (-1 for bare args)
+    and the index of the matching closing parenthesis (len(line) for
+    bare args).
+    '''
+    if comment_delimiters is None:
+        comment_delimiters = []
+    if isinstance(comment_delimiters, str):
+        raise ValueError(
+            "comment_delimiters should be a list-like object."
+        )
+    if isinstance(line, CodeView):
+        code = line
+        line = code.text
+    else:
+        code = CodeView(
+            line,
+            comment_delimiters=comment_delimiters,
+            allow_escaping_quotes=allow_escaping_quotes,
+        )
+    open_paren_i = find_unquoted_not_commented(code, "(")
+    if open_paren_i < 0:
+        if not allow_bare_args:
+            raise ValueError(
+                'allow_bare_args is False but there is no'
+                ' uncommented "(" in `{}`'
+                ''.format(line)
+            )
+        return -1, len(line)
+    if len(line[:open_paren_i].strip()) == 0:
+        raise ValueError(
+            'There is no function name in `{}`'
+            ''.format(line)
+        )
+    close_paren_i = BracketIndex(
+        code,
+        enclosures=["()"],
+    ).closer_of(open_paren_i)
+    # ^ find the end parenthesis accounting for nesting
+    if close_paren_i <= open_paren_i:
+        raise ValueError(
+            'There is no closing ")" in `{}`'
+            ''.format(line)
+        )
+    return open_paren_i, close_paren_i
+
+
+def _param_slices(line, args_index, args_end, allow_escaping_quotes):
+    '''
+    Generate the (start, stop) of each parameter in
+    line[args_index:args_end]. For a CodeView, a comma only separates
+    parameters if it is not quoted or commented (by its context, so a
+    comment can end before the next line of a LogicalLine). Otherwise
+    the parameters are split as in explode_unquoted.
+    '''
+    if not isinstance(line, CodeView):
+        for _, p_start, p_end in iexplode_unquoted(
+                line[args_index:args_end],
+                ",",
+                strip=False,
+                allow_escaping_quotes=allow_escaping_quotes):
+            yield p_start+args_index, p_end+args_index
+        return
+    if args_end <= args_index:
+        return
+    text = line.text
+    mask = line.mask()
+    p_start = args_index
+    index = text.find(",", args_index, args_end)
+    while index > -1:
+        if not mask[index]:
+            yield p_start, index
+            p_start = index + 1
+        index = text.find(",", index+1, args_end)
+    if (p_start < args_end) or (p_start == args_index):
+        # ^ As in explode_unquoted, a trailing comma doesn't start an
+        #   empty parameter.
+        yield p_start, args_end
+
+
+class ParsedCalls(object):
+    '''
+    Calls parsed by parse_calls, stored in columns instead of one
+    AbstractFn per call.
+
+    Properties
+    names -- a list of the name of each call (stripped).
+    line_indices -- an array('I') of the index in lines of each call
+        (for a LogicalLine, the index of its first physical line).
+    counts -- an array('I') of how many parameters each call has.
+    offsets -- an array('I') of (start, end) pairs (flattened) of
+        every parameter of every call, in order, where each pair is a
+        slice of the call's line (See AbstractFn raw_params_slices).
+    '''
+    __slots__ = ("names", "line_indices", "counts", "offsets", "_lines",
+                 "_firsts")
+
+    def __init__(self):
+        self.names = []
+        self.line_indices = array('I')
+        self.counts = array('I')
+        self.offsets = array('I')
+        self._lines = []
+        self._firsts = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def _first(self, index):
+        '''
+        Get the index in offsets of the first parameter of a call.
+        '''
+        if self._firsts is None:
+            firsts = array('I')
+            total = 0
+            for count in self.counts:
+                firsts.append(total)
+                total += count * 2
+            self._firsts = firsts
+        return self._firsts[index]
+
+    def param_slices(self, index):
+        '''
+        Get a list of (start, end) tuples for the parameters of a call.
+        '''
+        first = self._first(index)
+        offsets = self.offsets
+        return [(offsets[i], offsets[i+1])
+                for i in range(first, first+self.counts[index]*2, 2)]
+
+    def params(self, index):
+        '''
+        Get a list of the parameters of a call as strings (not
+        stripped, like AbstractFn raw_params).
+        '''
+        line = self._lines[index]
+        return [line[start:end] for start, end in self.param_slices(index)]
+
+
+def parse_calls(lines, comment_delimiters=['#'], allow_bare_args=False,
+                allow_escaping_quotes=True):
+    '''
+    Parse the call on each line in columns (See ParsedCalls) without
+    making an object for each call. A line that isn't a call (See
+    AbstractFn.parse) is skipped.
+
+    Sequential arguments:
+    lines -- Any iterable of strings, such as an open file, or of
+        LogicalLine objects (See iter_logical_lines) so that calls can
+        continue onto other lines.
+
+    Returns:
+    a ParsedCalls.
+    '''
+    calls = ParsedCalls()
+    names = calls.names
+    line_indices = calls.line_indices
+    counts = calls.counts
+    offsets = calls.offsets
+    call_lines = calls._lines
+    for line_index, line in enumerate(lines):
+        if isinstance(line, LogicalLine):
+            line_index = line.line_index
+            line = line.code
+        try:
+            open_paren_i, close_paren_i = _call_bounds(
+                line,
+                comment_delimiters=comment_delimiters,
+                allow_bare_args=allow_bare_args,
+                allow_escaping_quotes=allow_escaping_quotes,
+            )
+        except ValueError:
+            continue
+        count = 0
+        for p_start, p_end in _param_slices(line, open_paren_i+1,
+                                            close_paren_i,
+                                            allow_escaping_quotes):
+            offsets.append(p_start)
+            offsets.append(p_end)
+            count += 1
+        if isinstance(line, CodeView):
+            line = line.text
+        names.append(line[:max(open_paren_i, 0)].strip())
+        line_indices.append(line_index)
+        counts.append(count)
+        call_lines.append(line)
+    return calls
+
+
 class InstalledFile:
     source_dir_path = None
     dest_dir_path = None
@@ -374,15 +632,26 @@ class SourceFileInfo:
         self.repo_path = repo_path
         self.relative_path = relative_path
         self._unsaved_lines = []
-        self._lines, self._encoding = try_readlines(
-            self.full_path(),
-            encoding=encoding,
-        )
+        loaded = load_text(self.full_path(), encoding=encoding)
+        self._lines = loaded.lines
+        self._encoding = loaded.encoding
+        self._newline = loaded.newline
+        self._bom = loaded.bom
         self._unsaved_d = {}
+        self._lexed = None
 
     def full_path(self):
         return os.path.join(self.repo_path, self.relative_path)
 
+    def lexed(self):
+        '''
+        Get the CLexedLines of the file, lexing it the first time only
+        (Each define operation refreshes it to re-lex changed lines).
+        '''
+        if self._lexed is None:
+            self._lexed = CLexedLines(self._lines)
+        return self._lexed
+
     def save_changes(self):
         '''
         Save the file only if there are lines changed by the
@@ -392,7 +661,8 @@ class SourceFileInfo:
         if count < 1:
             return count
         path = self.full_path()
-        write_lines(path, self._lines, encoding=self._encoding)
+        write_lines(path, self._lines, encoding=self._encoding,
+                    newline=self._newline, bom=self._bom)
         self._unsaved_lines.clear()
         self._unsaved_d.clear()
         return count
@@ -414,8 +684,8 @@ class SourceFileInfo:
         results = get_cdef(
             self.full_path(),
             name,
-            lines=self._lines,
             line_index=line_index,
+            lexed=self.lexed(),
         )
         # skip=skip
         return results
@@ -434,8 +704,8 @@ class SourceFileInfo:
             name,
             value,
             comments=comments,
-            lines=self._lines,
             encoding=self._encoding,
+            lexed=self.lexed(),
         )
         self._unsaved_d.update(cdefs_to_d(self.full_path(), changes))
         self._unsaved_lines += changes
@@ -776,16 +1046,49 @@ def singular_or_plural(singular, plural, count):
 
 
 def get_entries_modified_count():
-    return entries_modified_count
+    '''
+    Deprecated: Use the count returned by read_conf_file instead.
+
+    Get how many entries the latest get_dict_modified_by_conf_file call
+    in this thread changed.
+    '''
+    return getattr(_call_results, "entries_modified_count", 0)
 
 
 def get_dict_modified_by_conf_file(this_dict, path,
                                    assignment_operator="=",
                                    comment_delimiter="#",
                                    inline_comments_enable=False):
+    '''
+    Get this_dict updated by the conf file (See read_conf_file). The
+    number of changed entries is only available through the deprecated
+    get_entries_modified_count.
+    '''
     global entries_modified_count
+    results, count = read_conf_file(
+        this_dict,
+        path,
+        assignment_operator=assignment_operator,
+        comment_delimiter=comment_delimiter,
+        inline_comments_enable=inline_comments_enable,
+    )
+    _call_results.entries_modified_count = count
+    entries_modified_count = count
+    return results
+
+
+def read_conf_file(this_dict, path, assignment_operator="=",
+                   comment_delimiter="#", inline_comments_enable=False):
+    '''
+    Read a conf file (one "name=value" per line) into this_dict. None,
+    bool, int and float values are converted from the text.
+
+    Returns:
+    a tuple of the dict (this_dict, or a new dict if this_dict is not
+    a dict) and how many entries were added or changed.
+    '''
     nulls = ["None", "null", "~", "NULL"]
-    entries_modified_count = 0
+    modified_count = 0
     results = this_dict
     # echo2("Checking "+str(path)+" for settings...")
     if (results is None) or (type(results) is not dict):
@@ -835,11 +1138,10 @@ def get_dict_modified_by_conf_file(this_dict, path,
             #       + ":"+result_val)
             if ((result_name not in results) or
                     (results[result_name] != result_val)):
-                entries_modified_count += 1
-                # echo2(str(entries_modified_count))
+                modified_count += 1
             results[result_name] = result_val
         ins.close()
-    return results
+    return results, modified_count
 
 
 def save_conf_from_dict(path, this_dict, assignment_operator="=",
@@ -928,28 +1230,44 @@ def lastchar(val):
 
 
 def get_indent_string(line):
-    ender_index = find_any_not(line, " \t")
-    result = ""
-    if ender_index > -1:
-        result = line[:ender_index]
-    return result
+    stripped = line.lstrip(" \t")
+    if not stripped:
+        # There is no code after the indent.
+        return ""
+    return line[:len(line)-len(stripped)]
+
+
+def indent_widths(lines):
+    '''
+    Get the indent width (the number of leading spaces and tabs, as in
+    get_indent_string) of every line in one call.
+
+    Sequential arguments:
+    lines -- Any iterable of strings, such as an open file.
+
+    Returns:
+    an array('H') with one width per line (0 for a line with only
+    spaces and tabs, and at most 65535).
+    '''
+    widths = array('H')
+    for line in lines:
+        stripped = line.lstrip(" \t")
+        if stripped:
+            widths.append(min(len(line)-len(stripped), 65535))
+        else:
+            widths.append(0)
+    return widths
 
 
 def is_identifier_valid(val, is_dot_allowed):
-    result = False
-    these_id_chars = identifier_chars
+    if not val:
+        return False
     if is_dot_allowed:
-        these_id_chars = identifier_and_dot_chars
-    for index in range(0, len(val)):
-        if val[index] in these_id_chars:
-            result = True
-        else:
-            result = False
-            break
-    return result
+        return not val.translate(_delete_identifier_and_dot_chars)
+    return not val.translate(_delete_identifier_chars)
 
 
-def find_slice(haystack, starter, ender):
+def find_slice(haystack, starter, ender, start=0, endbefore=None):
     '''Find slice indices between two strings.
     Get a slice that can be used to get or remove the substring (index
     of starter, and index of ender + 1) or return tuple(-1, -1). The starter
@@ -959,19 +1277,26 @@ def find_slice(haystack, starter, ender):
     Note:
         - Use another function like `get_operation_chunk_len` for
           multiple enclosures.
-        - Use functions like `explode_unquoted` or `quoted_slices` to
-          get multiple slices.
+        - Use find_all_slices to get every slice, or functions like
+          `explode_unquoted` or `quoted_slices` to get multiple quoted
+          slices.
 
     Args:
         haystack (str): The string to slice.
         starter (str): The first needle such as "(".
         ender (str): The second needle such as ")".
+        start (int): Only search haystack[start:endbefore] (but return
+            indices of haystack, without copying it).
+        endbefore (Optional[int]): See start.
     returns:
         tuple(int): Two ints, or if not found, tuple(-1, -1)
     '''
     # See also a copy in linux-preinstall
-    pattern = re.escape(starter) + r'(.*?)' + re.escape(ender)
-    match = re.search(pattern, haystack)
+    pattern = _slice_pattern(starter, ender)
+    if endbefore is None:
+        match = pattern.search(haystack, start)
+    else:
+        match = pattern.search(haystack, start, endbefore)
 
     if not match:
         return -1, -1
@@ -981,8 +1306,34 @@ def find_slice(haystack, starter, ender):
     return start_index, end_index
 
 
+def find_all_slices(haystack, starter, ender, start=0, endbefore=None):
+    '''
+    Generate the slice (a tuple of the index of starter and the index
+    of ender + 1) of each non-overlapping match of find_slice, in
+    order. Only haystack[start:endbefore] is searched, but the indices
+    are of haystack (it is not copied).
+    '''
+    pattern = _slice_pattern(starter, ender)
+    if endbefore is None:
+        matches = pattern.finditer(haystack, start)
+    else:
+        matches = pattern.finditer(haystack, start, endbefore)
+    for match in matches:
+        yield match.start(), match.end()
+
+
+def _slice_pattern(starter, ender):
+    return compile_pattern(re.escape(starter) + r'(.*?)' + re.escape(ender))
+
+
 # formerly get_params_len
 def get_operation_chunk_len(val, start=0, step=1, line_n=None):
+    '''
+    Get the length of the operand (such as "a.b(c)[d]") starting at
+    start (or ending at start if step is -1), including any brackets
+    or quotes it has. To get many lengths from the same line (or file),
+    use BracketIndex instead.
+    '''
     result = 0
     openers = "([{"
     closers = ")]}"
@@ -998,8 +1349,8 @@ def get_operation_chunk_len(val, start=0, step=1, line_n=None):
         closers = tmp
         ender = -1
         direction_msg = "before closing"
-    opens = ""
-    closes = ""
+    opens = []
+    closes = []
     index = start
     in_quote = None
     line_message = ""
@@ -1010,15 +1361,15 @@ def get_operation_chunk_len(val, start=0, step=1, line_n=None):
         closer_number = closers.find(val[index])
         expected_closer = None
         if (len(closes) > 0):
-            expected_closer = lastchar(closes)
+            expected_closer = closes[-1]
         quote_number = quotes.find(val[index])
         if (in_quote is None) and (opener_number > -1):
-            opens += openers[opener_number]
-            closes += closers[opener_number]
+            opens.append(openers[opener_number])
+            closes.append(closers[opener_number])
         elif (in_quote is None) and (closer_number > -1):
             if closers[closer_number] == expected_closer:
-                opens = opens[:len(opens)-1]
-                closes = closes[:len(closes)-1]
+                opens.pop()
+                closes.pop()
         elif quote_number > -1:
             if in_quote is None:
                 in_quote = val[index]
@@ -1037,57 +1388,186 @@ def get_operation_chunk_len(val, start=0, step=1, line_n=None):
 
 
 def find_identifier(line, identifier_string, start=0):
-    result = -1
-    start_index = start
-    lenid = 0
+    '''
+    Find identifier_string where it is not quoted, not commented, and
+    not part of a longer identifier.
+
+    Sequential arguments:
+    line -- The string to search, or a CodeView of it (to avoid
+        rescanning the line for each search).
+    identifier_string -- The identifier (can contain dots, such as
+        "Console.WriteLine").
+
+    Keyword arguments:
+    start -- Where to start searching.
+
+    Returns:
+    the index where identifier_string starts, otherwise -1.
+    '''
     if identifier_string is None:
         return -1
-    lenid = len(identifier_string)
-    if lenid < 1:
+    if len(identifier_string) < 1:
         return -1
     if line is None:
         return -1
-    lenl = len(line)
-    if lenl < 1:
+    if len(line) < 1:
         return -1
+    offset = 0
+    if isinstance(line, CodeView):
+        mask = line.mask()
+        line = line.text
+    else:
+        # As with find_unquoted_not_commented, the context starts at
+        #   start.
+        mask = CodeView(line[start:]).mask()
+        offset = start
+    pattern = _identifier_pattern(identifier_string)
+    for match in pattern.finditer(line, start):
+        if not mask[match.start()-offset]:
+            return match.start()
+    return -1
+
+
+def _identifier_pattern(identifier_string):
+    '''
+    Get a regex that matches identifier_string only where it is not
+    part of a longer identifier.
+    '''
+    return re.compile("(?<![{0}]){1}(?![{0}])".format(
+        re.escape(identifier_chars),
+        re.escape(identifier_string),
+    ))
+
+
+_EXPLODE_COMMENT = 0
+_EXPLODE_STOP = 1
+_EXPLODE_QUOTE = 2
+_EXPLODE_DELIMITER = 3
+
+
+def _explode_tokenizer(kinds_and_tokens):
+    '''
+    Get a regex with one group per token (in order of precedence) and
+    a list of the kind of each group (one of the _EXPLODE_* values).
+    '''
+    tokens = []
+    kinds = []
+    for kind, these_tokens in kinds_and_tokens:
+        for token in these_tokens:
+            if token not in tokens:
+                tokens.append(token)
+                kinds.append(kind)
+    if not tokens:
+        return None, kinds
+    return re.compile("|".join("({})".format(re.escape(token))
+                               for token in tokens)), kinds
+
+
+def iexplode_unquoted(haystack, delimiter, strip=True,
+                      quote_marks=['"', "'"], allow_commented=False,
+                      allow_escaping_quotes=True, comment_marks="#",
+                      profile=None):
+    '''
+    Split haystack in one left-to-right pass, yielding each element as
+    soon as its end is found (so the caller can stop early). For the
+    arguments see explode_unquoted.
+
+    Yields:
+    a tuple of (element, start, end) for each element, where the slice
+    defined by start, end includes whitespace even if strip is True.
+    '''
+    if haystack is None:
+        raise ValueError("haystack is None.")
+    if (delimiter is None) or (len(delimiter) < 1):
+        raise ValueError("The delimiter is blank.")
+    for quote_mark in quote_marks:
+        if len(quote_mark) > 1:
+            raise ValueError("Each quote mark can only be 1 in length.")
+    trace_steps = get_trace_level() >= TRACE_STEPS
+    if profile is not None:
+        code = CodeView(haystack, profile=profile)
+        ender_i = len(haystack)
+        if not allow_commented:
+            # Only a line comment is flagged as CTX_COMMENTED alone.
+            comment_i = code.mask().find(CTX_COMMENTED)
+            if comment_i > -1:
+                ender_i = comment_i
+        start = 0
+        while start < ender_i:
+            end = code.find(delimiter, start=start, endbefore=ender_i,
+                            allow_quoted=False,
+                            allow_commented=allow_commented)
+            if trace_steps:
+                trace("explode_unquoted.step", start=start, end=end)
+            if end < 0:
+                end = ender_i
+            element = haystack[start:end]
+            yield (element.strip() if strip else element), start, end
+            start = end + 1
+        return
+    if allow_commented:
+        comment_marks = ()
+        stops = ()
+    else:
+        comment_marks = list(comment_marks)
+        stops = ("#", '"""', "'''")
+        # ^ Like find_unquoted_not_commented (with the default
+        #   comment_delimiters) stop splitting at these.
+    pattern, kinds = _explode_tokenizer([
+        (_EXPLODE_COMMENT, comment_marks),
+        (_EXPLODE_STOP, stops),
+        (_EXPLODE_QUOTE, quote_marks),
+        (_EXPLODE_DELIMITER, (delimiter,)),
+    ])
+    ender_i = len(haystack)
+    start = 0
+    pos = 0
+    in_quote = None
     while True:
-        try_index = find_unquoted_not_commented(line,
-                                                identifier_string,
-                                                start=start_index)
-        if try_index < 0:
+        if in_quote is not None:
+            closer_i = haystack.find(in_quote, pos)
+            while ((closer_i > 0) and allow_escaping_quotes
+                    and (haystack[closer_i-1] == "\\")):
+                closer_i = haystack.find(in_quote, closer_i+1)
+            if closer_i < 0:
+                break
+            in_quote = None
+            pos = closer_i + 1
+            continue
+        match = pattern.search(haystack, pos)
+        if match is None:
             break
-        # id_start = False
-        # if try_index == 0:
-        #     id_start = True
-        # elif line[try_index-1] not in identifier_chars:
-        # is_id = line[try_index-1] in identifier_chars
-        can_start = False
-        if try_index == 0:
-            can_start = True
-        elif line[try_index-1] not in identifier_chars:
-            can_start = True
-        is_alone = False
-
-        if try_index + lenid == lenl:
-            is_alone = True
-        elif line[try_index+lenid] not in identifier_chars:
-            is_alone = True
-
-        if can_start and is_alone:
-            result = try_index
-            # input(identifier_string + "starts after '"
-            #       + line[try_index] + "' ends before '"
-            #       + line[try_index+lenid]
-            #       + "'")
+        kind = kinds[match.lastindex-1]
+        index = match.start()
+        if kind == _EXPLODE_DELIMITER:
+            if trace_steps:
+                trace("explode_unquoted.step", start=start, end=index)
+            element = haystack[start:index]
+            yield (element.strip() if strip else element), start, index
+            start = index + 1  # +1 to skip the delimiter
+            pos = start
+        elif kind == _EXPLODE_QUOTE:
+            in_quote = match.group()
+            pos = match.end()
+        elif kind == _EXPLODE_COMMENT:
+            ender_i = index
             break
         else:
-            # match is part of a different identifier, so skip it
-            # input(identifier_string + " does not after '"
-            #       + line[try_index] + "' ends before '"
-            #       + line[try_index+lenid]
-            #       + "'")
-            start_index = try_index + lenid
-    return result
+            # Stop splitting, but still end at the first comment mark.
+            #   Triple quotes are only 3 quotes from here on (as in
+            #   find_unquoted_even_commented).
+            pattern, kinds = _explode_tokenizer([
+                (_EXPLODE_COMMENT, comment_marks),
+                (_EXPLODE_QUOTE, quote_marks),
+            ])
+            if pattern is None:
+                break
+            pos = index
+    if start < ender_i:
+        if trace_steps:
+            trace("explode_unquoted.step", start=start, end=-1)
+        element = haystack[start:ender_i]
+        yield (element.strip() if strip else element), start, ender_i
 
 
 def get_newline_in_data(data):
@@ -1116,57 +1596,64 @@ def re_escape_visible(val):
 
 
 def get_newline(file_path):
-    data = None
-    with open(file_path, "r") as myfile:
-        data = myfile.read()
-    return get_newline_in_data(data)
+    return load_text(file_path).newline
 
 
 def is_allowed_in_variable_name_char(one_char):
-    result = False
     if len(one_char) == 1:
-        if one_char in identifier_chars:
-            result = True
-    else:
-        echo0("error in is_allowed_in_variable_name_char: one_char"
-              " must be 1 character")
-    return result
+        return one_char in _identifier_char_set
+    echo0("error in is_allowed_in_variable_name_char: one_char"
+          " must be 1 character")
+    return False
+
+
+def _any_not_pattern(chars):
+    return compile_pattern("[^{}]".format(re.escape(chars)))
 
 
 def find_any_not(haystack, char_needles, start=None, step=1):
-    result = -1
+    '''
+    Get the index of the first character that isn't in char_needles
+    (or the last one at or before start if step is -1), or -1 if none.
+
+    Sequential arguments:
+    char_needles -- A string of characters (or a list of characters).
+    '''
     if step not in [-1, 1]:
         raise ValueError("step must be -1 or 1 not {}.".format(step))
-
-    if (len(char_needles) > 0) and (len(haystack) > 0):
-        endbefore = len(haystack)
+    if (len(char_needles) < 1) or (len(haystack) < 1):
+        return -1
+    if not isinstance(char_needles, str):
+        # Only a single character can match a character.
+        char_needles = "".join(needle for needle in char_needles
+                               if len(needle) == 1)
+    if step > 0:
         if start is None:
-            if step > 0:
-                start = 0
-            elif step < 0:
-                start = len(haystack)-1
-        if step < 0:
-            endbefore = -1
-        index = start
-
-        while ((step > 0 and index < endbefore) or
-                (step < 0 and index > endbefore)):
-            if not haystack[index:index+1] in char_needles:
-                result = index
-                break
-            index += step
-    return result
+            start = 0
+        if not char_needles:
+            return start if start < len(haystack) else -1
+        match = _any_not_pattern(char_needles).search(haystack,
+                                                      max(start, 0))
+        if match is None:
+            return -1
+        return match.start()
+    if start is None:
+        start = len(haystack) - 1
+    if start < 0:
+        return -1
+    return len(haystack[:start+1].rstrip(char_needles)) - 1
 
 
 def explode_unquoted(haystack, delimiter, get_str_i_tuple=False,
                      strip=True, quote_marks=['"', "'"],
                      allow_commented=False, min_indent="",
                      allow_escaping_quotes=True,
-                     comment_marks="#"):
+                     comment_marks="#", profile=None):
     '''
     Explode using a delimiter except quoted delimiters using double or
     single quotes. See quoted_slices for a function that uses quotes
-    but not delimiters.
+    but not delimiters. To get each element as soon as it is found
+    (without making a list), use iexplode_unquoted.
 
     Keyword arguments:
     get_str_i_tuple -- Get a list of tuples of (string, start, end)
@@ -1175,65 +1662,31 @@ def explode_unquoted(haystack, delimiter, get_str_i_tuple=False,
         strip will affect the string.
     strip -- Remove whitespace from each element.
     min_indent -- The starting indent only used for logging.
+    profile -- A LanguageProfile or the name of a built-in one (See
+        get_profile) to use instead of quote_marks, comment_marks, and
+        allow_escaping_quotes. The haystack is then scanned only once,
+        and delimiters in block comments are skipped.
     '''
-    if not allow_commented:
-        comment_i = -1
-        for comment_mark in comment_marks:
-            index = find_unquoted_even_commented(
-                haystack,
-                comment_mark,
-                quote_marks=quote_marks,
-                min_indent=min_indent+"  ",
-                allow_escaping_quotes=allow_escaping_quotes,
-            )
-            if index > -1:
-                if (comment_i < 0) or (index < comment_i):
-                    # Use the first comment mark (If found unquoted).
-                    comment_i = index
-        if comment_i > -1:
-            haystack = haystack[:comment_i]
+    trace_level = get_trace_level()
+    if trace_level:
+        trace("explode_unquoted", haystack=haystack, delimiter=delimiter,
+              allow_commented=allow_commented)
     elements = list()
-    start = 0
-    echo4(min_indent+"explode_unquoted:")
-    while start < len(haystack):
-        if allow_commented:
-            end = find_unquoted_even_commented(
-                haystack,
-                delimiter,
-                start=start,
-                quote_marks=quote_marks,
-                min_indent=min_indent+"  ",
-                allow_escaping_quotes=allow_escaping_quotes,
-            )
-        else:
-            end = find_unquoted_not_commented(
-                haystack,
-                delimiter,
-                start=start,
-                quote_marks=quote_marks,
-                min_indent=min_indent+"  ",
-                allow_escaping_quotes=allow_escaping_quotes,
-            )
-        echo4(min_indent+'- haystack[{}:]="{}"'
-              ''.format(start, haystack[start:]))
-        echo4(min_indent+'- end={} ender="{}"'
-              ''.format(end, delimiter))
-        if end < 0:
-            end = len(haystack)
-        hs = haystack
-        element = hs[start:end].strip() if strip else hs[start:end]
+    for element, start, end in iexplode_unquoted(
+            haystack,
+            delimiter,
+            strip=strip,
+            quote_marks=quote_marks,
+            allow_commented=allow_commented,
+            allow_escaping_quotes=allow_escaping_quotes,
+            comment_marks=comment_marks,
+            profile=profile):
         if get_str_i_tuple:
             elements.append((element, start, end))
         else:
             elements.append(element)
-        start = end + 1  # +1 to skip the delimiter
-        '''
-        if start + len(elements[-1]) >= len(haystack):
-            break
-        '''
-    echo4(min_indent+"END explode_unquoted after '{}' element at {}"
-          " due to '{}' not found"
-          "".format(haystack[start:start+1], start, delimiter))
+    if trace_level:
+        trace("explode_unquoted.result", elements=list(elements))
 
     '''
     element = haystack[start:].strip() if strip else haystack[start:]
@@ -1249,64 +1702,83 @@ def explode_unquoted(haystack, delimiter, get_str_i_tuple=False,
     return elements
 
 
+def _dup_groups(this_list, discard_whitespace_ignore_None_enable,
+                ignore_list, ignore_numbers_enable):
+    '''
+    Get an OrderedDict of each (normalized) value to the list of
+    indices where it occurs, in order of first occurrence, normalizing
+    each element only once. See find_dup for arguments.
+    '''
+    groups = OrderedDict()
+    for index, value in enumerate(this_list):
+        if discard_whitespace_ignore_None_enable:
+            if value is None:
+                continue
+            value = value.strip()
+            if len(value) == 0:
+                continue
+        indices = groups.get(value)
+        if indices is None:
+            groups[value] = [index]
+        else:
+            indices.append(index)
+    results = OrderedDict()
+    for value, indices in groups.items():
+        if len(indices) < 2:
+            continue
+        if (ignore_list is not None) and (value in ignore_list):
+            continue
+        if ignore_numbers_enable and (value is not None):
+            try:
+                float(value)
+                continue
+            except ValueError:
+                pass
+        results[value] = indices
+    return results
+
+
 def find_dup(this_list, discard_whitespace_ignore_None_enable=True,
              ignore_list=None, ignore_numbers_enable=False):
     """
-    DISCARD whitespace, and never match None to None
+    DISCARD whitespace, and never match None to None (unless
+    discard_whitespace_ignore_None_enable is False, in which case
+    values must match exactly).
+
+    Returns:
+    the index of the second occurrence of the earliest value that
+    occurs more than once, or -1 if none. See find_all_dups to get
+    every duplicate.
     """
-    result = -1
-    if type(this_list) is list:
-        for i1 in range(0, len(this_list)):
-            for i2 in range(0, len(this_list)):
-                i1_strip = None
-                i2_strip = None
-                if this_list[i1] is not None:
-                    i1_strip = this_list[i1].strip()
-                if this_list[i2] is not None:
-                    i2_strip = this_list[i2].strip()
-                if (i1_strip is not None and
-                        len(i1_strip) > 0 and
-                        i2_strip is not None and
-                        len(i2_strip) > 0):
-                    if ((i1 != i2) and
-                            (ignore_list is None or
-                             i1_strip not in ignore_list) and
-                            i1_strip == i2_strip):
-                        number1 = None
-                        # number2 = None
-                        if ignore_numbers_enable:
-                            try:
-                                number1 = int(i1_strip)
-                            except ValueError:
-                                try:
-                                    number1 = float(i1_strip)
-                                except ValueError:
-                                    pass
-                            # only need one since they already are known
-                            #   to match as text
-                            # try:
-                            #     number2 = int(i2_strip)
-                            # except:
-                            #     try:
-                            #         number2 = float(i2_strip)
-                            #     except:
-                            #         pass
-                        ignore_this = False
-                        if ignore_numbers_enable:
-                            ignore_this = number1 is not None
-                        if not ignore_this:
-                            result = i2
-                            echo1("[" + str(i1) + "]:"
-                                  + str(this_list[i1])
-                                  + " matches [" + str(i2) + "]:"
-                                  + str(this_list[i2]))
-                            break
-            if result > -1:
-                break
-    else:
+    if type(this_list) is not list:
         echo0("[ parsing.py ] ERROR in has_dups: " + str(this_list)
               + " is not a list")
-    return result
+        return -1
+    groups = _dup_groups(this_list, discard_whitespace_ignore_None_enable,
+                         ignore_list, ignore_numbers_enable)
+    for indices in groups.values():
+        i1, i2 = indices[:2]
+        echo1("[" + str(i1) + "]:"
+              + str(this_list[i1])
+              + " matches [" + str(i2) + "]:"
+              + str(this_list[i2]))
+        return i2
+    return -1
+
+
+def find_all_dups(this_list, discard_whitespace_ignore_None_enable=True,
+                  ignore_list=None, ignore_numbers_enable=False):
+    """
+    Get a list of every group of duplicates, where each group is a list
+    of the indices of the same value, in order of first occurrence (See
+    find_dup for arguments).
+    """
+    if type(this_list) is not list:
+        echo0("[ parsing.py ] ERROR in find_all_dups: " + str(this_list)
+              + " is not a list")
+        return []
+    return list(_dup_groups(this_list, discard_whitespace_ignore_None_enable,
+                            ignore_list, ignore_numbers_enable).values())
 
 
 def has_dups(this_list):
@@ -1365,151 +1837,2288 @@ def find_which_needle(haystack, haystack_i, needles, subscript=None):
 
 
 quoted_slices_error = None
+# ^ Deprecated (See SliceSet.error).
 
 
 def get_quoted_slices_error():
-    return quoted_slices_error
+    '''
+    Deprecated: Use the error property of the SliceSet from
+    quoted_slices instead.
+
+    Get the error (or None) from the latest quoted_slices (or finished
+    iquoted_slices) call in this thread.
+    '''
+    return getattr(_call_results, "quoted_slices_error", None)
 
 
-def which_slice(v, ranges, length=None):
+class SliceSet(object):
     '''
-    Get the index of the slice (ranged pair) that contains v.
+    A sorted, immutable set of (start, stop) slices (start inclusive,
+    stop exclusive as per Python slice notation), such as the quoted
+    portions of a string (See quoted_slices). Slices that overlap are
+    merged, but adjacent slices such as (0, 3) and (3, 6) are kept
+    separate so each quoted string is still its own slice.
 
-    Sequential arguments:
-    v -- Check for this index within each range
-    ranges -- A list of number pairs such as tuples [(start, stop),...]
-        where start is inclusive and stop is exclusive as per Python
-        slice and range notation.
+    Finding which slice contains an index is O(log n) (See which), so
+    checking every character of a line doesn't become quadratic.
 
-    Keyword arguments:
+    A SliceSet equals a list (or other sequence) of the same pairs, so
+    it can be used in place of the list that quoted_slices used to
+    return.
+
+    Properties
+    error -- None, or the problem found while making the slices, such
+        as END_BEFORE_QUOTE_ERR from quoted_slices. It is not compared by
+        ==.
+    '''
+    __slots__ = ("_starts", "_stops", "error")
+
+    def __init__(self, slices=(), length=None, error=None):
+        '''
+        Sequential arguments:
+        slices -- Any iterable of (start, stop) pairs, in any order.
+
+        Keyword arguments:
+        length -- If either of the values in any slice is negative, you
+            must provide the length of the string to which the slices
+            refer (so that the real index can be calculated). Otherwise
+            raise ValueError.
+        '''
+        pairs = []
+        is_sorted = True
+        for start, stop in slices:
+            if start < 0 or stop < 0:
+                if length is None:
+                    raise ValueError("negative slice notation requires"
+                                     " length but got ({}, {})"
+                                     "".format(start, stop))
+                if start < 0:
+                    start += length
+                if stop < 0:
+                    stop += length
+            if stop < start:
+                raise ValueError("stop is before start in ({}, {})"
+                                 "".format(start, stop))
+            if pairs and (start, stop) < pairs[-1]:
+                is_sorted = False
+            pairs.append((start, stop))
+        if not is_sorted:
+            pairs.sort()
+        starts = []
+        stops = []
+        for start, stop in pairs:
+            if stops and start < stops[-1]:
+                # It overlaps the previous slice, so merge them.
+                if stop > stops[-1]:
+                    stops[-1] = stop
+                continue
+            starts.append(start)
+            stops.append(stop)
+        self._starts = starts
+        self._stops = stops
+        self.error = error
+
+    def which(self, index):
+        '''
+        Get the index of the slice that contains index, or -1 if none.
+        '''
+        slice_i = bisect_right(self._starts, index) - 1
+        if slice_i >= 0 and index < self._stops[slice_i]:
+            return slice_i
+        return -1
+
+    def __contains__(self, item):
+        '''
+        Check whether an index is in any slice, or whether a (start,
+        stop) pair is one of the slices.
+        '''
+        if isinstance(item, tuple):
+            slice_i = bisect_left(self._starts, item[0])
+            return ((slice_i < len(self._starts))
+                    and (self._starts[slice_i] == item[0])
+                    and (self._stops[slice_i] == item[1]))
+        return self.which(item) > -1
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __iter__(self):
+        return zip(self._starts, self._stops)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return SliceSet(zip(self._starts[index], self._stops[index]))
+        return (self._starts[index], self._stops[index])
+
+    def __or__(self, other):
+        '''
+        Get the union (as a new SliceSet).
+        '''
+        return SliceSet(list(self) + list(other))
+
+    def __and__(self, other):
+        '''
+        Get the intersection (as a new SliceSet).
+        '''
+        if not isinstance(other, SliceSet):
+            other = SliceSet(other)
+        results = []
+        i = 0
+        j = 0
+        while i < len(self._starts) and j < len(other._starts):
+            start = max(self._starts[i], other._starts[j])
+            stop = min(self._stops[i], other._stops[j])
+            if start < stop:
+                results.append((start, stop))
+            if self._stops[i] < other._stops[j]:
+                i += 1
+            else:
+                j += 1
+        return SliceSet(results)
+
+    __ror__ = __or__
+    __rand__ = __and__
+
+    def __eq__(self, other):
+        if isinstance(other, SliceSet):
+            return ((self._starts == other._starts)
+                    and (self._stops == other._stops))
+        try:
+            return list(self) == [tuple(pair) for pair in other]
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash((tuple(self._starts), tuple(self._stops)))
+
+    def __repr__(self):
+        return "SliceSet({})".format(list(self))
+
+
+def which_slice(v, ranges, length=None):
+    '''
+    Get the index of the slice (ranged pair) that contains v.
+
+    Sequential arguments:
+    v -- Check for this index within each range
+    ranges -- A SliceSet (checked in O(log n) time, see SliceSet.which),
+        or a list of number pairs such as tuples [(start, stop),...]
+        where start is inclusive and stop is exclusive as per Python
+        slice and range notation.
+
+    Keyword arguments:
     length -- If either of the values in any range is negative, you must
         provide the length of the string to which the slices refer (so
         that the real index can be calculated). Otherwise this function
         will raise a ValueError.
 
-    Returns:
-    The first index in ranges that has the range that contains v, or
-    -1 if v was not in any ranges.
+    Returns:
+    The first index in ranges that has the range that contains v, or
+    -1 if v was not in any ranges.
+    '''
+    if isinstance(ranges, SliceSet):
+        return ranges.which(v)
+    for range_i in range(len(ranges)):
+        start, stop = ranges[range_i]
+        if start < 0:
+            if length is not None:
+                start = length + start
+            else:
+                raise ValueError("negative slice notation isn't"
+                                 " implemented but a start index is"
+                                 " negative in {}".format(ranges))
+        if stop < 0:
+            if length is not None:
+                stop = length + stop
+            else:
+                raise ValueError("negative slice notation isn't"
+                                 " implemented but a stop index is"
+                                 " negative in {}".format(ranges))
+        if (v >= start) and (v < stop):
+            return range_i
+    return -1
+
+
+def in_any_slice(i, ranges):
+    return which_slice(i, ranges) > -1
+
+
+END_BEFORE_QUOTE_ERR = "string ended before quote ended"
+
+
+def quoted_slices(haystack, start=0, endbefore=None,
+                  comment_delimiters=["#"], profile=None):
+    '''
+    Get a SliceSet of the start and stop values for quoted portions of
+    haystack. The start of each slice is the first quotation mark (`"`
+    or `'`) and the stop is 1 after the ending quote's index (as per
+    slice notation). See explode_unquoted for a function that does
+    something similar but also uses field delimiters (with
+    get_str_i_tuple option to get slice start index).
+    - For a hard slice search excluding comments use find_slice instead.
+    - To get each slice as soon as it is found (such as for a huge
+      line), use iquoted_slices instead.
+
+    Keyword arguments:
+    comment_delimiters -- Use this to specify one or more comment
+        delimiters. Examples: ['#'] for Python or ['#', '//'] for PHP
+    profile -- A LanguageProfile or the name of a built-in one (See
+        get_profile) to use instead of comment_delimiters. The haystack
+        is then scanned using the profile's regex tokenizer, so block
+        comments are skipped (instead of ending the search as line
+        comments do) and each triple quoted string is one slice.
+    '''
+    global quoted_slices_error
+    errors = []
+    slices = SliceSet(
+        list(_iquoted_slices(haystack, start, endbefore,
+                             comment_delimiters, profile, errors)),
+        error=(errors[0] if errors else None),
+    )
+    _call_results.quoted_slices_error = slices.error
+    quoted_slices_error = slices.error
+    return slices
+
+
+def iquoted_slices(haystack, start=0, endbefore=None,
+                   comment_delimiters=["#"], profile=None, errors=None):
+    '''
+    Generate a (start, stop) tuple for each quoted portion of haystack
+    in order (See quoted_slices for other arguments).
+
+    Keyword arguments:
+    errors -- If not None, append any error (such as
+        END_BEFORE_QUOTE_ERR) to this list once it is found.
+    '''
+    global quoted_slices_error
+    if errors is None:
+        errors = []
+    first_error_i = len(errors)
+    for pair in _iquoted_slices(haystack, start, endbefore,
+                                comment_delimiters, profile, errors):
+        yield pair
+    error = errors[first_error_i] if len(errors) > first_error_i else None
+    _call_results.quoted_slices_error = error
+    quoted_slices_error = error
+
+
+def _iquoted_slices(haystack, start, endbefore, comment_delimiters, profile,
+                    errors):
+    '''
+    Generate the slices for quoted_slices and iquoted_slices, appending
+    any error to errors instead of setting a global.
+    '''
+    if profile is not None:
+        comment_delimiters = None  # the profile's are used instead
+    elif comment_delimiters is None:
+        echo0("WARNING: quoted_slices got no comment delimiters.")
+        comment_delimiters = []
+    error = None
+    results = []
+    open_i = None
+    i = start
+    quotes = "\"'"
+    if haystack is None:
+        raise ValueError("haystack is None")
+    if endbefore is None:
+        endbefore = len(haystack)
+    elif endbefore < 0:
+        new_endbefore = len(haystack) + endbefore
+        # ^ + since already negative
+        echo2("INFO: endbefore was negative so it will"
+              " change to len(haystack)+offset (endbefore={},"
+              " new_endbefore={})."
+              "".format(endbefore, new_endbefore))
+        endbefore = new_endbefore
+    if endbefore < start:
+        raise ValueError("endbefore is < start which should never be"
+                         " the case (endbefore={})"
+                         "".format(endbefore))
+    if profile is not None:
+        profile = get_profile(profile)
+        slices = []
+        if _use_numpy(endbefore-start) and not profile.block_closers:
+            _, in_quote, _ = _scan_context_numpy(
+                haystack[start:endbefore],
+                profile.comment_delimiters,
+                tuple(profile.triple_quotes) + tuple(profile.quote_marks),
+                profile.allow_escaping_quotes,
+                slices=slices,
+            )
+        else:
+            _, in_quote, _ = _scan_context(
+                haystack[start:endbefore],
+                profile.tokenizer,
+                profile.comment_delimiters,
+                profile.allow_escaping_quotes,
+                block_comments=profile.block_closers,
+                slices=slices,
+            )
+        for open_i, end in slices:
+            if end is not None:
+                yield (open_i+start, end+start)
+        if in_quote is not None:
+            errors.append(END_BEFORE_QUOTE_ERR)
+        return
+    i -= 1
+    open_i = None
+    prev_c = None
+    comment_started = False
+    trace_level = get_trace_level()
+    trace_steps = trace_level >= TRACE_STEPS
+    if trace_level:
+        trace("quoted_slices", haystack=haystack, start=start,
+              endbefore=endbefore, comment_delimiters=comment_delimiters)
+    if (not trace_steps) and _use_numpy(endbefore-start):
+        slices = []
+        _scan_context_numpy(haystack[start:endbefore], comment_delimiters,
+                            quotes, True, slices=slices)
+        for open_i, end in slices:
+            if end is None:
+                break
+            if trace_level:
+                results.append((open_i+start, end+start))
+            yield (open_i+start, end+start)
+        else:
+            open_i = None
+        if open_i is not None:
+            open_i += start
+        i = endbefore - 1  # as if the loop below reached the end
+    while i+1 < endbefore:
+        i += 1
+        c = haystack[i]
+        if trace_steps:
+            trace("quoted_slices.step", i=i, open_i=open_i, c=c)
+        if open_i is None:
+            if c in quotes:
+                open_i = i
+            else:
+                for c_delim in comment_delimiters:
+                    if (haystack[i:i+len(c_delim)] == c_delim):
+                        comment_started = True
+                        break
+                if comment_started:
+                    break
+        elif (c == haystack[open_i]) and (prev_c != "\\"):
+            if trace_level:
+                results.append((open_i, i+1))
+            yield (open_i, i+1)
+            # ^ first quote & 1 after end quote as per slice notation
+            #   (including both quotes)
+            open_i = None
+        prev_c = c
+    if open_i is not None:
+        error = END_BEFORE_QUOTE_ERR
+        errors.append(error)
+        echo0("WARNING: The quote ([{}]) wasn't closed in"
+              " (i={}, endbefore={}):"
+              "".format(open_i+1, i, endbefore))
+        echo0("`{}`".format(haystack))
+        end_mark_i = endbefore - (open_i+1)
+        end_mark = ""
+        if end_mark_i >= 0:
+            # end_mark = "^end"
+            pass
+        echo0(" "*(open_i+1) + "^" + " "*end_mark_i + end_mark)
+        # raise SyntaxError("END_BEFORE_QUOTE_ERR")
+    if trace_level:
+        trace("quoted_slices.result", results=list(results),
+              error=error)
+
+
+# Character context flags stored by CodeView (one byte per character):
+CTX_QUOTED = 1  # inside a quoted string (including its quote marks)
+CTX_COMMENTED = 2  # at or after the start of a comment
+CTX_QUOTE_MARK = 4  # an opening or closing quote mark (also CTX_QUOTED)
+CTX_BLOCK_COMMENT = 8  # in a block comment (also CTX_COMMENTED)
+
+DEFAULT_TRIPLE_QUOTES = ('"""', "'''")
+
+
+def _context_tokenizer(comment_delimiters, quote_marks, triple_quotes,
+                       block_comments=None):
+    '''
+    Get a regex that finds the next comment delimiter, block comment
+    opener, or quote mark. Comment delimiters are listed first so that
+    (as in find_in_code) a comment mark wins if both start at the same
+    index, and triple quotes are listed before quote marks so that they
+    win over a single quote mark.
+
+    Keyword arguments:
+    block_comments -- A dict where each key opens a block comment and
+        each value closes it.
+    '''
+    tokens = []
+    if block_comments is None:
+        block_comments = {}
+    for token in (list(comment_delimiters) + list(block_comments.keys())
+                  + list(triple_quotes) + list(quote_marks)):
+        if token not in tokens:
+            tokens.append(token)
+    if not tokens:
+        return None
+    return re.compile("|".join(re.escape(token) for token in tokens))
+
+
+def _scan_context(text, tokenizer, comment_delimiters, allow_escaping_quotes,
+                  in_quote=None, block_comments=None, in_comment=None,
+                  slices=None):
+    '''
+    Get a bytearray of CTX_* flags for each character in text.
+
+    Sequential arguments:
+    tokenizer -- A regex from _context_tokenizer.
+    comment_delimiters -- The comment delimiters the tokenizer was
+        built with (any other token is a quote or block comment opener).
+
+    Keyword arguments:
+    in_quote -- If not None, text starts inside of a quote that is
+        closed by this string.
+    block_comments -- The block_comments the tokenizer was built with.
+    in_comment -- If not None, text starts inside of a block comment
+        that is closed by this string.
+    slices -- If not None, append a (start, stop) tuple to this list
+        for each quote that is opened and closed in text (including
+        the quote marks, as in quoted_slices), or (start, None) for a
+        quote that is still open at the end.
+
+    Returns:
+    a tuple of the mask, the closing quote string still expected at the
+    end of text (or None if the text ended outside of quotes), and the
+    closing block comment string still expected (or None).
+    '''
+    length = len(text)
+    mask = bytearray(length)
+    quoted = bytes((CTX_QUOTED,))
+    mark = bytes((CTX_QUOTED | CTX_QUOTE_MARK,))
+    commented = bytes((CTX_COMMENTED,))
+    block = bytes((CTX_COMMENTED | CTX_BLOCK_COMMENT,))
+    if block_comments is None:
+        block_comments = {}
+    open_i = None
+    pos = 0
+    while pos < length:
+        if in_comment is not None:
+            closer_i = text.find(in_comment, pos)
+            if closer_i < 0:
+                mask[pos:] = block * (length-pos)
+                break
+            end = closer_i + len(in_comment)
+            mask[pos:end] = block * (end-pos)
+            in_comment = None
+            pos = end
+            continue
+        if in_quote is None:
+            if tokenizer is None:
+                break
+            match = tokenizer.search(text, pos)
+            if match is None:
+                break
+            token = match.group()
+            token_i = match.start()
+            if token in comment_delimiters:
+                mask[token_i:] = commented * (length-token_i)
+                break
+            if token in block_comments:
+                mask[token_i:match.end()] = block * len(token)
+                in_comment = block_comments[token]
+                pos = match.end()
+                continue
+            mask[token_i:match.end()] = mark * len(token)
+            open_i = token_i
+            in_quote = token
+            pos = match.end()
+            continue
+        closer_i = pos
+        while True:
+            closer_i = text.find(in_quote, closer_i)
+            if closer_i < 0:
+                break
+            if (allow_escaping_quotes and (closer_i > 0)
+                    and (text[closer_i-1] == "\\")):
+                closer_i += 1
+                continue
+            break
+        if closer_i < 0:
+            mask[pos:] = quoted * (length-pos)
+            break
+        mask[pos:closer_i] = quoted * (closer_i-pos)
+        end = closer_i + len(in_quote)
+        mask[closer_i:end] = mark * len(in_quote)
+        if (slices is not None) and (open_i is not None):
+            slices.append((open_i, end))
+        open_i = None
+        in_quote = None
+        pos = end
+    if (slices is not None) and (open_i is not None):
+        slices.append((open_i, None))
+    return mask, in_quote, in_comment
+
+
+# Lines at least this long are scanned by numpy (if installed):
+NUMPY_MIN_LENGTH = 65536
+_numpy_min_length = NUMPY_MIN_LENGTH
+
+
+def set_numpy_min_length(length):
+    '''
+    Set how long a string must be for CodeView and quoted_slices to scan
+    it with numpy (if numpy is installed) instead of the pure Python
+    scanner. The results are the same either way.
+
+    Sequential arguments:
+    length -- The minimum length, 0 to use numpy for every string, or
+        None to never use numpy.
+    '''
+    global _numpy_min_length
+    if (length is not None) and (length < 0):
+        raise ValueError("length must be >= 0 or None not {}"
+                         "".format(length))
+    _numpy_min_length = length
+
+
+def _use_numpy(length):
+    return ((numpy is not None) and (_numpy_min_length is not None)
+            and (length >= _numpy_min_length))
+
+
+def _code_points(text):
+    '''
+    Get a numpy array of the code point of each character in text.
+    '''
+    return numpy.frombuffer(text.encode("utf-32-le", "surrogatepass"),
+                            dtype=numpy.uint32)
+
+
+def _token_hits(codes, token):
+    '''
+    Get a numpy bool array that is True where token starts in codes
+    (including where occurrences overlap).
+    '''
+    length = len(codes)
+    hits = numpy.zeros(length, dtype=bool)
+    count = length - len(token) + 1
+    if count < 1:
+        return hits
+    found = codes[:count] == ord(token[0])
+    for offset in range(1, len(token)):
+        found &= codes[offset:count+offset] == ord(token[offset])
+    hits[:count] = found
+    return hits
+
+
+def _scan_context_numpy(text, comment_delimiters, quotes,
+                        allow_escaping_quotes, slices=None):
+    '''
+    Get the same result as _scan_context using vectorized numpy
+    operations. Block comments and starting inside of a quote or comment
+    are not supported (use _scan_context for those).
+
+    Each place a token (a comment delimiter, or one of quotes in order
+    of precedence such as triple quotes before quote marks) starts could
+    open a quote or comment, and each opener is followed by the first
+    opener after its closer. Which openers are really reached from the
+    start is found by pointer doubling (log n steps over the arrays
+    instead of a Python loop over every token).
+    '''
+    length = len(text)
+    if length == 0:
+        return bytearray(), None, None
+    codes = _code_points(text)
+    tokens = []
+    for token in list(comment_delimiters) + list(quotes):
+        if token and (token not in tokens):
+            tokens.append(token)
+    comment_count = len([token for token in tokens
+                         if token in comment_delimiters])
+    token_at = numpy.full(length, -1, dtype=numpy.int64)
+    token_positions = []
+    for token_i, token in enumerate(tokens):
+        hits = _token_hits(codes, token)
+        token_positions.append(numpy.flatnonzero(hits))
+        token_at[hits & (token_at < 0)] = token_i
+    starts = numpy.flatnonzero(token_at >= 0)
+    kinds = token_at[starts]
+    count = len(starts)
+    lengths = numpy.array([len(token) for token in tokens],
+                          dtype=numpy.int64)
+    closes = numpy.full(count, -1, dtype=numpy.int64)
+    escaped = None
+    if allow_escaping_quotes:
+        escaped = numpy.zeros(length, dtype=bool)
+        escaped[1:] = codes[:-1] == ord("\\")
+    for token_i in range(comment_count, len(tokens)):
+        which = numpy.flatnonzero(kinds == token_i)
+        if len(which) == 0:
+            continue
+        closers = token_positions[token_i]
+        if escaped is not None:
+            closers = closers[~escaped[closers]]
+        next_i = numpy.searchsorted(closers, starts[which]+lengths[token_i])
+        found = next_i < len(closers)
+        closes[which[found]] = closers[next_i[found]]
+    closed = closes >= 0
+    ends = numpy.where(closed, closes+lengths[kinds], length)
+    successors = numpy.full(count+1, count, dtype=numpy.int64)
+    successors[:count][closed] = numpy.searchsorted(starts, ends[closed])
+    # ^ A comment or unclosed quote is the last opener (count means none).
+    reached = numpy.zeros(count+1, dtype=bool)
+    reached[0] = True
+    jumps = successors
+    while True:
+        reached[jumps[reached]] = True
+        if (jumps[:count] == count).all():
+            break
+        jumps = jumps[jumps]
+    opener_i = numpy.flatnonzero(reached[:count])
+    kinds = kinds[opener_i]
+    starts = starts[opener_i]
+    closes = closes[opener_i]
+    ends = ends[opener_i]
+    is_quote = kinds >= comment_count
+    comment_i = None
+    if len(kinds) and not is_quote[-1]:
+        comment_i = int(starts[-1])
+    kinds = kinds[is_quote]
+    starts = starts[is_quote]
+    closes = closes[is_quote]
+    ends = ends[is_quote]
+    closed = closes >= 0
+    quoted = numpy.zeros(length+1, dtype=numpy.int8)
+    quoted[starts] += 1
+    quoted[ends[closed]] -= 1
+    marks = numpy.zeros(length+1, dtype=numpy.int8)
+    marks[starts] += 1
+    marks[starts+lengths[kinds]] -= 1
+    marks[closes[closed]] += 1
+    marks[ends[closed]] -= 1
+    mask = numpy.where(numpy.cumsum(quoted[:length]) > 0,
+                       CTX_QUOTED, 0).astype(numpy.uint8)
+    mask[numpy.cumsum(marks[:length]) > 0] |= CTX_QUOTE_MARK
+    if comment_i is not None:
+        mask[comment_i:] = CTX_COMMENTED
+    in_quote = None
+    if len(closed) and not closed[-1]:
+        in_quote = tokens[int(kinds[-1])]
+    if slices is not None:
+        for start, end, is_closed in zip(starts.tolist(), ends.tolist(),
+                                         closed.tolist()):
+            slices.append((start, end if is_closed else None))
+    return bytearray(mask.tobytes()), in_quote, None
+
+
+def _enclosure_depths(text, mask, enclosures, opener_stack=None):
+    '''
+    Get an array('H') where each element is how deeply the character is
+    enclosed. An opener counts as enclosed by itself and a closer as
+    enclosed by its opener, so that only characters with a depth of 0
+    are outside of every enclosure. Characters that have any flags in
+    mask do not open or close anything.
+
+    Keyword arguments:
+    opener_stack -- A list of openers that are still open before text
+        starts. The list is modified in place.
+    '''
+    closers = _enclosure_closers(enclosures)
+    if opener_stack is None:
+        opener_stack = []
+    depths = array('H', [0]) * len(text)
+    chars = "".join(sorted(set(closers.keys()) | set(closers.values())))
+    pos = 0
+    for match in re.finditer("[{}]".format(re.escape(chars)), text):
+        index = match.start()
+        if mask[index]:
+            continue
+        depth = len(opener_stack)
+        if depth:
+            depths[pos:index] = array('H', [depth]) * (index-pos)
+        this_char = text[index]
+        if opener_stack and (this_char == closers[opener_stack[-1]]):
+            opener_stack.pop()
+        elif this_char in closers:
+            opener_stack.append(this_char)
+        depths[index] = max(depth, len(opener_stack))
+        pos = index + 1
+    depth = len(opener_stack)
+    if depth:
+        depths[pos:] = array('H', [depth]) * (len(text)-pos)
+    return depths
+
+
+_closers_cache = {}
+
+
+def _enclosure_closers(enclosures):
+    '''
+    Validate enclosures (See find_in_code) and get a dict where each
+    key is an opener and each value is the matching closer. The result
+    is cached (Do not modify it).
+    '''
+    key = tuple(enclosures)
+    closers = _closers_cache.get(key)
+    if closers is not None:
+        return closers
+    closers = {}
+    for pair in enclosures:
+        if len(pair) != 2:
+            raise ValueError("All sets of enclosures must be 2-long"
+                             " but the enclosures are: {}"
+                             "".format(enclosures))
+        if len(pair[0]) != 1:
+            raise ValueError("All openers must be 1-long"
+                             " but the enclosures are: {}"
+                             "".format(enclosures))
+        if len(pair[1]) != 1:
+            raise ValueError("All closers must be 1-long"
+                             " but the enclosures are: {}"
+                             "".format(enclosures))
+        closers[pair[0]] = pair[1]
+    _closers_cache[key] = closers
+    return closers
+
+
+class LanguageProfile(object):
+    '''
+    The quote and comment rules of a language, validated and compiled
+    into regex tokenizers once so that searches using the profile (See
+    the profile argument of find_in_code) skip over strings and
+    comments using the regex instead of checking every character. A
+    profile is immutable (and can be pickled), so the built-in ones
+    (See get_profile) can be shared.
+
+    Properties
+    name -- the name of the language (or None for a custom profile).
+    comment_delimiters -- a tuple of strings that comment out the rest
+        of the line.
+    quote_marks -- a tuple of 1-long strings that start or end a quote.
+    triple_quotes -- a tuple of strings that start or end a quote
+        (that can continue onto the next line) and are checked before
+        quote_marks.
+    block_comments -- a tuple of (opener, closer) pairs such as
+        (("/*", "*/"),) that comment out everything between them.
+    allow_escaping_quotes -- a quote mark directly after a backslash
+        does not close the quote.
+    block_closers -- a dict where each key is a block comment opener and
+        each value is the closer (Do not modify it).
+    tokenizer -- a regex that finds the next comment or quote.
+    quote_tokenizer -- a regex that finds the next quote (for searches
+        that ignore comments).
+    '''
+    __slots__ = (
+        "name",
+        "comment_delimiters",
+        "quote_marks",
+        "triple_quotes",
+        "block_comments",
+        "allow_escaping_quotes",
+        "block_closers",
+        "tokenizer",
+        "quote_tokenizer",
+    )
+
+    def __init__(self, name, comment_delimiters=("#",),
+                 quote_marks=('"', "'"), triple_quotes=(),
+                 block_comments=(), allow_escaping_quotes=True):
+        if comment_delimiters is None:
+            comment_delimiters = ()
+        if block_comments is None:
+            block_comments = ()
+        for quote_mark in quote_marks:
+            if len(quote_mark) != 1:
+                raise ValueError("Each quote mark can only be 1 in length.")
+        for delimiter in comment_delimiters:
+            if len(delimiter) < 1:
+                raise ValueError("A comment delimiter is blank.")
+        for pair in block_comments:
+            if (len(pair) != 2) or (len(pair[0]) < 1) or (len(pair[1]) < 1):
+                raise ValueError("Each block comment must be an (opener,"
+                                 " closer) pair but got {}".format(pair))
+        block_comments = tuple(tuple(pair) for pair in block_comments)
+        block_closers = dict(block_comments)
+        init = object.__setattr__
+        init(self, "name", name)
+        init(self, "comment_delimiters", tuple(comment_delimiters))
+        init(self, "quote_marks", tuple(quote_marks))
+        init(self, "triple_quotes", tuple(triple_quotes))
+        init(self, "block_comments", block_comments)
+        init(self, "allow_escaping_quotes", allow_escaping_quotes)
+        init(self, "block_closers", block_closers)
+        init(self, "tokenizer", _context_tokenizer(
+            self.comment_delimiters,
+            self.quote_marks,
+            self.triple_quotes,
+            block_comments=block_closers,
+        ))
+        init(self, "quote_tokenizer", _context_tokenizer(
+            (),
+            self.quote_marks,
+            self.triple_quotes,
+        ))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("A LanguageProfile is immutable.")
+
+    def __delattr__(self, name):
+        raise AttributeError("A LanguageProfile is immutable.")
+
+    def _key(self):
+        return (self.name, self.comment_delimiters, self.quote_marks,
+                self.triple_quotes, self.block_comments,
+                self.allow_escaping_quotes)
+
+    def __reduce__(self):
+        return (self.__class__, self._key())
+
+    def __eq__(self, other):
+        if not isinstance(other, LanguageProfile):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return "LanguageProfile({!r})".format(self.name)
+
+
+_c_profile = LanguageProfile(
+    "c",
+    comment_delimiters=("//",),
+    block_comments=(("/*", "*/"),),
+)
+
+LANGUAGE_PROFILES = {
+    "python": LanguageProfile(
+        "python",
+        triple_quotes=DEFAULT_TRIPLE_QUOTES,
+    ),
+    "c": _c_profile,
+    "cpp": _c_profile,
+    "c++": _c_profile,
+    "csharp": LanguageProfile(
+        "csharp",
+        comment_delimiters=("//",),
+        block_comments=(("/*", "*/"),),
+    ),
+    "php": LanguageProfile(
+        "php",
+        comment_delimiters=("//", "#"),
+        block_comments=(("/*", "*/"),),
+    ),
+    "bash": LanguageProfile("bash"),
+}
+LANGUAGE_PROFILES["c#"] = LANGUAGE_PROFILES["csharp"]
+LANGUAGE_PROFILES["sh"] = LANGUAGE_PROFILES["bash"]
+
+
+def get_profile(profile):
+    '''
+    Get a built-in LanguageProfile by name.
+
+    Sequential arguments:
+    profile -- The name of the language (any key in LANGUAGE_PROFILES,
+        such as "python", "c", "cpp", "csharp", "php", or "bash"),
+        or a LanguageProfile (which is returned as is).
+    '''
+    if isinstance(profile, LanguageProfile):
+        return profile
+    result = LANGUAGE_PROFILES.get(profile.lower())
+    if result is None:
+        raise ValueError("There is no language profile named {} (try one"
+                         " of: {})".format(repr(profile),
+                                           sorted(LANGUAGE_PROFILES)))
+    return result
+
+
+_custom_profiles = {}
+
+
+def _custom_profile(comment_delimiters, quote_marks, triple_quotes,
+                    block_comments, allow_escaping_quotes):
+    '''
+    Get a LanguageProfile (with no name) for the given rules (See
+    LanguageProfile), so that callers that pass the rules instead of a
+    profile don't compile the tokenizers on every call. The result is
+    cached.
+    '''
+    key = (
+        tuple(comment_delimiters or ()),
+        tuple(quote_marks),
+        tuple(triple_quotes or ()),
+        tuple(tuple(pair) for pair in (block_comments or ())),
+        allow_escaping_quotes,
+    )
+    profile = _custom_profiles.get(key)
+    if profile is None:
+        profile = LanguageProfile(
+            None,
+            comment_delimiters=key[0],
+            quote_marks=key[1],
+            triple_quotes=key[2],
+            block_comments=key[3],
+            allow_escaping_quotes=allow_escaping_quotes,
+        )
+        _custom_profiles[key] = profile
+    return profile
+
+
+class CodeView:
+    '''
+    Scan a string once and keep the context (quoted, commented, and
+    enclosure depth) of every character, so that find_in_code and its
+    wrappers can answer many searches on the same string using
+    str.find and a lookup instead of rescanning the string each time.
+    Pass a CodeView anywhere those functions accept a haystack.
+
+    The context always starts at the beginning of the string (unlike a
+    plain string haystack, which is scanned starting at "start"), so
+    forward and reverse searches agree with each other. A triple quote
+    starts a string (rather than ending the search as it does for a
+    plain string haystack). To start in the middle of a quote, block
+    comment, or enclosure (such as for a line of a file), see
+    LineScanner.
+
+    Properties
+    text -- the original string.
+    profile -- the LanguageProfile with the rules for quotes and
+        comments (If not given, one is made from the comment_delimiters,
+        quote_marks, allow_escaping_quotes, triple_quotes, and
+        block_comments arguments, which are otherwise ignored).
+    comment_delimiters, quote_marks, triple_quotes, block_comments,
+    allow_escaping_quotes -- the rules from profile (See
+        LanguageProfile).
+    in_quote -- the closing quote expected if text starts in a quote.
+    in_comment -- the block comment closer expected if text starts in
+        a block comment.
+    openers -- a tuple of enclosure openers that are open where text
+        starts (innermost last).
+    '''
+    def __init__(self, text, comment_delimiters=["#"],
+                 quote_marks=['"', "'"], allow_escaping_quotes=True,
+                 triple_quotes=DEFAULT_TRIPLE_QUOTES, block_comments=None,
+                 in_quote=None, in_comment=None, openers=(), profile=None):
+        if text is None:
+            raise ValueError("text is None.")
+        if profile is None:
+            profile = _custom_profile(
+                comment_delimiters,
+                quote_marks,
+                triple_quotes,
+                block_comments,
+                allow_escaping_quotes,
+            )
+        else:
+            profile = get_profile(profile)
+        self.text = text
+        self.profile = profile
+        self.comment_delimiters = profile.comment_delimiters
+        self.quote_marks = profile.quote_marks
+        self.triple_quotes = profile.triple_quotes
+        self.allow_escaping_quotes = profile.allow_escaping_quotes
+        self.block_comments = profile.block_comments
+        self.in_quote = in_quote
+        self.in_comment = in_comment
+        self.openers = tuple(openers)
+        self._masks = {}
+        self._depths = {}
+        self._end_context = None
+        self._end_openers = {}
+        self._codes = None
+        self._slices = None
+
+    def __len__(self):
+        return len(self.text)
+
+    def __getitem__(self, key):
+        return self.text[key]
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return "CodeView({!r})".format(self.text)
+
+    def strip(self, *args):
+        return self.text.strip(*args)
+
+    def mask(self, allow_commented=False):
+        '''
+        Get a bytearray with the CTX_* flags of each character.
+
+        Keyword arguments:
+        allow_commented -- Ignore comment delimiters (CTX_COMMENTED is
+            never set) as find_unquoted_even_commented does.
+        '''
+        mask = self._masks.get(allow_commented)
+        if mask is None:
+            profile = self.profile
+            comment_delimiters = profile.comment_delimiters
+            block_comments = profile.block_closers
+            in_comment = self.in_comment
+            tokenizer = profile.tokenizer
+            if allow_commented:
+                comment_delimiters = ()
+                block_comments = {}
+                in_comment = None
+                tokenizer = profile.quote_tokenizer
+            slices = None if allow_commented else []
+            if (_use_numpy(len(self.text)) and (self.in_quote is None)
+                    and (in_comment is None) and not block_comments):
+                mask, in_quote, in_comment = _scan_context_numpy(
+                    self.text,
+                    comment_delimiters,
+                    tuple(profile.triple_quotes) + tuple(profile.quote_marks),
+                    self.allow_escaping_quotes,
+                    slices=slices,
+                )
+            else:
+                mask, in_quote, in_comment = _scan_context(
+                    self.text,
+                    tokenizer,
+                    comment_delimiters,
+                    self.allow_escaping_quotes,
+                    in_quote=self.in_quote,
+                    block_comments=block_comments,
+                    in_comment=in_comment,
+                    slices=slices,
+                )
+            self._masks[allow_commented] = mask
+            if not allow_commented:
+                self._end_context = (in_quote, in_comment)
+                self._slices = slices
+        return mask
+
+    def _quote_slices(self):
+        '''
+        Get the slices of the quotes that open in text (See the slices
+        argument of _scan_context).
+        '''
+        self.mask()
+        return self._slices
+
+    def depths(self, enclosures, allow_commented=False):
+        '''
+        Get an array('H') of how deeply each character is enclosed by
+        enclosures (See find_in_code).
+        '''
+        key = (tuple(enclosures), allow_commented)
+        depths = self._depths.get(key)
+        if depths is None:
+            closers = _enclosure_closers(enclosures)
+            opener_stack = [opener for opener in self.openers
+                            if opener in closers]
+            depths = _enclosure_depths(self.text,
+                                       self.mask(allow_commented),
+                                       enclosures,
+                                       opener_stack=opener_stack)
+            self._depths[key] = depths
+            self._end_openers[key] = tuple(opener_stack)
+        return depths
+
+    def end_state(self, enclosures=None):
+        '''
+        Get the context where the text ends, for continuing on the next
+        piece of text (See LineScanner).
+
+        Keyword arguments:
+        enclosures -- Also get which of these enclosures are still
+            open.
+
+        Returns:
+        a tuple of the quote closer expected (or None), the block
+        comment closer expected (or None), and a tuple of openers that
+        are still open (innermost last, always empty if enclosures is
+        None).
+        '''
+        self.mask()
+        in_quote, in_comment = self._end_context
+        openers = ()
+        if enclosures is not None:
+            self.depths(enclosures)
+            openers = self._end_openers[(tuple(enclosures), False)]
+        return in_quote, in_comment, openers
+
+    def find(self, needle, start=0, endbefore=None, step=1,
+             enclosures=None, allow_quoted=True, allow_commented=False):
+        '''
+        Find needle using the stored context. For documentation of the
+        arguments see find_in_code.
+        '''
+        if step not in [-1, 1]:
+            raise ValueError("step must be -1 or 1 not {}.".format(step))
+        if needle is None:
+            raise ValueError("needle is None.")
+        if len(needle) < 1:
+            raise ValueError("len(needle) is 0.")
+        text = self.text
+        if endbefore is None:
+            endbefore = len(text)
+        elif endbefore < 0:
+            endbefore = len(text) + endbefore
+        elif endbefore > len(text):
+            endbefore = len(text)
+        if len(text) == 0:
+            return -1
+        elif endbefore < start:
+            raise ValueError("endbefore is < start (start={}, endbefore={},"
+                             " step={})".format(start, endbefore, step))
+        mask = self.mask(allow_commented)
+        depths = None
+        if enclosures is not None:
+            depths = self.depths(enclosures, allow_commented)
+        if _use_numpy(endbefore - start):
+            return self._find_numpy(needle, start, endbefore, step, mask,
+                                    depths, allow_quoted)
+        if step > 0:
+            index = text.find(needle, start, endbefore)
+        else:
+            index = text.rfind(needle, start, endbefore)
+        while index > -1:
+            if self._allows(index, mask, depths, allow_quoted):
+                return index
+            if step > 0:
+                index = text.find(needle, index+1, endbefore)
+            else:
+                index = text.rfind(needle, start,
+                                   index+len(needle)-1)
+        return -1
+
+    def find_first(self, needles, start=0, endbefore=None, step=1,
+                   enclosures=None, allow_quoted=True,
+                   allow_commented=False):
+        '''
+        Find whichever of needles occurs first using the stored context.
+        For documentation see find_first_in_code.
+        '''
+        if step not in [-1, 1]:
+            raise ValueError("step must be -1 or 1 not {}.".format(step))
+        pattern = _needles_pattern(needles)
+        text = self.text
+        if endbefore is None:
+            endbefore = len(text)
+        elif endbefore < 0:
+            endbefore = len(text) + endbefore
+        elif endbefore > len(text):
+            endbefore = len(text)
+        if len(text) == 0:
+            return -1, -1
+        elif endbefore < start:
+            raise ValueError("endbefore is < start (start={}, endbefore={},"
+                             " step={})".format(start, endbefore, step))
+        mask = self.mask(allow_commented)
+        depths = None
+        if enclosures is not None:
+            depths = self.depths(enclosures, allow_commented)
+        result = -1, -1
+        pos = start
+        while True:
+            match = pattern.search(text, pos, endbefore)
+            if match is None:
+                break
+            index = match.start()
+            if self._allows(index, mask, depths, allow_quoted):
+                result = index, match.lastindex - 1
+                if step > 0:
+                    break
+            pos = index + 1
+        return result
+
+    def _find_numpy(self, needle, start, endbefore, step, mask, depths,
+                    allow_quoted):
+        '''
+        Find needle as find does, but check every position at once (See
+        set_numpy_min_length).
+        '''
+        last = endbefore - len(needle)  # the last place needle fits
+        if last < start:
+            return -1
+        if getattr(self, "_codes", None) is None:
+            self._codes = _code_points(self.text)
+        hits = _token_hits(self._codes[start:endbefore], needle)
+        hits = hits[:last+1-start]
+        flags = numpy.frombuffer(mask, dtype=numpy.uint8)[start:last+1]
+        allowed = flags == 0
+        if depths is not None:
+            allowed &= numpy.frombuffer(
+                depths, dtype=numpy.uint16)[start:last+1] == 0
+        if allow_quoted:
+            allowed |= flags == CTX_QUOTED
+            # ^ not CTX_QUOTE_MARK (See _allows)
+        indices = numpy.flatnonzero(hits & allowed)
+        if len(indices) == 0:
+            return -1
+        if step > 0:
+            return int(indices[0]) + start
+        return int(indices[-1]) + start
+
+    def _allows(self, index, mask, depths, allow_quoted):
+        flags = mask[index]
+        if flags & CTX_QUOTE_MARK:
+            return False
+        elif flags & CTX_QUOTED:
+            return allow_quoted
+        elif flags == 0:
+            return (depths is None) or (depths[index] == 0)
+        return False  # commented
+
+
+def _needles_pattern(needles):
+    '''
+    Get a regex with one group per needle, in order, so that
+    match.lastindex - 1 is the index of the needle that matched (If
+    more than one needle starts at the same index, the first one in
+    needles wins).
+    '''
+    if isinstance(needles, str):
+        raise ValueError("needles should be a list-like object.")
+    if len(needles) < 1:
+        raise ValueError("len(needles) is 0.")
+    for needle in needles:
+        if needle is None:
+            raise ValueError("A needle is None.")
+        if len(needle) < 1:
+            raise ValueError("A needle is blank.")
+    return re.compile(
+        "|".join("({})".format(re.escape(needle)) for needle in needles)
+    )
+
+
+class LineScanner:
+    '''
+    Lex a file one line at a time, carrying the quote, triple quote,
+    block comment, and enclosure state from each line into the next, so
+    that a whole file is scanned once (in order) instead of each line
+    being rescanned for each search.
+
+    Each line given to feed (or scan) becomes a CodeView that already
+    knows its context, so it can be passed as the haystack to
+    find_in_code and its wrappers. Unlike a plain CodeView, a triple
+    quoted string or block comment continues onto the following lines.
+    A quote that is not a triple quote ends at the end of the line
+    unless the newline is escaped with a backslash.
+
+    Properties
+    line_count -- the number of lines fed so far.
+    in_quote -- the quote closer expected at the start of the next
+        line (or None).
+    in_comment -- the block comment closer expected at the start of
+        the next line (or None).
+    openers -- a tuple of the openers of enclosures that are still
+        open (innermost last).
+    unclosed_quote_lines -- a list of indices (0-based) of lines where
+        a quote that can't continue onto the next line wasn't closed.
+    '''
+    def __init__(self, comment_delimiters=["#"], quote_marks=['"', "'"],
+                 allow_escaping_quotes=True,
+                 triple_quotes=DEFAULT_TRIPLE_QUOTES, block_comments=None,
+                 enclosures=None, profile=None):
+        '''
+        For documentation of the arguments see CodeView.
+
+        Keyword arguments:
+        enclosures -- A list of enclosures (See find_in_code) to track
+            across lines, such as ["()", "[]", "{}"]. Their depths are
+            also precomputed for each line.
+        '''
+        if profile is None:
+            profile = _custom_profile(
+                comment_delimiters,
+                quote_marks,
+                triple_quotes,
+                block_comments,
+                allow_escaping_quotes,
+            )
+        else:
+            profile = get_profile(profile)
+        if enclosures is not None:
+            _enclosure_closers(enclosures)  # validate
+        self.profile = profile
+        self.triple_quotes = profile.triple_quotes
+        self.allow_escaping_quotes = profile.allow_escaping_quotes
+        self.enclosures = enclosures
+        self._token_chars = None
+        self.reset()
+
+    def reset(self):
+        '''
+        Forget the state so that the next line is the start of a file.
+        '''
+        self.line_count = 0
+        self.in_quote = None
+        self.in_comment = None
+        self.openers = ()
+        self.unclosed_quote_lines = []
+
+    def get_state(self):
+        '''
+        Get the state as a tuple of (in_quote, in_comment, openers) so
+        that scanning can be resumed later (See set_state).
+        '''
+        return self.in_quote, self.in_comment, self.openers
+
+    def set_state(self, state):
+        '''
+        Resume from a state from get_state (or CodeView's end_state).
+        '''
+        self.in_quote, self.in_comment, openers = state
+        self.openers = tuple(openers)
+
+    def feed(self, line, more=False):
+        '''
+        Lex the next line.
+
+        Sequential arguments:
+        line -- The line, with or without its newline.
+
+        Keyword arguments:
+        more -- line is only part of a line and the rest of it will be
+            fed next (so a comment or quote continues and the line is
+            not counted yet). Only split a line where no quote mark,
+            comment delimiter, or escape spans the split (See
+            split_index).
+
+        Returns:
+        a CodeView of line with its context already scanned.
+        '''
+        code = CodeView(
+            line,
+            profile=self.profile,
+            in_quote=self.in_quote,
+            in_comment=self.in_comment,
+            openers=self.openers,
+        )
+        in_quote, in_comment, openers = code.end_state(self.enclosures)
+        if more:
+            if ((in_comment is None) and line
+                    and (code.mask()[-1] & CTX_COMMENTED)
+                    and not (code.mask()[-1] & CTX_BLOCK_COMMENT)):
+                # Continue the comment as a block comment closed by the
+                #   newline so that the rest of the line is commented.
+                in_comment = "\n"
+        else:
+            if in_comment == "\n":
+                in_comment = None
+            if ((in_quote is not None)
+                    and (in_quote not in self.triple_quotes)):
+                content = line.rstrip("\r\n")
+                if not (self.allow_escaping_quotes
+                        and content.endswith("\\")):
+                    self.unclosed_quote_lines.append(self.line_count)
+                    in_quote = None
+            self.line_count += 1
+        self.in_quote = in_quote
+        self.in_comment = in_comment
+        if self.enclosures is not None:
+            self.openers = openers
+        return code
+
+    def split_index(self, text, end=None):
+        '''
+        Get the last index (up to end) where text can be split so that
+        the parts can be fed separately (See the more argument of feed),
+        or 0 if there is none.
+        '''
+        if end is None:
+            end = len(text)
+        token_chars = self._token_chars
+        if token_chars is None:
+            profile = self.profile
+            tokens = (profile.comment_delimiters + profile.quote_marks
+                      + profile.triple_quotes)
+            for pair in profile.block_comments:
+                tokens += pair
+            token_chars = frozenset("".join(tokens) + "\\")
+            self._token_chars = token_chars
+        index = end
+        while (index > 0) and (text[index-1] in token_chars):
+            index -= 1
+        return index
+
+    def scan(self, lines):
+        '''
+        Lex each line in order (lines can be any iterable, such as an
+        open file), yielding a CodeView for each (See feed).
+        '''
+        for line in lines:
+            yield self.feed(line)
+
+
+class LogicalLine(object):
+    '''
+    A statement that may continue onto more than one physical line (See
+    iter_logical_lines).
+
+    Properties
+    text -- the physical lines (without their newlines) joined by "\\n".
+    line_index -- the index (0-based) of the first physical line.
+    starts -- an array('L') of where each physical line starts in text.
+    '''
+    __slots__ = ("text", "line_index", "starts", "_views", "_code")
+
+    def __init__(self, text, line_index, starts, views):
+        self.text = text
+        self.line_index = line_index
+        self.starts = starts
+        self._views = views
+        self._code = None
+
+    def __len__(self):
+        return len(self.text)
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return "LogicalLine({!r}, {})".format(self.text, self.line_index)
+
+    @property
+    def line_count(self):
+        return len(self.starts)
+
+    @property
+    def code(self):
+        '''
+        Get a CodeView of text with the context found when each line was
+        scanned (so a comment ends at the end of its physical line). It
+        can be used as the haystack for find_in_code and its wrappers,
+        or given to AbstractFn.
+        '''
+        if self._code is None:
+            self._code = _join_code_views(self._views)
+            self._views = None
+        return self._code
+
+    def to_physical(self, index):
+        '''
+        Get the (line_index, col) in the physical lines of an index in
+        text (O(log n) using starts).
+        '''
+        if (index < 0) or (index > len(self.text)):
+            raise ValueError("index {} is not in the logical line (length"
+                             " {})".format(index, len(self.text)))
+        part_i = bisect_right(self.starts, index) - 1
+        return self.line_index + part_i, index - self.starts[part_i]
+
+
+def _join_code_views(views):
+    '''
+    Get one CodeView of the text of views (from one LineScanner, in
+    order) joined by newlines, using the masks of the views.
+    '''
+    first = views[0]
+    code = CodeView(
+        "\n".join(view.text for view in views),
+        profile=first.profile,
+        in_quote=first.in_quote,
+        in_comment=first.in_comment,
+        openers=first.openers,
+    )
+    for allow_commented in (False, True):
+        mask = bytearray(first.mask(allow_commented))
+        for view in views[1:]:
+            if view.in_quote is not None:
+                mask.append(CTX_QUOTED)
+            elif (view.in_comment is not None) and not allow_commented:
+                mask.append(CTX_COMMENTED | CTX_BLOCK_COMMENT)
+            else:
+                mask.append(0)
+            mask += view.mask(allow_commented)
+        code._masks[allow_commented] = mask
+    slices = []
+    offset = 0
+    for view in views:
+        if slices and (slices[-1][1] is None) and (view.in_quote is not None):
+            # The quote opened on a previous line, so close it where the
+            # quoted characters at the start of this line end.
+            view_mask = view.mask()
+            for index in range(len(view_mask)):
+                if not (view_mask[index] & CTX_QUOTED):
+                    slices[-1] = (slices[-1][0], offset+index)
+                    break
+        for open_i, end in view._quote_slices():
+            slices.append((open_i+offset,
+                           None if end is None else end+offset))
+        offset += len(view.text) + 1
+    code._slices = slices
+    in_quote, in_comment, _ = views[-1].end_state()
+    code._end_context = (in_quote, in_comment)
+    return code
+
+
+def iter_logical_lines(lines, profile=None,
+                       enclosures=["()", "[]", "{}"]):
+    '''
+    Join physical lines into logical lines (statements) in one pass. A
+    line continues onto the next if an enclosure is still open, if it
+    ends with a backslash (that isn't quoted or commented), or if it
+    ends inside a triple quoted string or block comment.
+
+    Sequential arguments:
+    lines -- Any iterable of strings, such as an open file (newlines are
+        removed).
+
+    Keyword arguments:
+    profile -- A LanguageProfile or the name of one (See get_profile),
+        or None for the LineScanner defaults (Python-like).
+    enclosures -- The enclosures (See find_in_code) that continue a
+        line until they are closed.
+
+    Returns:
+    a generator of LogicalLine objects (the last one may be unfinished
+    if the file ends first).
+    '''
+    scanner = LineScanner(profile=profile, enclosures=enclosures)
+    parts = []
+    views = []
+    starts = array('L')
+    first_index = 0
+    offset = 0
+    for line_index, line in enumerate(lines):
+        line = line.rstrip("\r\n")
+        view = scanner.feed(line)
+        if not parts:
+            first_index = line_index
+        parts.append(line)
+        views.append(view)
+        starts.append(offset)
+        offset += len(line) + 1
+        if (scanner.openers or (scanner.in_quote is not None)
+                or (scanner.in_comment is not None)):
+            continue
+        if line.endswith("\\") and not view.mask()[-1]:
+            continue
+        yield LogicalLine("\n".join(parts), first_index, starts, views)
+        parts = []
+        views = []
+        starts = array('L')
+        offset = 0
+    if parts:
+        yield LogicalLine("\n".join(parts), first_index, starts, views)
+
+
+def search_file_in_code(path, needle, profile=None, enclosures=None,
+                        allow_quoted=False, allow_commented=False,
+                        encoding=DEFAULT_CO, chunk_size=1048576,
+                        processes=None, include_line=False):
+    '''
+    Find every place needle is in the code (by default, as in
+    find_unquoted_not_commented) in a file without reading the whole
+    file into memory. The file is memory-mapped and decoded one chunk
+    of whole lines at a time, and a LineScanner carries the state (such
+    as a triple quoted string or block comment) from each line (and
+    therefore chunk) into the next.
+
+    Sequential arguments:
+    path -- The file to search, or a list of files to search in
+        separate processes (See processes).
+    needle -- The string to find.
+
+    Keyword arguments:
+    profile -- A LanguageProfile or the name of one (See get_profile),
+        or None for the LineScanner defaults (Python-like).
+    enclosures, allow_quoted, allow_commented -- See find_in_code.
+    encoding -- The encoding of the file(s). It must be compatible with
+        ASCII newlines (such as UTF-8). Bytes that can't be decoded are
+        replaced, so the search still finishes.
+    chunk_size -- About how many bytes to decode at once. A chunk ends
+        at the end of a line, except that a line longer than chunk_size
+        is decoded and lexed in parts of about chunk_size (A part only
+        grows past that if there is no place to split it, such as in a
+        long run of quote marks). If include_line, the whole line of
+        each match is decoded though.
+    processes -- How many processes to use for a list of paths (None
+        for the number of CPUs).
+    include_line -- Also get the line (without the newline) of each
+        match.
+
+    Returns:
+    a generator of (line_n, col) tuples for each match where line_n
+    starts at 1 and col starts at 0, or (path, line_n, col) if path is
+    a list (ordered by path). If include_line, each tuple also ends
+    with the line.
+    '''
+    if needle is None:
+        raise ValueError("needle is None.")
+    if len(needle) < 1:
+        raise ValueError("len(needle) is 0.")
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1 not {}"
+                         "".format(chunk_size))
+    if profile is not None:
+        profile = get_profile(profile)
+    options = (needle, profile, enclosures, allow_quoted, allow_commented,
+               encoding, chunk_size, include_line)
+    if isinstance(path, (list, tuple)):
+        return _search_files_in_code(path, options, processes)
+    return _search_file_in_code(path, *options)
+
+
+def _search_files_in_code(paths, options, processes):
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = executor.map(_search_file_in_code_list,
+                               [(path,) + options for path in paths])
+        for path, hits in zip(paths, results):
+            for hit in hits:
+                yield (path,) + hit
+
+
+def _search_file_in_code_list(args):
+    return list(_search_file_in_code(*args))
+
+
+def _search_file_in_code(path, needle, profile, enclosures, allow_quoted,
+                         allow_commented, encoding, chunk_size, include_line):
+    scanner = LineScanner(profile=profile, enclosures=enclosures)
+    line_n = 0
+    with open(path, 'rb') as stream:
+        if os.fstat(stream.fileno()).st_size == 0:
+            return  # mmap can't map an empty file.
+        data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            size = len(data)
+            pos = 0
+            while pos < size:
+                end = pos + chunk_size
+                if end < size:
+                    newline_i = data.rfind(b"\n", pos, end)
+                    if newline_i < 0:
+                        # The line is longer than chunk_size.
+                        newline_i = data.find(b"\n", end)
+                        end = size if newline_i < 0 else newline_i
+                        line_n += 1
+                        for hit in _search_long_line(
+                                scanner, data, pos, end, line_n, needle,
+                                enclosures, allow_quoted, allow_commented,
+                                encoding, chunk_size, include_line):
+                            yield hit
+                        pos = end + 1
+                        continue
+                    end = newline_i + 1
+                else:
+                    end = size
+                chunk = data[pos:end].decode(encoding, "replace")
+                pos = end
+                lines = chunk.split("\n")
+                if chunk.endswith("\n"):
+                    lines.pop()  # not a line (the chunk ends in a newline)
+                for line in lines:
+                    line_n += 1
+                    code = scanner.feed(line)
+                    col = code.find(needle, enclosures=enclosures,
+                                    allow_quoted=allow_quoted,
+                                    allow_commented=allow_commented)
+                    while col > -1:
+                        if include_line:
+                            yield line_n, col, line.rstrip("\r")
+                        else:
+                            yield line_n, col
+                        col = code.find(needle, start=col+1,
+                                        enclosures=enclosures,
+                                        allow_quoted=allow_quoted,
+                                        allow_commented=allow_commented)
+        finally:
+            data.close()
+
+
+def _search_long_line(scanner, data, start, end, line_n, needle,
+                      enclosures, allow_quoted, allow_commented, encoding,
+                      chunk_size, include_line):
+    '''
+    Search a line (data[start:end] without its newline) that is longer
+    than chunk_size by decoding and lexing about chunk_size bytes at a
+    time (See the more argument of LineScanner.feed) instead of the
+    whole line. The needle can span the parts since the last
+    len(needle)-1 characters of each part are kept for the next.
+    '''
+    decoder = codecs.getincrementaldecoder(encoding)("replace")
+    profile = scanner.profile
+    keep = len(needle) - 1
+    quote_state = None
+    if allow_commented:
+        # The search ignores comments, so track quotes the same way.
+        quote_state = (scanner.in_quote, scanner.openers)
+    pending = ""
+    offset = 0  # where pending starts in the line
+    line = None
+    for piece_start in range(start, end, chunk_size):
+        piece_end = min(piece_start + chunk_size, end)
+        final = piece_end >= end
+        pending += decoder.decode(data[piece_start:piece_end], final)
+        if final:
+            cut = len(pending)
+        else:
+            cut = scanner.split_index(pending, len(pending) - keep)
+            if cut < 1:
+                continue  # There is no place to split yet.
+        part = pending[:cut]
+        code = scanner.feed(part, more=not final)
+        if allow_commented:
+            in_quote, openers = quote_state
+            code = CodeView(part, profile=profile, in_quote=in_quote,
+                            openers=openers)
+            _, in_quote, _ = _scan_context(
+                part,
+                profile.quote_tokenizer,
+                (),
+                profile.allow_escaping_quotes,
+                in_quote=in_quote,
+            )
+            if enclosures is not None:
+                code.depths(enclosures, True)
+                openers = code._end_openers[(tuple(enclosures), True)]
+            quote_state = (in_quote, openers)
+        cols = []
+        col = code.find(needle, enclosures=enclosures,
+                        allow_quoted=allow_quoted,
+                        allow_commented=allow_commented)
+        while col > -1:
+            cols.append(col)
+            col = code.find(needle, start=col+1, enclosures=enclosures,
+                            allow_quoted=allow_quoted,
+                            allow_commented=allow_commented)
+        if keep and not final:
+            # Check where needle starts in part but ends in the next part.
+            mask = code.mask(allow_commented)
+            depths = None
+            if enclosures is not None:
+                depths = code.depths(enclosures, allow_commented)
+            for col in range(max(cut-keep, 0), cut):
+                if (pending.startswith(needle, col)
+                        and code._allows(col, mask, depths, allow_quoted)):
+                    cols.append(col)
+        for col in cols:
+            if include_line:
+                if line is None:
+                    line = data[start:end].decode(encoding, "replace")
+                    line = line.rstrip("\r")
+                yield line_n, offset + col, line
+            else:
+                yield line_n, offset + col
+        pending = pending[cut:]
+        offset += cut
+
+
+_chunk_profile = LanguageProfile(
+    None,
+    comment_delimiters=(),
+    quote_marks=('"', "'"),
+)
+# ^ Like get_operation_chunk_len, don't treat anything as a comment.
+
+
+class BracketIndex:
+    '''
+    Match every unquoted bracket in a line (or a whole file) in one
+    pass, so that the matching bracket and the length of an operation
+    chunk (See get_operation_chunk_len) can be looked up in O(1)
+    instead of rescanning from each start.
+
+    A closer only matches the innermost open opener (other closers are
+    ignored), as in get_operation_chunk_len. That is also why the
+    opener of each closer is found by a separate pass in reverse: For
+    malformed text, such as "([)", they can differ.
+
+    Properties
+    text -- the string that was indexed.
+    enclosures -- the enclosures (See find_in_code) that were matched.
+    '''
+    def __init__(self, text, enclosures=["()", "[]", "{}"], profile=None):
+        '''
+        Sequential arguments:
+        text -- The string to index, or a CodeView of it (in that case
+            its context is used).
+
+        Keyword arguments:
+        profile -- A LanguageProfile or the name of one for the quote
+            and comment rules. The default has no comments (only quotes
+            as in get_operation_chunk_len).
+        '''
+        code = None
+        if isinstance(text, CodeView):
+            code = text
+            text = code.text
+        elif profile is None:
+            profile = _chunk_profile
+        else:
+            profile = get_profile(profile)
+        closers = _enclosure_closers(enclosures)
+        openers = dict((closer, opener) for opener, closer in closers.items())
+        self.text = text
+        self.enclosures = enclosures
+        self._closers = closers
+        self._openers = openers
+        length = len(text)
+        if code is not None:
+            # Use the context it already has (such as for a LogicalLine).
+            mask = code.mask()
+            slices = code._quote_slices()
+        else:
+            slices = []
+            mask, _, _ = _scan_context(
+                text,
+                profile.tokenizer,
+                profile.comment_delimiters,
+                profile.allow_escaping_quotes,
+                block_comments=profile.block_closers,
+                slices=slices,
+            )
+        self._mask = mask
+        partners = array('l', [-1]) * length
+        for open_i, end in slices:
+            if end is None:
+                partners[open_i] = length
+            else:
+                partners[open_i] = end
+                partners[end-1] = open_i
+        # ^ For a quote mark: 1 past the closing quote (or the opening
+        #   quote's index for a closing quote).
+        self._quote_partners = partners
+        positions = []
+        chars = "".join(sorted(set(closers) | set(openers)))
+        for match in re.finditer("[{}]".format(re.escape(chars)), text):
+            if not mask[match.start()]:
+                positions.append(match.start())
+        closer_of = array('l', [-1]) * length
+        stack = []
+        for index in positions:
+            this_char = text[index]
+            if this_char in closers:
+                stack.append(index)
+            elif stack and (this_char == closers[text[stack[-1]]]):
+                closer_of[stack.pop()] = index
+        opener_of = array('l', [-1]) * length
+        stack = []
+        for index in reversed(positions):
+            this_char = text[index]
+            if this_char in openers:
+                stack.append(index)
+            elif stack and (this_char == openers[text[stack[-1]]]):
+                opener_of[stack.pop()] = index
+        self._closer_of = closer_of
+        self._opener_of = opener_of
+        self._chunk_ends = None
+        self._chunk_stops = None
+
+    def __len__(self):
+        return len(self.text)
+
+    def closer_of(self, index):
+        '''
+        Get the index of the closer that matches the opener at index, or
+        -1 if it is not closed (or index is not an unquoted opener).
+        '''
+        return self._closer_of[index]
+
+    def opener_of(self, index):
+        '''
+        Get the index of the opener that matches the closer at index, or
+        -1 if it was not opened (or index is not an unquoted closer).
+        '''
+        return self._opener_of[index]
+
+    def _build_chunk_ends(self):
+        text = self.text
+        length = len(text)
+        mask = self._mask
+        partners = self._quote_partners
+        closer_of = self._closer_of
+        closers = self._closers
+        id_chars = identifier_and_dot_chars
+        ends = array('l', [0]) * length
+        for index in range(length-1, -1, -1):
+            flags = mask[index]
+            if (flags & CTX_QUOTE_MARK) and (partners[index] > index):
+                after = partners[index]
+            elif (not flags) and (text[index] in closers):
+                after = closer_of[index] + 1
+                if after == 0:
+                    after = length  # never closed
+            else:
+                after = index + 1
+            if (after >= length) or (text[after] not in id_chars):
+                ends[index] = after
+            else:
+                ends[index] = ends[after]
+        self._chunk_ends = ends
+
+    def _build_chunk_stops(self):
+        text = self.text
+        length = len(text)
+        mask = self._mask
+        partners = self._quote_partners
+        opener_of = self._opener_of
+        openers = self._openers
+        id_chars = identifier_and_dot_chars
+        stops = array('l', [0]) * length
+        for index in range(length):
+            flags = mask[index]
+            if ((flags & CTX_QUOTE_MARK) and (partners[index] > -1)
+                    and (partners[index] < index)):
+                before = partners[index] - 1
+            elif (not flags) and (text[index] in openers):
+                before = opener_of[index] - 1
+                if before == -2:
+                    before = -1  # never opened
+            else:
+                before = index - 1
+            if (before < 0) or (text[before] not in id_chars):
+                stops[index] = before
+            else:
+                stops[index] = stops[before]
+        self._chunk_stops = stops
+
+    def chunk_len(self, start, step=1):
+        '''
+        Get the same result as get_operation_chunk_len(text, start,
+        step), but in O(1) after the first call for each direction.
+        The character at start must not be inside of a quote (but can
+        be a quote mark).
+        '''
+        if step > 0:
+            if self._chunk_ends is None:
+                self._build_chunk_ends()
+            return self._chunk_ends[start] - start
+        elif step < 0:
+            if self._chunk_stops is None:
+                self._build_chunk_stops()
+            return start - self._chunk_stops[start]
+        raise ValueError("step must be -1 or 1 not {}.".format(step))
+
+
+_any_identifier = re.compile("(?<![{0}])[{1}_][{0}]*".format(
+    re.escape(identifier_chars),
+    re.escape(alpha_chars),
+))
+
+
+class IdentifierIndex:
+    '''
+    Tokenize a file once and map each identifier (outside of strings
+    and comments) to where it occurs, so that finding every use of an
+    identifier is a dict lookup instead of a scan of every line.
+
+    Positions are (line_index, column) tuples, both starting at 0.
+
+    Properties
+    line_count -- the number of lines added so far.
+    lines -- the lines that were added (for checking dotted names).
+    '''
+    def __init__(self, lines=None, profile=None, scanner=None):
+        '''
+        Keyword arguments:
+        lines -- Lines to add (See add_lines).
+        profile -- A LanguageProfile or the name of one for the quote
+            and comment rules (the default is Python's). It is ignored
+            if scanner is set.
+        scanner -- A LineScanner to lex the lines (so its state
+            carries on from lines already scanned).
+        '''
+        if scanner is None:
+            if profile is None:
+                profile = "python"
+            scanner = LineScanner(profile=profile)
+        self._scanner = scanner
+        self._positions = {}
+        self._sorted_names = None
+        self.lines = []
+        self.line_count = 0
+        if lines is not None:
+            self.add_lines(lines)
+
+    def add_line(self, line):
+        '''
+        Add the next line of the file.
+        '''
+        mask = self._scanner.feed(line).mask()
+        line_index = self.line_count
+        positions = self._positions
+        for match in _any_identifier.finditer(line):
+            column = match.start()
+            if mask[column]:
+                continue
+            name = match.group()
+            occurrences = positions.get(name)
+            if occurrences is None:
+                occurrences = array('L')
+                positions[name] = occurrences
+                self._sorted_names = None
+            occurrences.append(line_index)
+            occurrences.append(column)
+        self.lines.append(line)
+        self.line_count += 1
+
+    def add_lines(self, lines):
+        '''
+        Add each line in lines (any iterable, such as an open file).
+        '''
+        for line in lines:
+            self.add_line(line)
+
+    def __contains__(self, name):
+        return name in self._positions
+
+    def __len__(self):
+        return len(self._positions)
+
+    def count(self, name):
+        '''
+        Get how many times the identifier occurs.
+        '''
+        occurrences = self._positions.get(name)
+        if occurrences is None:
+            return 0
+        return len(occurrences) // 2
+
+    def positions(self, name):
+        '''
+        Get a list of (line_index, column) tuples where name occurs (in
+        order). If name has dots (such as "Console.WriteLine") it is
+        checked as a dotted name (See positions_dotted).
+        '''
+        if "." in name:
+            return self.positions_dotted(name)
+        occurrences = self._positions.get(name)
+        if occurrences is None:
+            return []
+        return list(zip(occurrences[0::2], occurrences[1::2]))
+
+    def positions_dotted(self, dotted_name):
+        '''
+        Get a list of (line_index, column) tuples where dotted_name (such
+        as "Console.WriteLine") occurs and is not part of a longer name
+        (such as "Console.WriteLines" or "System.Console.WriteLine").
+        '''
+        parts = dotted_name.split(".")
+        occurrences = self._positions.get(parts[0])
+        if occurrences is None:
+            return []
+        for part in parts[1:]:
+            if part not in self._positions:
+                return []
+        results = []
+        pattern = _identifier_pattern(dotted_name)
+        lines = self.lines
+        for i in range(0, len(occurrences), 2):
+            line_index = occurrences[i]
+            column = occurrences[i+1]
+            line = lines[line_index]
+            if (column > 0) and (line[column-1] == "."):
+                continue
+            if pattern.match(line, column):
+                results.append((line_index, column))
+        return results
+
+    def names(self):
+        '''
+        Get a sorted list of all of the identifiers.
+        '''
+        if self._sorted_names is None:
+            self._sorted_names = sorted(self._positions)
+        return self._sorted_names
+
+    def names_with_prefix(self, prefix):
+        '''
+        Get a sorted list of the identifiers that start with prefix.
+        '''
+        names = self.names()
+        results = []
+        for i in range(bisect_left(names, prefix), len(names)):
+            if not names[i].startswith(prefix):
+                break
+            results.append(names[i])
+        return results
+
+
+class SearchCache(object):
     '''
-    for range_i in range(len(ranges)):
-        r = ranges[range_i]
-        start = r[0]
-        stop = r[1]
-        if start < 0:
-            if length is not None:
-                start = length + start
-            else:
-                raise ValueError("negative slice notation isn't"
-                                 " implemented but a start index is"
-                                 " negative in {}".format(ranges))
-        if stop < 0:
-            if length is not None:
-                stop = length + stop
-            else:
-                raise ValueError("negative slice notation isn't"
-                                 " implemented but a stop index is"
-                                 " negative in {}".format(ranges))
-        if (v >= r[0]) and (v < r[1]):
-            return range_i
-    return -1
+    A bounded least-recently-used cache of search results (See
+    enable_search_cache). It is safe to share between threads.
 
+    Properties
+    maxsize -- the most results to keep before evicting the least
+        recently used one.
+    hits -- how many lookups found a result.
+    misses -- how many lookups did not find a result.
+    evictions -- how many results were discarded to stay within maxsize.
+    '''
+    def __init__(self, maxsize=4096):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1 not {}"
+                             "".format(maxsize))
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        '''
+        Get the result for key (and mark it as recently used), or
+        default if there is none.
+        '''
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
 
-def in_any_slice(i, ranges):
-    return which_slice(i, ranges) > -1
+    def clear(self):
+        '''
+        Remove all results and reset the statistics.
+        '''
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
 
+    def info(self):
+        '''
+        Get a dict of statistics: hits, misses, evictions, size, and
+        maxsize.
+        '''
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+            }
 
-END_BEFORE_QUOTE_ERR = "string ended before quote ended"
 
+_search_cache = None
 
-def quoted_slices(haystack, start=0, endbefore=None,
-                  comment_delimiters=["#"]):
-    '''
-    Get a list of tuples where each tuple is the start and stop values
-    for quoted portions of haystack. The first entry of the tuple is
-    the first quotation mark (`"` or `'`) and the second entry of
-    the tuple is 1 after the ending quote's index (as per slice
-    notation). See explode_unquoted for a function that does something
-    similar but also uses field delimiters (with get_str_i_tuple option
-    to get slice start index).
-    - For a hard slice search excluding comments use find_slice instead.
+
+def enable_search_cache(maxsize=4096):
+    '''
+    Cache the results of find_in_code (and therefore of its wrappers
+    such as find_unquoted_not_commented) by haystack and options. Only
+    plain string haystacks are cached (A CodeView already avoids
+    rescanning).
 
     Keyword arguments:
-    comment_delimiters -- Use this to specify one or more comment
-        delimiters. Examples: ['#'] for Python or ['#', '//'] for PHP
+    maxsize -- The most results to keep (See SearchCache).
+
+    Returns:
+    the SearchCache (a new one unless enabled already with the same
+    maxsize).
     '''
-    if comment_delimiters is None:
-        echo0("WARNING: quoted_slices got no comment delimiters.")
-        comment_delimiters = []
-    global quoted_slices_error
-    quoted_slices_error = None
-    results = []
-    open_i = None
-    i = start
-    quotes = "\"'"
-    if haystack is None:
-        raise ValueError("haystack is None")
-    if endbefore is None:
-        endbefore = len(haystack)
-    elif endbefore < 0:
-        new_endbefore = len(haystack) + endbefore
-        # ^ + since already negative
-        echo2("INFO: endbefore was negative so it will"
-              " change to len(haystack)+offset (endbefore={},"
-              " new_endbefore={})."
-              "".format(endbefore, new_endbefore))
-        endbefore = new_endbefore
-    if endbefore < start:
-        raise ValueError("endbefore is < start which should never be"
-                         " the case (endbefore={})"
-                         "".format(endbefore))
-    i -= 1
-    open_i = None
-    prev_c = None
-    comment_started = False
-    echo4("comment_delimiters={}".format(comment_delimiters))
-    while i+1 < endbefore:
-        i += 1
-        c = haystack[i]
-        echo4("( i={}, open_i={}, c={} )".format(i, open_i, c))
-        if open_i is None:
-            if c in quotes:
-                open_i = i
-            else:
-                for c_delim in comment_delimiters:
-                    if (haystack[i:i+len(c_delim)] == c_delim):
-                        comment_started = True
-                        break
-                if comment_started:
-                    break
-        elif (c == haystack[open_i]) and (prev_c != "\\"):
-            results.append((open_i, i+1))
-            # ^ first quote & 1 after end quote as per slice notation
-            #   (including both quotes)
-            open_i = None
-        prev_c = c
-    if open_i is not None:
-        quoted_slices_error = END_BEFORE_QUOTE_ERR
-        echo0("WARNING: The quote ([{}]) wasn't closed in"
-              " (i={}, endbefore={}):"
-              "".format(open_i+1, i, endbefore))
-        echo0("`{}`".format(haystack))
-        end_mark_i = endbefore - (open_i+1)
-        end_mark = ""
-        if end_mark_i >= 0:
-            # end_mark = "^end"
-            pass
-        echo0(" "*(open_i+1) + "^" + " "*end_mark_i + end_mark)
-        # raise SyntaxError("END_BEFORE_QUOTE_ERR")
+    global _search_cache
+    if (_search_cache is None) or (_search_cache.maxsize != maxsize):
+        _search_cache = SearchCache(maxsize=maxsize)
+    return _search_cache
 
-    return results
+
+def disable_search_cache():
+    '''
+    Stop caching searches (and discard the results).
+    '''
+    global _search_cache
+    _search_cache = None
+
+
+def get_search_cache():
+    '''
+    Get the SearchCache, or None if caching is disabled.
+    '''
+    return _search_cache
+
+
+_pattern_cache = SearchCache(maxsize=256)
+
+
+def compile_pattern(pattern, flags=0):
+    '''
+    Get a compiled regex from a bounded cache shared by the module (and
+    by other modules such as io_bashtopython) so the same pattern is
+    only compiled once.
+    '''
+    key = (pattern, flags)
+    compiled = _pattern_cache.get(key)
+    if compiled is None:
+        compiled = re.compile(pattern, flags)
+        _pattern_cache.put(key, compiled)
+    return compiled
+
+
+class cached_searches(object):
+    '''
+    Cache searches only while in a with statement, then restore the
+    previous cache (or lack of one):
+
+    with cached_searches() as cache:
+        parser.framework_to_standard_python(outfile_path)
+    echo0(cache.info())
+    '''
+    def __init__(self, maxsize=4096):
+        self.cache = SearchCache(maxsize=maxsize)
+        self._old = None
+
+    def __enter__(self):
+        global _search_cache
+        self._old = _search_cache
+        _search_cache = self.cache
+        return self.cache
+
+    def __exit__(self, exc_type, exc_value, tb):
+        global _search_cache
+        _search_cache = self._old
+        return False
+
+
+def _freeze(value):
+    '''
+    Get a hashable version of a list argument for a cache key.
+    '''
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+
+_MISSING = object()
 
 
 def find_in_code(haystack, needle, start=0, endbefore=None,
                  step=1, comment_delimiters=["#"],
                  enclosures=None, allow_quoted=True,
                  allow_commented=False, quote_marks=['"', "'"],
-                 min_indent="", allow_escaping_quotes=True):
+                 min_indent="", allow_escaping_quotes=True, profile=None):
     '''
+    Sequential arguments:
+    haystack -- The string to search, or a CodeView of it to avoid
+        rescanning the same string on every call (In that case the
+        CodeView's own comment_delimiters, quote_marks and
+        allow_escaping_quotes are used instead of the arguments).
+
     Keyword arguments:
     start -- where to start (if step is negative go from endbefore-1 to
         start, otherwise go from start to endbefore-1)
@@ -1529,6 +4138,64 @@ def find_in_code(haystack, needle, start=0, endbefore=None,
         beforehand (therefore negative step doubles the processing time
         on average).
     min_indent -- The minimum indent used for logging.
+    profile -- A LanguageProfile or the name of a built-in one (See
+        get_profile) to use instead of comment_delimiters, quote_marks
+        and allow_escaping_quotes. The haystack (from start) is then
+        scanned using the profile's regex tokenizer as a CodeView is,
+        so block comments are skipped and triple quotes start a string.
+    '''
+    if isinstance(haystack, CodeView):
+        return haystack.find(
+            needle,
+            start=start,
+            endbefore=endbefore,
+            step=step,
+            enclosures=enclosures,
+            allow_quoted=allow_quoted,
+            allow_commented=allow_commented,
+        )
+    cache = _search_cache
+    if cache is not None:
+        key = (haystack, needle, start, endbefore, step,
+               _freeze(comment_delimiters), _freeze(enclosures),
+               allow_quoted, allow_commented, _freeze(quote_marks),
+               allow_escaping_quotes, profile)
+        try:
+            result = cache.get(key, _MISSING)
+        except TypeError:
+            # An option isn't hashable (such as a list in a list).
+            key = None
+            result = _MISSING
+        if result is not _MISSING:
+            return result
+        result = _find_in_code(
+            haystack, needle, start=start, endbefore=endbefore,
+            step=step, comment_delimiters=comment_delimiters,
+            enclosures=enclosures, allow_quoted=allow_quoted,
+            allow_commented=allow_commented, quote_marks=quote_marks,
+            min_indent=min_indent,
+            allow_escaping_quotes=allow_escaping_quotes, profile=profile,
+        )
+        if key is not None:
+            cache.put(key, result)
+        return result
+    return _find_in_code(
+        haystack, needle, start=start, endbefore=endbefore,
+        step=step, comment_delimiters=comment_delimiters,
+        enclosures=enclosures, allow_quoted=allow_quoted,
+        allow_commented=allow_commented, quote_marks=quote_marks,
+        min_indent=min_indent,
+        allow_escaping_quotes=allow_escaping_quotes, profile=profile,
+    )
+
+
+def _find_in_code(haystack, needle, start=0, endbefore=None,
+                  step=1, comment_delimiters=["#"],
+                  enclosures=None, allow_quoted=True,
+                  allow_commented=False, quote_marks=['"', "'"],
+                  min_indent="", allow_escaping_quotes=True, profile=None):
+    '''
+    Search a plain string for find_in_code (without the cache).
     '''
     if step not in [-1, 1]:
         raise ValueError("step must be -1 or 1 not {}.".format(step))
@@ -1574,6 +4241,15 @@ def find_in_code(haystack, needle, start=0, endbefore=None,
                          " endbefore-1 (start={}, endbefore={},"
                          " step={})"
                          "".format(min_indent, start, endbefore, step))
+    if profile is not None:
+        # As with a plain string, the context starts at start.
+        code = CodeView(haystack[start:endbefore], profile=profile)
+        index = code.find(needle, step=step, enclosures=enclosures,
+                          allow_quoted=allow_quoted,
+                          allow_commented=allow_commented)
+        if index < 0:
+            return index
+        return index + start
     '''
     q_slices = None
     if (step < 0) and (not allow_quoted):
@@ -1608,20 +4284,7 @@ def find_in_code(haystack, needle, start=0, endbefore=None,
                 endbefore = comment_i
 
     if enclosures is not None:
-        for pair in enclosures:
-            if len(pair) != 2:
-                raise ValueError("All sets of enclosures must be 2-long"
-                                 " but the enclosures are: {}"
-                                 "".format(enclosures))
-            if len(pair[0]) != 1:
-                raise ValueError("All openers must be 1-long"
-                                 " but the enclosures are: {}"
-                                 "".format(enclosures))
-            if len(pair[1]) != 1:
-                raise ValueError("All closers must be 1-long"
-                                 " but the enclosures are: {}"
-                                 "".format(enclosures))
-            closers[pair[0]] = pair[1]
+        closers = _enclosure_closers(enclosures)
     opener_stack = []
     # prev_char = None  # in case step doesn't matter
     left_char = None  # in case step is negative
@@ -1631,8 +4294,13 @@ def find_in_code(haystack, needle, start=0, endbefore=None,
     index = start
     if step < 0:
         index = endbefore - 1
-    echo4("{}find_in_code(`{}`, '{}':"
-          "".format(min_indent, haystack.strip(), needle))
+    trace_level = get_trace_level()
+    trace_steps = trace_level >= TRACE_STEPS
+    if trace_level:
+        trace("find_in_code", haystack=haystack, needle=needle,
+              start=start, endbefore=endbefore, step=step,
+              enclosures=enclosures, allow_quoted=allow_quoted,
+              allow_commented=allow_commented)
     while ((step > 0 and index <= (endbefore-len(needle)))
             or (step < 0 and (index >= start))):
         this_char = haystack[index:index+1]
@@ -1644,14 +4312,10 @@ def find_in_code(haystack, needle, start=0, endbefore=None,
         left_char = None
         if index - 1 >= 0:
             left_char = haystack[index-1:index]
-        echo4(min_indent+"{"
-              "start:" + str(start) + "; "
-              "index:" + str(index) + "; "
-              "this_char:" + str(this_char) + "; "
-              "in_quote:" + str(in_quote if in_quote is not None else "") + "; "
-              "opener_stack:" + str(opener_stack) + "; "
-              "here_c_del:" + str(here_c_del if here_c_del is not None else "") + "; "
-              "}")
+        if trace_steps:
+            trace("find_in_code.step", index=index, this_char=this_char,
+                  in_quote=in_quote, opener_stack=tuple(opener_stack),
+                  here_c_del=here_c_del)
         if in_quote is None:
             needle_i = -1
             if enclosures is not None:
@@ -1668,8 +4332,8 @@ def find_in_code(haystack, needle, start=0, endbefore=None,
                          or (haystack[index:index+3] == '"""')
                          or (haystack[index:index+3] == "'''"))):
                 # TODO: handle multi-line comments?
-                echo4(min_indent+"END find_in_code with '{}' due to comment"
-                      "".format(result))
+                if trace_steps:
+                    trace("find_in_code.comment", index=index)
                 break
             elif this_char in quote_marks:
                 # ^ Don't check for escape characters when not
@@ -1705,22 +4369,91 @@ def find_in_code(haystack, needle, start=0, endbefore=None,
                     break
         # prev_char = this_char
         index += step
+    if trace_level:
+        trace("find_in_code.result", result=result)
     return result
 
 
+def find_first_in_code(haystack, needles, start=0, endbefore=None,
+                       step=1, comment_delimiters=["#"],
+                       enclosures=None, allow_quoted=True,
+                       allow_commented=False, quote_marks=['"', "'"],
+                       min_indent="", allow_escaping_quotes=True,
+                       profile=None):
+    '''
+    Find whichever of several needles occurs first in one pass instead
+    of calling find_in_code once per needle. The options are the same
+    as find_in_code except that there are multiple needles.
+
+    Sequential arguments:
+    haystack -- The string to search, or a CodeView of it.
+    needles -- A list of strings to find.
+
+    Keyword arguments:
+    step -- If -1, find the last occurrence instead of the first.
+
+    Returns:
+    a tuple of the index in haystack and the index in needles of the
+    needle found there, or (-1, -1) if no needle was found. If more than
+    one needle starts at that index, the first one in needles is used.
+    '''
+    if isinstance(haystack, CodeView):
+        return haystack.find_first(
+            needles,
+            start=start,
+            endbefore=endbefore,
+            step=step,
+            enclosures=enclosures,
+            allow_quoted=allow_quoted,
+            allow_commented=allow_commented,
+        )
+    if haystack is None:
+        raise ValueError("haystack is None.")
+    if endbefore is None:
+        endbefore = len(haystack)
+    elif endbefore < 0:
+        endbefore = len(haystack) + endbefore
+    elif endbefore > len(haystack):
+        endbefore = len(haystack)
+    if endbefore < start:
+        raise ValueError("{}endbefore is < start (start={}, endbefore={},"
+                         " step={})"
+                         "".format(min_indent, start, endbefore, step))
+    # As with find_in_code, the context of a plain string starts at
+    #   start, so view only that part:
+    view = CodeView(
+        haystack[start:endbefore],
+        comment_delimiters=comment_delimiters,
+        quote_marks=quote_marks,
+        allow_escaping_quotes=allow_escaping_quotes,
+        profile=profile,
+    )
+    index, needle_i = view.find_first(
+        needles,
+        step=step,
+        enclosures=enclosures,
+        allow_quoted=allow_quoted,
+        allow_commented=allow_commented,
+    )
+    if index < 0:
+        return index, needle_i
+    return index + start, needle_i
+
+
 def find_unquoted_not_commented_not_parenthetical(haystack, needle,
                                                   start=0, endbefore=None,
                                                   step=1,
                                                   comment_delimiters=["#"],
                                                   quote_marks=["'", '"'],
                                                   min_indent="",
-                                                  allow_escaping_quotes=True):
+                                                  allow_escaping_quotes=True,
+                                                  profile=None):
     '''
     This function was lost and not found in a previous commit, and may
     have never been created after used. Therefore, 2021-03-13 it was
     re-implemented by calling find_unquoted_not_commented with a new
     enclosures parameter with the value ["()"].
-    See find_in_code.
+    See find_in_code (haystack can be a CodeView).
     '''
     return find_in_code(
         haystack,
@@ -1734,6 +4467,7 @@ def find_unquoted_not_commented_not_parenthetical(haystack, needle,
         quote_marks=quote_marks,
         min_indent=min_indent,
         allow_escaping_quotes=allow_escaping_quotes,
+        profile=profile,
     )
 
 
@@ -1741,13 +4475,14 @@ def find_unquoted_not_commented(haystack, needle, start=0, endbefore=None,
                                 step=1, comment_delimiters=["#"],
                                 quote_marks=['"', "'"],
                                 min_indent="",
-                                allow_escaping_quotes=True):
+                                allow_escaping_quotes=True,
+                                profile=None):
     '''
     This function was lost and not found in a previous commit, and may
     have never been created after used. Therefore, 2021-03-13 it was
     re-implemented by calling find_unquoted_not_commented with a new
     enclosures parameter with the value ["()"].
-    See find_in_code.
+    See find_in_code (haystack can be a CodeView).
     '''
     return find_in_code(
         haystack,
@@ -1760,6 +4495,7 @@ def find_unquoted_not_commented(haystack, needle, start=0, endbefore=None,
         quote_marks=quote_marks,
         min_indent=min_indent,
         allow_escaping_quotes=allow_escaping_quotes,
+        profile=profile,
     )
 
 
@@ -1767,13 +4503,14 @@ def find_unquoted_even_commented(haystack, needle, start=0,
                                  endbefore=None, step=1,
                                  quote_marks=["'", '"'],
                                  min_indent="",
-                                 allow_escaping_quotes=True):
+                                 allow_escaping_quotes=True,
+                                 profile=None):
     '''
     This function was lost and not found in a previous commit, and may
     have never been created after used. Therefore, 2021-03-13 it was
     re-implemented by calling find_unquoted_not_commented with a new
     enclosures parameter with the value ["()"].
-    See find_in_code.
+    See find_in_code (haystack can be a CodeView).
     '''
     return find_in_code(
         haystack,
@@ -1787,6 +4524,7 @@ def find_unquoted_even_commented(haystack, needle, start=0,
         quote_marks=quote_marks,
         min_indent=min_indent,
         allow_escaping_quotes=allow_escaping_quotes,
+        profile=profile,
     )
 
 
@@ -1797,196 +4535,346 @@ def substring_after(haystack, needle):
     return haystack[needleI+len(needle):]
 
 
-def find_after(haystack, needle):
-    needleI = haystack.find(needle)
-    if needleI < -1:
-        return -1
-    return needleI+len(needle)
+def find_after(haystack, needle):
+    needleI = haystack.find(needle)
+    if needleI < -1:
+        return -1
+    return needleI+len(needle)
+
+
+def block_uncomment_line(line, path=None, line_n=None):
+    '''
+    Remove the comments from a C or C++ line that doesn't start in a
+    block comment (To lex a whole file, see CLexedLines).
+
+    Keyword arguments:
+    path -- The file in which this line exists (for error tracing).
+    line_n -- The line number (starting with 1) in path that is where
+        this line originated (for error tracing).
+
+    Returns:
+    a tuple of line (string, stripped, with each comment replaced by a
+    space), still_commented (boolean, True if a block comment continues
+    onto the next line).
+    '''
+    view = CodeView(line, profile=_c_profile)
+    still_commented = view.end_state()[1] is not None
+    return CLexedLine(view).code, still_commented
+
+
+COMMENTED_DEF_WARNING = "comment"
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return(f.read())
+    return None
+
+
+def try_readlines(path, encoding=None):
+    '''
+    Get a tuple of lines and the encoding that decoded them (See
+    load_text for details and to also get the newline and BOM).
+    '''
+    loaded = load_text(path, encoding=encoding)
+    return loaded.lines, loaded.encoding
+
+
+_mask_run_rx = re.compile(b"\x01+")
+_mask_run_tables = {}
+_c_directive_rx = re.compile(r"#[ \t]*(\w+)(?:[ \t]+(\S+))?[ \t]*")
+
+
+def _mask_runs(mask, flag):
+    '''
+    Get a list of (start, stop) tuples, one for each run of characters
+    that have flag set in mask (See CodeView.mask).
+    '''
+    table = _mask_run_tables.get(flag)
+    if table is None:
+        table = bytes(bytearray((1 if (value & flag) else 0)
+                                for value in range(256)))
+        _mask_run_tables[flag] = table
+    return [match.span()
+            for match in _mask_run_rx.finditer(bytes(mask).translate(table))]
+
+
+def _without_runs(text, runs, start, stop):
+    '''
+    Get text[start:stop] with each run (See _mask_runs) replaced by a
+    space (so "a/*b*/c" becomes "a c", as a C compiler sees it).
+    '''
+    parts = []
+    pos = start
+    for run_start, run_stop in runs:
+        if run_stop <= pos:
+            continue
+        if run_start >= stop:
+            break
+        parts.append(text[pos:max(run_start, pos)])
+        pos = min(run_stop, stop)
+    parts.append(text[pos:stop])
+    return " ".join(parts)
+
+
+class CLexedLine(object):
+    '''
+    One line of C or C++ code, lexed once (See CLexedLines).
+
+    Properties
+    text -- the original line.
+    code -- the line without comments (each comment becomes a space),
+        stripped.
+    comments -- a list of (start, stop) tuples (indices in text) of
+        each comment or part of a block comment on the line.
+    strings -- a list of (start, stop) tuples of each string or
+        character literal (including quote marks) on the line.
+    tokens -- a tuple of the directive (such as "#define", even if
+        written "# define"), its first argument (or None), and the rest
+        of the code (or "") if the line is a preprocessor directive,
+        otherwise an empty tuple.
+    value_slice -- a (start, stop) tuple of where the rest of the
+        directive (tokens[2]) is in text, or None if there are no
+        tokens. If the rest is blank, both are the end of the first
+        argument.
+    commented -- True if tokens are from a directive that is commented
+        with "//" (such as "// #define NAME 1"). A directive inside of
+        a block comment doesn't count.
+    '''
+    __slots__ = (
+        "text",
+        "code",
+        "comments",
+        "strings",
+        "tokens",
+        "value_slice",
+        "commented",
+    )
+
+    def __init__(self, view):
+        '''
+        Sequential arguments:
+        view -- A CodeView of the line using a C profile (such as from
+            LineScanner.feed so a block comment or escaped newline from
+            the previous line is known).
+        '''
+        text = view.text
+        mask = view.mask()
+        self.text = text
+        self.comments = _mask_runs(mask, CTX_COMMENTED)
+        self.strings = _mask_runs(mask, CTX_QUOTED)
+        self.code = _without_runs(text, self.comments, 0, len(text)).strip()
+        self.tokens = ()
+        self.value_slice = None
+        self.commented = False
+        start = len(text) - len(text.lstrip())
+        if ((view.in_quote is not None) or (view.in_comment is not None)
+                or (start >= len(text))):
+            return
+        if text.startswith("#", start):
+            self._set_directive(text, self.comments, start)
+        elif text.startswith("//", start):
+            body_start = find_non_whitespace(text, start+2)
+            if (body_start < 0) or not text.startswith("#", body_start):
+                return
+            body = CodeView(text[body_start:], profile=view.profile)
+            runs = [(run_start+body_start, run_stop+body_start)
+                    for run_start, run_stop
+                    in _mask_runs(body.mask(), CTX_COMMENTED)]
+            self.commented = self._set_directive(text, runs, body_start)
+
+    def _set_directive(self, text, runs, start):
+        blanked = list(text)
+        for run_start, run_stop in runs:
+            blanked[run_start:run_stop] = " " * (run_stop-run_start)
+        blanked = "".join(blanked)  # same indices as text but no comments
+        match = _c_directive_rx.match(blanked, start)
+        if match is None:
+            return False
+        value_start = match.end()
+        value_stop = len(blanked.rstrip())
+        value = _without_runs(text, runs, value_start, value_stop).strip()
+        if not value:
+            if match.group(2) is None:
+                value_start = value_stop = match.end(1)
+            else:
+                value_start = value_stop = match.end(2)
+        self.tokens = ("#" + match.group(1), match.group(2), value)
+        self.value_slice = (value_start, value_stop)
+        return True
+
+    def define_name(self):
+        '''
+        Get the name defined (or commented-out) by a "#define" line, or
+        None if the line isn't one.
+        '''
+        if self.tokens and (self.tokens[0] == "#define"):
+            return self.tokens[1]
+        return None
+
+    def __repr__(self):
+        return "CLexedLine({!r})".format(self.text)
 
 
-def block_uncomment_line(line, path=None, line_n=None):
+def iter_lexed_c_lines(lines, profile="c"):
     '''
-    Keyword arguments:
-    path -- The file in which this line exists (for error tracing).
-    line_n -- The line number (starting with 1) in path that is where
-        this line originated (for error tracing).
+    Lex C or C++ lines in one pass without keeping them (for a large
+    file, such as from iter_lines). To keep the results so they can be
+    refreshed after a change, use CLexedLines.
 
     Returns:
-    a tuple of line (string), still_commented (boolean).
+    a generator of a CLexedLine for each line.
     '''
-    orig_line = line
-    still_commented = False
-    opener = "/*"
-    closer = "*/"
-    line_n = 0
-    too_many = len(orig_line)
-    try_count = 0
-    while True:
-        try_count += 1
-        if try_count >= too_many:
-            raise RuntimeError(
-                "There were too many tries"
-                " (The line `{}` wasn't handled properly"
-                " and became `{}` so far)."
-                "".format(orig_line, line)
-            )
-        line_n += 1  # Counting numbers start at 1.
-        openI = line.find(opener)
-        closeI = -1
-        if openI > -1:
-            closeI = line.find(closer, openI+len(opener))
-        inlineI = line.find("//")
-        if openI < 0 and closeI < 0 and inlineI < 0:
-            break
-        if (openI > -1) and ((inlineI < 0) or (openI < inlineI)):
-            # There's a `/*` and either there is no `//` or `/*` is before `//`.
-            if closeI > -1:
-                if closeI < openI:
-                    raise_SyntaxError(
-                        path,
-                        line_n,
-                        'block_uncomment_line only accepts lines that'
-                        'were not in a block comment, but there was a'
-                        ' {} before {} in `{}`'
-                        ''.format(opener, closer, orig_line)
-                    )
-                echo2('* removing "{}" from "{}"'
-                      ''.format(line[openI:closeI+len(closer)], line))
-                line = line[:openI] + line[closeI+len(closer):]
-            else:
-                still_commented = True
-        else:
-            # There is either no `/*` or there is one to ignore after `//`.
-            if inlineI > -1:
-                echo2('* removing "{}" from "{}"'
-                      ''.format(line[inlineI:], line))
-                line = line[:inlineI].strip()
-            else:
-                raise RuntimeError(
-                    "Uh oh, the checks shouldn't happen if there is"
-                    " neither a `/*` nor a `//` in a predictable arrangement."
-                )
-
-    return line, still_commented
+    scanner = LineScanner(profile=profile)
+    for line in lines:
+        yield CLexedLine(scanner.feed(line))
 
 
-COMMENTED_DEF_WARNING = "comment"
-
-
-def _try_get_encoded_lines(path, encoding=None):
-    # This should be used
-    # instead of any function called get_lines (such as from
-    # YAMLObject_fromCodeConverter.py) or get_all_lines.
-
-    user_encoding = encoding
-    # with open(file, "rb") as ins:
-    #     rawdata = ins.read()
-    #     det_encoding = chardet.detect(rawdata)['encoding']
-    det_encoding = get_file_encoding(path)
-    echo1()
-    echo1("det_encoding={}".format(det_encoding))
-
-    lines = None
-    encodings = [None, 'iso-8859', 'utf-8', 'iso-8859-1', 'latin-1',
-                 'cp437']
-    # ^ 'cp437' is the (English) Windows Command Prompt's
-    #   (The `chcp` command shows code page 437), MIME/IANA: IBM437,
-    #   aliases "cp437, 437, csPC8CodePage437, OEM-US"
-    #   according to <https://en.wikipedia.org/wiki/Code_page_437>
-    #   2022-09-26. It correctly displays German strings (such as the
-    #   German spelling of Prusa in Configuration_adv.h in Marlin) read
-    #   using binary mode then decoded using "UTF-8".
-    if det_encoding not in encodings:
-        encodings.insert(0, det_encoding)
-    if user_encoding is not None:
-        if user_encoding in encodings:
-            encodings.remove(user_encoding)
-        encodings.insert(0, user_encoding)
-    encodingI = 0
-    ex0 = None
-    echo1('- reading "{}"'.format(path))
-    if lines is None:
-        while True:
-            encoding = encodings[encodingI]
-            try:
-                lines = []
-                if encoding is None:
-                    with open(path, 'r', encoding=encoding) as ins:
-                        for rawL in ins:
-                            '''
-                            ^ may cause "UnicodeDecodeError: 'charmap'
-                              codec can't" decode byte 0x90 in position
-                              5762: character maps to" <undefined>"
-                              such as in Marlin bugfix-2.0.x ecaebe4
-                              Configuration_adv.h (which Geany says is
-                              UTF-8).
-                            '''
-                            lines.append(rawL)
-                else:
-                    with open(path, 'r') as ins:
-                        for rawL in ins:
-                            lines.append(rawL)
-                break
-            except UnicodeDecodeError as ex:
-                if ex0 is None:
-                    ex0 = ex
-                if "decode byte" in str(ex):
-                    encodingI += 1
-                    if encodingI >= len(encodings):
-                        echo0('\nError reading "{}" (tried encoding={}):'
-                              ''.format(path, encoding))
-                        raise
-                        # raise
-                        # break
-                    else:
-                        echo1("  - encoding={} failed: {}"
-                              "".format(encoding, str(ex)))
-                        # if encoding is not None:
-                        #     raise  # for debug only
-                else:
-                    echo0('\nError reading "{}" (tried encoding={}):'
-                          ''.format(path, encoding))
-                    raise
-    return lines, encoding
+def _define_matches(lexed_lines, name, line_index):
+    '''
+    Generate an (index, CLexedLine) tuple for each of lexed_lines that
+    has a #define (or commented #define) of name, or only the line at
+    line_index (if not None, then name is ignored) if it has one.
+    '''
+    for index, line in enumerate(lexed_lines):
+        got_name = line.define_name()
+        if line_index is not None:
+            if index == line_index:
+                if got_name is not None:
+                    yield index, line
+                return
+        elif (got_name is not None) and (got_name == name):
+            yield index, line
+
+
+class CLexedLines(object):
+    '''
+    Lex the lines of a C or C++ file in one pass (carrying block
+    comments and escaped newlines to the next line) so that each
+    #define operation (See get_cdef, cdefs_to_d, and set_cdef) reads
+    the CLexedLine of each line instead of re-lexing the file.
 
+    The list of lines is not copied, so after it is changed (such as by
+    set_cdef or insert_lines) call refresh (get_cdef does) to re-lex
+    only the lines that changed (and any lines after them that are now
+    in a different block comment or quote).
 
-def read_bytes(path):
-    with open(path, 'rb') as f:
-        return(f.read())
-    return None
+    Properties
+    lines -- the list of lines that was lexed.
+    '''
+    def __init__(self, lines, profile="c"):
+        self.lines = lines
+        self._scanner = LineScanner(profile=profile)
+        self._texts = []
+        self._lexed = []
+        self._states = [self._scanner.get_state()]
+        # ^ the state before each line, then the state at the end
+        self._defines = None
+        self.refresh()
+
+    def __len__(self):
+        return len(self._lexed)
+
+    def __getitem__(self, index):
+        return self._lexed[index]
+
+    def __iter__(self):
+        return iter(self._lexed)
+
+    def refresh(self):
+        '''
+        Re-lex each line that isn't the same object (string) as when
+        it was lexed, and following lines until the state carried from
+        the previous line is the same as before. If lines is a read-only
+        sequence (such as a LineStore) rather than a list, it can't have
+        changed, so it is only lexed again if lines is set to a
+        different one.
 
+        Returns:
+        the number of lines lexed.
+        '''
+        lines = self.lines
+        texts = self._texts
+        if not isinstance(lines, list):
+            if texts is lines:
+                return 0
+            # Keep only the state before the first line, and lex all
+            #   of the lines without comparing (or copying) them.
+            texts = self._texts = []
+            del self._lexed[:]
+            del self._states[1:]
+        new_count = len(lines)
+        old_count = len(texts)
+        limit = min(new_count, old_count)
+        start = 0
+        while (start < limit) and (lines[start] is texts[start]):
+            start += 1
+        if start == new_count == old_count:
+            return 0
+        tail = 0
+        while ((tail < limit - start)
+               and (lines[new_count-1-tail] is texts[old_count-1-tail])):
+            tail += 1
+        scanner = self._scanner
+        states = self._states
+        scanner.set_state(states[start])
+        new_lexed = []
+        new_states = []
+        stop = new_count - tail
+        index = start
+        while index < new_count:
+            state = scanner.get_state()
+            if ((index >= stop)
+                    and (state == states[index-new_count+old_count])):
+                break  # The rest is lexed the same way as before.
+            new_states.append(state)
+            new_lexed.append(CLexedLine(scanner.feed(lines[index])))
+            index += 1
+        old_index = index - new_count + old_count
+        self._lexed[start:old_index] = new_lexed
+        self._states[start:old_index] = new_states
+        if isinstance(lines, list):
+            self._texts[start:old_index] = lines[start:index]
+        else:
+            self._texts = lines
+        if index == new_count:
+            self._states[-1] = scanner.get_state()
+        self._defines = None
+        return len(new_lexed)
 
-def try_readlines(path, encoding=None):
-    lines = None
-    try:
-        return _try_get_encoded_lines(path, encoding=encoding)
-    except UnicodeDecodeError as ex:
-        pass
-    with open(path, 'rb') as f:
-        f_contents = f.read()
-    if encoding is None:
-        encoding = DEFAULT_DEC
-    contents = f_contents.decode(encoding)
-    if "\r\n" in contents:
-        contents = contents.replace("\r\n", "\n")
-    lines = contents.split("\n")
-    echo1("- had to use binary (decoded as {})".format(encoding))
-    return lines, "utf-8"
+    def define_indices(self, name):
+        '''
+        Get a list of the index of each line (in order) that defines
+        name (or has a commented-out #define of it, See
+        CLexedLine.commented).
+        '''
+        if self._defines is None:
+            defines = {}
+            for index, lexed in enumerate(self._lexed):
+                got_name = lexed.define_name()
+                if got_name is not None:
+                    defines.setdefault(got_name, []).append(index)
+            self._defines = defines
+        return self._defines.get(name, [])
 
 
 def get_cdef(path, name, lines=None, skip=None, encoding=None,
-             line_index=None):
+             line_index=None, lexed=None):
     '''
     Get a value after "#define {}".format(name) in a file located at
     path, and an error.
 
     Keyword arguments:
     lines -- If this is not None, it is assumed to be a list of lines,
-        and path is ignored.
+        and path is ignored. It can also be an iterator (such as from
+        iter_lines), which is lexed as it is read and not kept, so
+        reading stops at the first non-commented match.
     skip -- Skip this many instances (increase to detect more
         instances). The successive result will be ignored if commented.
     line_index -- Get the value from this line index, and ignore name.
         The index starts at 0 so it is one less than line_n.
+    lexed -- A CLexedLines to use (after calling its refresh method)
+        instead of lexing lines again (lines and path are ignored).
 
     Returns:
     a tuple of value (string), line number (-1 if not found),
@@ -1995,19 +4883,7 @@ def get_cdef(path, name, lines=None, skip=None, encoding=None,
     Raises:
     UnicodeDecodeError (The implied call to readline in the line iterator
       itself raises the error).
-    NotImplementedError if /* is detected inside of an inline comment
     '''
-    block_commented = False
-    # Account for commented defs:
-    commented_v = None
-    commented_v_n = -1
-    v = None
-    v_n = -1
-    line_n = 0
-    if lines is None:
-        lines, got_encoding = try_readlines(path, encoding=encoding)
-    count = 0
-    actual_name = None
     if name is None:
         if (line_index is None) or (line_index < 0):
             raise ValueError(
@@ -2015,101 +4891,81 @@ def get_cdef(path, name, lines=None, skip=None, encoding=None,
                 " a line index (starting at 0 for the first line in the"
                 " case of an index as opposed to a line number)."
             )
-    for rawL in lines:
-        line_n += 1  # Start at 1.
-        line = rawL.strip()
-        was_commented = False
-        if not block_commented:
-            inlineI = line.find("//")
-            if line.startswith("//"):
-                parts = line[2:].strip().split()
-                if (skip is not None) and (skip > 0):
-                    # Do not uncomment multiple defines or an error
-                    # will occur unless enclosed in #ifdef, #elif, etc.
-                    continue
-                if len(parts) >= 2:
-                    if (parts[0] == "#define"):
-                        if line_index is not None:
-                            if line_index != line_n - 1:
-                                continue
-                            actual_name = parts[1]
-                        else:
-                            if (parts[1] != name):
-                                continue
-                        # Only get this value if the name or line_index
-                        #   matches.
-                        commented_v_n = line_n
-                        commented_v = substring_after(line, name).strip()
-                        if commented_v.startswith("//"):
-                            commented_v = ""
-                        elif "/*" in commented_v:
-                            raise NotImplementedError('"/*" in commented value')
+    if lexed is None:
+        if lines is None:
+            lines = load_text(path, encoding=encoding).lines
+        if hasattr(lines, "__len__"):
+            lexed = CLexedLines(lines)
+    else:
+        lexed.refresh()
+    if lexed is None:
+        matches = _define_matches(iter_lexed_c_lines(lines), name,
+                                  line_index)
+    elif line_index is not None:
+        matches = []
+        if ((line_index < len(lexed))
+                and (lexed[line_index].define_name() is not None)):
+            matches.append((line_index, lexed[line_index]))
+    else:
+        matches = ((index, lexed[index])
+                   for index in lexed.define_indices(name))
+    actual_name = None
+    # Account for commented defs:
+    commented_v = None
+    commented_v_n = -1
+    count = 0
+    for index, line in matches:
+        if line_index is not None:
+            actual_name = line.define_name()
+        if line.commented:
+            if (skip is not None) and (skip > 0):
+                # Do not uncomment multiple defines or an error
+                # will occur unless enclosed in #ifdef, #elif, etc.
                 continue
-            if inlineI > -1:
-                line = line[:inlineI].strip()
-        else:
-            closeI = line.find("*/")
-            if closeI > -1:
-                line = line[closeI+2:]
-                # in case another comment starts on same line:
-                line, block_commented = block_uncomment_line(line)
-        if len(line) == 0:
+            commented_v = line.tokens[2]
+            commented_v_n = index + 1
             continue
-        parts = line.split()  # spaces/tabs or multiple doesn't matter.
-        if ((parts[0] == "#define")
-                and ((parts[1] == name) or (line_index == (line_n-1)))):
-            count += 1
-            if (skip is not None) and (count <= skip):
-                echo2("* skipped `{}`".format(rawL.strip()))
-                continue
-            echo2("* found `{}`".format(rawL.strip()))
-            if name is not None:
-                v = substring_after(line, name).strip()
-            else:
-                actual_name = parts[1]
-                v = substring_after(line, actual_name).strip()
-            v_n = line_n
-            break
-    if v is None:
-        if commented_v is not None:
-            echo2('[pycodetool.parsing get_cdef] commented_v="{}"'
-                  ''.format(commented_v))
-            return commented_v, commented_v_n, actual_name, COMMENTED_DEF_WARNING
-    echo2('[pycodetool.parsing get_cdef] v="{}"'
-          ''.format(v))
-    return v, v_n, actual_name, None
-
-
-def cdefs_to_d(path, lines=None):
+        count += 1
+        if (skip is not None) and (count <= skip):
+            echo2("* skipped `{}`".format(line.text.strip()))
+            continue
+        echo2("* found `{}`".format(line.text.strip()))
+        echo2('[pycodetool.parsing get_cdef] v="{}"'
+              ''.format(line.tokens[2]))
+        return line.tokens[2], index + 1, actual_name, None
+    if commented_v is not None:
+        echo2('[pycodetool.parsing get_cdef] commented_v="{}"'
+              ''.format(commented_v))
+        return commented_v, commented_v_n, actual_name, COMMENTED_DEF_WARNING
+    echo2('[pycodetool.parsing get_cdef] v=None')
+    return None, -1, actual_name, None
+
+
+def cdefs_to_d(path, lines=None, lexed=None):
+    '''
+    Get a dict of each name defined by a #define in the file at path
+    (or lines, or lexed--See get_cdef) and its value (or None if the
+    #define is commented).
+    '''
     results = {}
-    got_encoding = None
-    if lines is None:
-        lines, got_encoding = try_readlines(path, encoding=None)
-    for i in range(len(lines)):
-        line = lines[i]
-        v, line_n, got_key, err = get_cdef(
-            path,
-            None,
-            lines=lines,
-            line_index=i
-        )
-
-        if (err is not None):
-            if "commented" in err:
-                v = None
-            else:
-                raise NotImplementedError(
-                    'Whether to store cached values when err is'
-                    ' "{}" is not decided yet--needs test cases.'
-                    ''.format(err)
-                )
+    if lexed is None:
+        if lines is None:
+            lines = load_text(path).lines
+        lexed = iter_lexed_c_lines(lines)
+    else:
+        lexed.refresh()
+    for line in lexed:
+        got_key = line.define_name()
         if got_key is not None:
-            results[got_key] = v
+            if line.commented:
+                results[got_key] = None
+            else:
+                results[got_key] = line.tokens[2]
         else:
             echo2('There was no variable in `{}`:'
                   ' The line may be a comment'
                   ' (but not even a commented `#define` apparently)'
-                  ''.format(line))
+                  ''.format(line.text))
     return results
 
 
@@ -2118,7 +4974,7 @@ C_CONSTANTS = ['BOARD_MKS_GEN_L', 'ONBOARD', 'TMC2209', 'A4988',
 
 
 def set_cdef(path, name, value, comments=None, lines=None,
-             encoding=DEFAULT_CO):
+             encoding=DEFAULT_CO, lexed=None):
     '''
     Set define(s) preserving spacing and comments. If the item is
     commented, uncomment it, unless value is None.
@@ -2141,6 +4997,8 @@ def set_cdef(path, name, value, comments=None, lines=None,
         of comments after the line. A list is multiline, while a string
         goes at the end of the line. A "//" will be prepended if not
         present unless comments[0] == "/*" and comments[-1] == "*/".
+    lexed -- A CLexedLines to use instead of lines (so that the lines
+        are not lexed again, See get_cdef).
 
     Returns:
     a tuple containing a list of symbols that changed and a list
@@ -2199,9 +5057,13 @@ def set_cdef(path, name, value, comments=None, lines=None,
         )
 
     do_save = False
+    newline = None
+    bom = None
     affected_keys = []
     unaffected_items = []
-    if lines is None:
+    if lexed is not None:
+        lines = lexed.lines
+    elif lines is None:
         if path is None:
             raise ValueError("You must specify a file and/or lines to modify.")
         # with open(path, 'r') as ins:
@@ -2211,15 +5073,22 @@ def set_cdef(path, name, value, comments=None, lines=None,
               can't decode byte 0x90 in position 5762: character maps to
               <undefined>".
             '''
-        lines, got_encoding = try_readlines(path, encoding=encoding)
+        loaded = load_text(path, encoding=encoding)
+        lines = loaded.lines
+        encoding = loaded.encoding
+        newline = loaded.newline
+        bom = loaded.bom
         do_save = True
+    if lexed is None:
+        lexed = CLexedLines(lines)
 
     for name in names:
         for skip in range(3):
             # GRID_MAX_POINTS_X appears 3 times in Configuration.h
             #   in Marlin 2.0.x-bugfix branch
             #   (ok since protected under #if, #elif, #elif).
-            v, line_n, got_key, err = get_cdef(path, name, lines=lines, skip=skip)
+            v, line_n, got_key, err = get_cdef(path, name, skip=skip,
+                                               lexed=lexed)
             line_i = line_n - 1
             # COMMENTED_DEF_WARNING is ok (using that line is safe
             #   since the warning indicates there is no non-commented
@@ -2252,14 +5121,13 @@ def set_cdef(path, name, value, comments=None, lines=None,
                     if get_verbosity() > 0:
                         echo0('* formerly "{}"'.format(original_line))
                     continue
-                indent_count = len(rawL) - len(rawL.lstrip())
-                indent = rawL[:indent_count]
                 line = rawL.strip()
                 if line.startswith("//"):
                     line = line[2:].strip()
-                parts = line.split()
+                # The value is shifted left if "//" was removed:
+                shift = len(rawL.strip()) - len(line)
                 line = indent + line
-                if parts[0] != "#define":
+                if lexed[line_i].define_name() != name:
                     raise RuntimeError('{}:{}: expected #define'
                                        ''.format(path, line_n))
                 if v != value:
@@ -2277,28 +5145,11 @@ def set_cdef(path, name, value, comments=None, lines=None,
                         orphan=True,
                     ))
 
-                if v == "":
-                    # define the symbol, but do not give it a value.
-                    # if len(parts) < 3:
-                    #   pass # There is no comment.
-                    name_i = line.find(parts[1])
-                    if name_i < 0:
-                        raise RuntimeError("name wasn't found")
-                    original_v_i = name_i + len(parts[1])
-                    '''
-                    else:
-                        comment_i = line.find(parts[2])
-                        if comment_i < 0:
-                            raise RuntimeError("comment wasn't found")
-                        original_v_i = comment_i + len(parts[2])
-                    '''
-                    detected_sym_name = line[name_i:original_v_i]
-                    echo2('detected_sym_name="{}"'.format(detected_sym_name))
-                else:
-                    original_v_i = line.find(v)
-                    echo2('v="{}"'.format(v))
+                # If v == "", the slice is empty and is after the name.
+                original_v_i, after_v_i = lexed[line_i].value_slice
+                original_v_i -= shift
+                after_v_i -= shift
                 echo2("original_v_i={}".format(original_v_i))
-                after_v_i = original_v_i + len(v)
                 echo2("after_v_i={}".format(after_v_i))
                 echo2('v="{}"'.format(v))
 
@@ -2322,11 +5173,6 @@ def set_cdef(path, name, value, comments=None, lines=None,
                     # multi-line comments are later (only if comment is None)
                     echo2('this_cmt="{}"'.format(this_cmt))
                 old_value = line[original_v_i:after_v_i]
-                if old_value != v:
-                    raise RuntimeError(
-                        "Parsing failed to identify the value in `{}`"
-                        "".format(lines[line_i])
-                    )
                 space_diff = len(value) - len(old_value)
                 this_sym = line[:original_v_i]
                 post_sym_count = len(this_sym) - len(this_sym.rstrip())
@@ -2432,76 +5278,191 @@ def set_cdef(path, name, value, comments=None, lines=None,
         # if name == "PID_EDIT_MENU":
         #     raise NotImplementedError("preserving comments") # debug only
     if do_save:
-        write_lines(path, lines, encoding=encoding)
+        write_lines(path, lines, encoding=encoding, newline=newline, bom=bom)
     return affected_keys, unaffected_items
 
 
-def write_lines(path, lines, encoding=DEFAULT_CO):
+# Each faux word (bytes of text that was decoded using the wrong
+#   encoding then saved, such as b"Pr\xc3\x85\xc2\xaf\xc3\x85\xc2\xa1a")
+#   and the real word to write instead (such as b"Pr\xc5\xaf\xc5\xa1a").
+#   They are loaded from DATA_DIR the first time they are needed (See
+#   replace_faux_words):
+_faux_words = None
+_faux_words_rx = None
+_faux_word_counts = Counter()
+_faux_words_lock = threading.Lock()
+
+
+def _load_faux_words():
+    faux_path = os.path.join(DATA_DIR, "faux-words")
+    real_path = os.path.join(DATA_DIR, "real-words")
+    faux_words = OrderedDict()
+    for sub in sorted(os.listdir(faux_path)):
+        faux_words[read_bytes(os.path.join(faux_path, sub))] = \
+            read_bytes(os.path.join(real_path, sub))
+    return faux_words
+
+
+def _get_faux_words_rx():
+    global _faux_words
+    global _faux_words_rx
+    with _faux_words_lock:
+        if _faux_words is None:
+            _faux_words = _load_faux_words()
+        if (_faux_words_rx is None) and _faux_words:
+            # ^ (If there are no pairs, the regex would be b"", which
+            #   matches everywhere.)
+            # Longest first so that a faux word containing another wins:
+            _faux_words_rx = re.compile(b"|".join(
+                re.escape(faux)
+                for faux in sorted(_faux_words, key=len, reverse=True)
+            ))
+        return _faux_words_rx, _faux_words
+
+
+def register_faux_word(faux, real):
+    '''
+    Replace faux with real whenever write_lines writes it (in addition
+    to the pairs in DATA_DIR).
+
+    Sequential arguments:
+    faux -- The bytes to replace (or a string, which is encoded as
+        UTF-8), such as mojibake from a file that was decoded using the
+        wrong encoding then saved.
+    real -- The bytes (or a string, which is encoded as UTF-8) to
+        write instead.
+    '''
+    global _faux_words_rx
+    if not isinstance(faux, bytes):
+        faux = faux.encode("utf-8")
+    if not isinstance(real, bytes):
+        real = real.encode("utf-8")
+    if not faux:
+        raise ValueError("faux is blank.")
+    _get_faux_words_rx()  # Load the built-in pairs first.
+    with _faux_words_lock:
+        _faux_words[faux] = real
+        _faux_words_rx = None
+
+
+def unregister_faux_word(faux):
+    '''
+    Stop replacing faux (See register_faux_word), including a built-in
+    one. Do nothing if faux is not a faux word.
+    '''
+    global _faux_words_rx
+    if not isinstance(faux, bytes):
+        faux = faux.encode("utf-8")
+    _get_faux_words_rx()
+    with _faux_words_lock:
+        if _faux_words.pop(faux, None) is not None:
+            _faux_words_rx = None
+
+
+def replace_faux_words(data):
+    '''
+    Replace every faux word (See register_faux_word) in data in one
+    pass (A real word written by a replacement is not checked again).
+
+    Sequential arguments:
+    data -- The encoded bytes.
+
+    Returns:
+    a tuple of the new bytes and the number of replacements.
+    '''
+    rx, faux_words = _get_faux_words_rx()
+    if rx is None:
+        return data, 0  # There are no faux words.
+    counts = Counter()
+
+    def real_of(match):
+        faux = match.group()
+        counts[faux] += 1
+        return faux_words[faux]
+
+    data = rx.sub(real_of, data)
+    if counts:
+        with _faux_words_lock:
+            _faux_word_counts.update(counts)
+    return data, sum(counts.values())
+
+
+def get_faux_word_counts():
+    '''
+    Get a Counter of how many times each faux word (bytes) was replaced
+    (See replace_faux_words) so far.
+    '''
+    with _faux_words_lock:
+        return Counter(_faux_word_counts)
+
+
+def write_lines(path, lines, encoding=DEFAULT_CO, newline=None, bom=None):
     '''
     Write each line in lines to path (Only each line not
-    ending with "\n" gets that added).
+    ending with "\n" gets that added). Faux words are replaced (See
+    replace_faux_words).
+
+    Keyword arguments:
+    newline -- Write this instead of each "\n" at the end of a line
+        (such as the newline of a LoadedText).
+    bom -- Write these bytes (such as the bom of a LoadedText) first.
     '''
     if encoding == "utf_8":
         encoding = "utf-8"
     echo1('write_lines...encoding="{}"...'.format(encoding))
-    # raise NotImplementedError()
-    # with open(path, 'w', encoding=encoding) as outs:
-    faux_path = os.path.join(DATA_DIR, "faux-words")
-    real_path = os.path.join(DATA_DIR, "real-words")
-    real_pairs = []
-    for sub in os.listdir(faux_path):
-        fauxStrPath = os.path.join(faux_path, sub)
-        realStrPath = os.path.join(real_path, sub)
-        fauxBytes = read_bytes(fauxStrPath)
-        realBytes = read_bytes(realStrPath)
-        real_pairs.append((fauxBytes, realBytes))
+    parts = []
+    for rawL in lines:
+        if not rawL.endswith("\n"):
+            rawL += "\n"
+        parts.append(rawL)
+    text = "".join(parts)
+    if (newline is not None) and (newline != "\n"):
+        text = text.replace("\n", newline)
+    try:
+        data = text.encode(encoding)
+    except UnicodeEncodeError as ex:
+        line_start = text.rfind("\n", 0, ex.start) + 1
+        line_end = text.find("\n", ex.start)
+        if line_end < 0:
+            line_end = len(text)
+        echo0('\nError: Encoding "{}" failed:'
+              ''.format(text[line_start:line_end]))
+        raise
+    data, count = replace_faux_words(data)
+    if count:
+        echo1("  - replaced {} faux word(s)".format(count))
     with open(path, 'wb') as outs:
-        for rawL in lines:
-            if not rawL.endswith("\n"):
-                rawL += "\n"
-            try:
-                rawLB = rawL.encode(encoding)
-                for (fauxBytes, realBytes) in real_pairs:
-                    rawLB = rawLB.replace(fauxBytes, realBytes)
-                outs.write(rawLB)
-            except UnicodeEncodeError:
-                echo0('\nError: Encoding "{}" failed:'.format(rawL))
-                raise
+        if bom:
+            outs.write(bom)
+        outs.write(data)
     return True
 
 
 def find_non_whitespace(haystack, start, step=1):
     if step not in [-1, 1]:
         raise ValueError("step must be -1 or 1 not {}.".format(step))
-    i = start - step
-    while True:
-        i += step
-        if step < 1:
-            if i < 0:
-                break
-        else:
-            if i >= len(haystack):
-                break
-        if haystack[i].strip() == haystack[i]:
-            return i
-    return -1
+    if step < 0:
+        if start < 0:
+            return -1
+        return len(haystack[:start+1].rstrip()) - 1
+    match = _non_whitespace_rx.search(haystack, start)
+    if match is None:
+        return -1
+    return match.start()
 
 
 def find_whitespace(haystack, start, step=1):
     if step not in [-1, 1]:
         raise ValueError("step must be -1 or 1 not {}.".format(step))
-    i = start - step
-    while True:
-        i += step
-        if step < 1:
-            if i < 0:
-                break
-        else:
-            if i >= len(haystack):
-                break
-        if haystack[i].strip() != haystack[i]:
-            return i
-    return -1
+    if step < 0:
+        if start < 0:
+            return -1
+        match = _last_whitespace_rx.search(haystack, 0, start+1)
+    else:
+        match = _whitespace_rx.search(haystack, start)
+    if match is None:
+        return -1
+    return match.start()
 
 
 def insert_lines(path, new_lines, lines=None, after=None, before=None,
@@ -2544,9 +5505,11 @@ def insert_lines(path, new_lines, lines=None, after=None, before=None,
     if lines is None:
         if path is None:
             raise ValueError("You must specify a file and/or lines to modify.")
-        lines, got_encoding = try_readlines(path, encoding=encoding)
-        if got_encoding is not None:
-            encoding = got_encoding
+        loaded = load_text(path, encoding=encoding)
+        lines = loaded.lines
+        encoding = loaded.encoding
+        newline = loaded.newline
+        bom = loaded.bom
         do_save = True
     line_n = 0
 
@@ -2582,7 +5545,7 @@ def insert_lines(path, new_lines, lines=None, after=None, before=None,
         insert_i += 1
         lines.insert(insert_i, new_lines[i])
     if do_save:
-        write_lines(path, lines, encoding=encoding)
+        write_lines(path, lines, encoding=encoding, newline=newline, bom=bom)
     return True
 
 
@@ -2603,7 +5566,115 @@ def get_file_bom_encoding(filename):
     return ''
 
 
+# Read this many bytes to detect an encoding (See detect_encoding):
+ENCODING_SAMPLE_SIZE = 65536
+
+_BOM_ENCODINGS = (
+    # (BOM, encoding that reads the BOM, encoding after the BOM)
+    # UTF-32 first since BOM_UTF32_LE starts with BOM_UTF16_LE.
+    (codecs.BOM_UTF32_BE, "utf_32", "utf_32_be"),
+    (codecs.BOM_UTF32_LE, "utf_32", "utf_32_le"),
+    (codecs.BOM_UTF8, "utf_8_sig", "utf_8"),
+    (codecs.BOM_UTF16_BE, "utf_16", "utf_16_be"),
+    (codecs.BOM_UTF16_LE, "utf_16", "utf_16_le"),
+)
+
+# Try these (in order of preference if scores are equal) if the data is
+# not UTF-8:
+LEGACY_ENCODINGS = ("cp1252", "latin_1", "cp437")
+
+_high_bytes_rx = re.compile(b"[\x80-\xff]+")
+_typographic_chars = ("\u00a0©®°±µ·«»§¶½¼¾²³"
+                      "‘’‚“”„–—…•€™Ω")
+
+
+def _legacy_scores(high_bytes):
+    '''
+    Get a list of (score, -rank, encoding) for each LEGACY_ENCODINGS
+    that can decode high_bytes, where score is the fraction of the
+    decoded characters that are letters or common typographic marks
+    (not control characters or box drawing).
+    '''
+    results = []
+    for rank, encoding in enumerate(LEGACY_ENCODINGS):
+        try:
+            text = high_bytes.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+        good = 0
+        for c in text:
+            if c.isalpha() or (c in _typographic_chars):
+                good += 1
+        results.append((good / max(len(text), 1), -rank, encoding))
+    results.sort(reverse=True)
+    return results
+
+
+def detect_encoding_in_data(data, sample_size=ENCODING_SAMPLE_SIZE,
+                            final=True):
+    '''
+    Detect the encoding of bytes without decoding all of them in each
+    possible encoding: Check for a BOM, then try UTF-8 on a sample
+    starting at the first non-ASCII byte, then score LEGACY_ENCODINGS
+    (scoring all of the non-ASCII bytes only if the sample doesn't make
+    one of them the clear winner).
+
+    Sequential arguments:
+    data -- The bytes (or a bytearray or mmap) to check.
+
+    Keyword arguments:
+    sample_size -- How many bytes to check at first.
+    final -- Set to False if data is only the start of the file, so a
+        character cut off at the end of data isn't an error.
+
+    Returns:
+    a tuple of the encoding (such as "utf_8", "utf_8_sig", "utf_16",
+    "cp1252") and the confidence (from 0.0 to 1.0).
+    '''
+    for bom, encoding, body_encoding in _BOM_ENCODINGS:
+        if data[:len(bom)] == bom:
+            return encoding, 1.0
+    match = _high_bytes_rx.search(data)
+    if match is None:
+        return "utf_8", 1.0  # ASCII
+    start = match.start()
+    sample = data[start:start+sample_size]
+    decoder = codecs.getincrementaldecoder("utf_8")()
+    try:
+        # Only say the sample is invalid if a character is cut off
+        #   when there is no more data:
+        decoder.decode(sample,
+                       final=final and (start+sample_size >= len(data)))
+        return "utf_8", 0.99
+    except UnicodeDecodeError:
+        pass
+    high_bytes = b"".join(_high_bytes_rx.findall(sample))
+    scores = _legacy_scores(high_bytes)
+    if (start+sample_size < len(data)) and (len(scores) > 1) \
+            and (scores[0][0] - scores[1][0] < .1):
+        # The sample is ambiguous, so score all of the non-ASCII bytes.
+        high_bytes = b"".join(_high_bytes_rx.findall(data))
+        scores = _legacy_scores(high_bytes)
+    score, rank, encoding = scores[0]
+    return encoding, round(score * .9, 2)
+
+
+def detect_encoding(path, sample_size=ENCODING_SAMPLE_SIZE):
+    '''
+    Detect the encoding of a file by reading it once (For details and
+    the return, see detect_encoding_in_data).
+    '''
+    with open(path, 'rb') as stream:
+        data = stream.read()
+    return detect_encoding_in_data(data, sample_size=sample_size)
+
+
 def get_all_file_encodings(filename):
+    '''
+    Get a list of [encoding] for each encoding that can decode the whole
+    file (Slow: The file is decoded in each of about 100 encodings--to
+    get only the most likely one, use detect_encoding).
+    '''
     # from <https://stackoverflow.com/a/44405580>
     encoding_list = []
     encodings = ('utf_8', 'utf_16', 'utf_16_le', 'utf_16_be',
@@ -2643,12 +5714,364 @@ def get_all_file_encodings(filename):
 
 
 def get_file_encoding(filename):
-    # from <https://stackoverflow.com/a/44405580>
-    file_encoding = get_file_bom_encoding(filename)
-    if file_encoding != '':
-        return file_encoding
-    encoding_list = get_all_file_encodings(filename)
-    file_encoding = str(encoding_list[0][0])
-    if file_encoding[-3:] == '_be' or file_encoding[-3:] == '_le':
-        file_encoding = file_encoding[:-3]
+    '''
+    Get the most likely encoding of a file (See detect_encoding), except
+    "utf_8" if it has a UTF-8 BOM (as get_file_bom_encoding does).
+    '''
+    file_encoding, confidence = detect_encoding(filename)
+    if file_encoding == "utf_8_sig":
+        file_encoding = "utf_8"
     return file_encoding
+
+
+# Files at least this large are mapped into memory (See load_text):
+MMAP_MIN_SIZE = 16777216
+
+_newline_rx = re.compile(r"\r\n|\r|\n")
+
+
+class LoadedText(object):
+    '''
+    The contents of a text file (See load_text).
+
+    Properties
+    lines -- a list (or LineStore) of lines, each ending with "\\n"
+        (except the last line if the file doesn't end with a newline)
+        whatever the newline in the file is, as when reading in text
+        mode.
+    encoding -- the encoding that decoded the file, not counting the
+        BOM (such as "utf_8" rather than "utf_8_sig"), so it can be
+        passed to write_lines.
+    newline -- the newline at the end of the first line ("\\n", "\\r\\n",
+        or "\\r"), or None if there is only one line.
+    bom -- the BOM (bytes) at the start of the file, or b"" if none.
+    '''
+    __slots__ = ("lines", "encoding", "newline", "bom")
+
+    def __init__(self, lines, encoding, newline, bom):
+        self.lines = lines
+        self.encoding = encoding
+        self.newline = newline
+        self.bom = bom
+
+    def __repr__(self):
+        return ("LoadedText(<{} line(s)>, encoding={!r}, newline={!r},"
+                " bom={!r})".format(len(self.lines), self.encoding,
+                                    self.newline, self.bom))
+
+
+def load_text(path, encoding=None, line_store=False):
+    '''
+    Read a text file once (mapped into memory if it is at least
+    MMAP_MIN_SIZE bytes) and get its lines, encoding, newline, and BOM
+    from the same buffer.
+
+    Keyword arguments:
+    encoding -- Try this encoding first. If it can't decode the file
+        (or is None), use detect_encoding_in_data, then the
+        LEGACY_ENCODINGS that best fits the non-ASCII bytes. If the file
+        starts with a BOM, the encoding of the BOM is used instead.
+    line_store -- Get the lines as a read-only LineStore instead of a
+        list (to save memory for a large file that won't be changed).
+
+    Returns:
+    a LoadedText.
+    '''
+    echo1('- reading "{}"'.format(path))
+    with open(path, 'rb') as stream:
+        size = os.fstat(stream.fileno()).st_size
+        if (size > 0) and (size >= MMAP_MIN_SIZE):
+            data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = stream.read()
+    try:
+        return _load_text_data(data, encoding, line_store)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+
+def _load_text_data(data, encoding, line_store):
+    bom = b""
+    candidates = []
+    for this_bom, bom_encoding, body_encoding in _BOM_ENCODINGS:
+        if data[:len(this_bom)] == this_bom:
+            # The BOM says how the file is encoded, so it wins over
+            #   encoding (which may be only a default such as DEFAULT_CO
+            #   that happens to decode the body, such as UTF-16 as
+            #   UTF-8).
+            bom = this_bom
+            candidates.append(body_encoding)
+            break
+    else:
+        if encoding is not None:
+            candidates.append(encoding)
+        candidates.append(detect_encoding_in_data(data)[0])
+    whole = memoryview(data)
+    view = whole[len(bom):]
+    try:
+        text = None
+        for candidate in candidates:
+            try:
+                text = str(view, candidate)
+                encoding = candidate
+                break
+            except UnicodeDecodeError as ex:
+                echo1("  - encoding={} failed: {}".format(candidate, ex))
+        if text is None:
+            high_bytes = b"".join(_high_bytes_rx.findall(view))
+            encoding = _legacy_scores(high_bytes)[0][2]
+            text = str(view, encoding)
+    finally:
+        view.release()
+        whole.release()  # or else an mmap can't be closed
+    echo1("  - encoding={}".format(encoding))
+    newline = None
+    match = _newline_rx.search(text)
+    if match is not None:
+        newline = match.group()
+        if "\r" in text:
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+    if line_store:
+        return LoadedText(LineStore(text), encoding, newline, bom)
+    lines = text.split("\n")
+    last = lines.pop()
+    lines = [line + "\n" for line in lines]
+    if last:
+        lines.append(last)
+    return LoadedText(lines, encoding, newline, bom)
+
+
+# Read this many bytes at a time (See iter_lines):
+ITER_LINES_CHUNK_SIZE = 1048576
+
+
+def iter_lines(path, encoding=None, fallback_encoding="latin_1",
+               chunk_size=ITER_LINES_CHUNK_SIZE, fallbacks=None):
+    '''
+    Read a text file lazily, one chunk of bytes at a time through an
+    incremental decoder, so that memory use is bounded by chunk_size
+    (and the longest line) instead of the size of the file. The result
+    can be passed as lines to get_cdef, cdefs_to_d, LineScanner.scan,
+    iter_logical_lines, parse_calls, and IdentifierIndex.
+
+    Keyword arguments:
+    encoding -- The encoding, or None to detect it (See
+        detect_encoding_in_data) from the first chunk. If the file
+        starts with a BOM, the encoding of the BOM is used instead.
+    fallback_encoding -- If the rest of the file can't be decoded (such
+        as if the first chunk was ASCII but a later one isn't UTF-8),
+        decode the rest using this encoding.
+    chunk_size -- How many bytes to read at a time.
+    fallbacks -- If not None, append a (byte offset, encoding,
+        fallback_encoding) tuple to this list if decoding fails at that
+        offset and the rest of the file is decoded as
+        fallback_encoding.
+
+    Returns:
+    a generator of lines, each ending with "\\n" (except the last line
+    if the file doesn't end with a newline) whatever the newline in the
+    file is, as when reading in text mode.
+    '''
+    chunk_size = max(chunk_size, len(codecs.BOM_UTF32))  # Detect any BOM.
+    newline_decoder = io.IncrementalNewlineDecoder(None, True)
+    with open(path, 'rb') as stream:
+        chunk = stream.read(chunk_size)
+        for bom, bom_encoding, body_encoding in _BOM_ENCODINGS:
+            if chunk[:len(bom)] == bom:
+                encoding = bom_encoding  # See load_text.
+                break
+        if encoding is None:
+            encoding, confidence = detect_encoding_in_data(
+                chunk,
+                final=len(chunk) < chunk_size,
+            )
+            echo1('- reading "{}" (encoding={}, confidence={})'
+                  ''.format(path, encoding, confidence))
+        decoder = codecs.getincrementaldecoder(encoding)()
+        offset = 0  # of the start of chunk in the file
+        pending = ""
+        while True:
+            final = len(chunk) < chunk_size
+            if not final:
+                next_chunk = stream.read(chunk_size)
+                final = not next_chunk
+            try:
+                text = decoder.decode(chunk, final)
+            except UnicodeDecodeError as ex:
+                if encoding == fallback_encoding:
+                    raise
+                # The decoder still has any bytes before chunk that
+                #   were part of an unfinished character:
+                buffered, flag = decoder.getstate()
+                data = buffered + chunk
+                error_offset = offset - (len(data) - len(chunk)) + ex.start
+                echo0('Warning: "{}" is not {} at byte {}, so the rest'
+                      ' will be decoded as {}.'
+                      ''.format(path, encoding, error_offset,
+                                fallback_encoding))
+                if fallbacks is not None:
+                    fallbacks.append((error_offset, encoding,
+                                      fallback_encoding))
+                decoder.setstate((b"", flag))
+                text = decoder.decode(data[:ex.start], True)
+                encoding = fallback_encoding
+                decoder = codecs.getincrementaldecoder(encoding)()
+                text += decoder.decode(data[ex.start:], final)
+            parts = (pending + newline_decoder.decode(text, final)).split("\n")
+            pending = parts.pop()
+            for part in parts:
+                yield part + "\n"
+            if final:
+                break
+            offset += len(chunk)
+            chunk = next_chunk
+    if pending:
+        yield pending
+
+
+def _line_starts(buffer, newline):
+    '''
+    Get an array('Q') of the index where each line in buffer starts,
+    then len(buffer).
+    '''
+    if _use_numpy(len(buffer)):
+        if isinstance(buffer, str):
+            codes = _code_points(buffer)
+        else:
+            codes = numpy.frombuffer(buffer, dtype=numpy.uint8)
+        ends = numpy.flatnonzero(codes == ord(newline)) + 1
+        starts = array('Q', [0])
+        starts.frombytes(ends.astype(numpy.uint64).tobytes())
+    else:
+        starts = array('Q', [0])
+        find = buffer.find
+        index = find(newline)
+        while index > -1:
+            starts.append(index + 1)
+            index = find(newline, index + 1)
+    if starts[-1] != len(buffer):
+        starts.append(len(buffer))  # The last line has no newline.
+    return starts
+
+
+class LineStore(object):
+    '''
+    A read-only sequence of lines kept as one buffer and an array('Q')
+    of where each line starts (8 bytes per line instead of a str object
+    for each line). Pass it as lines to any function that only reads
+    lines (such as get_cdef, cdefs_to_d, or CLexedLines). Each line is
+    only made into a str when it is accessed. Slicing (with a step of
+    1) makes a LineStore that shares the buffer and starts.
+
+    Each line ends with "\\n" (except the last line if the text doesn't
+    end with a newline), as in the lines of a LoadedText.
+    '''
+    __slots__ = ("_buffer", "_starts", "_first", "_count")
+
+    def __init__(self, text, _starts=None, _first=0, _count=None):
+        '''
+        Sequential arguments:
+        text -- The text, where each newline is "\\n" (such as after
+            reading in text mode).
+        '''
+        if _starts is None:
+            _starts = _line_starts(text, "\n")
+        if _count is None:
+            _count = len(_starts) - 1
+        self._buffer = text
+        self._starts = _starts
+        self._first = _first
+        self._count = _count
+
+    @classmethod
+    def from_lines(cls, lines):
+        '''
+        Make a LineStore from a list (or any iterable) of lines.
+        '''
+        parts = []
+        for line in lines:
+            if parts and not parts[-1].endswith("\n"):
+                parts[-1] += "\n"
+            parts.append(line)
+        return cls("".join(parts))
+
+    def __len__(self):
+        return self._count
+
+    def _line(self, index):
+        starts = self._starts
+        return self._buffer[starts[index]:starts[index+1]]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._count)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            view = copy.copy(self)  # shares the buffer and starts
+            view._first = self._first + start
+            view._count = max(stop - start, 0)
+            return view
+        if index < 0:
+            index += self._count
+        if (index < 0) or (index >= self._count):
+            raise IndexError("line index out of range")
+        return self._line(self._first + index)
+
+    def __iter__(self):
+        line = self._line
+        for index in range(self._first, self._first + self._count):
+            yield line(index)
+
+    def __repr__(self):
+        return "{}(<{} line(s)>)".format(self.__class__.__name__,
+                                         self._count)
+
+
+class MappedLineStore(LineStore):
+    '''
+    A LineStore over the bytes of a file mapped into memory, for files
+    that are ASCII (or in another single-byte encoding) so that a line
+    can be decoded on its own. Lines ending with "\\r\\n" are read as
+    ending with "\\n" (a file with only "\\r" newlines is one line).
+
+    Close it (or use it in a with statement) when done.
+
+    Properties
+    encoding -- the encoding of each line.
+    '''
+    __slots__ = ("encoding", "_mmap")
+
+    def __init__(self, path, encoding="ascii"):
+        with open(path, 'rb') as stream:
+            if os.fstat(stream.fileno()).st_size > 0:
+                buffer = mmap.mmap(stream.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+            else:
+                buffer = b""  # An empty file can't be mapped.
+        self.encoding = encoding
+        self._mmap = buffer
+        LineStore.__init__(self, buffer, _starts=_line_starts(buffer, b"\n"))
+
+    def _line(self, index):
+        starts = self._starts
+        line = self._buffer[starts[index]:starts[index+1]].decode(
+            self.encoding
+        )
+        if line.endswith("\r\n"):
+            return line[:-2] + "\n"
+        return line
+
+    def close(self):
+        '''
+        Close the file (Views made by slicing can't be used after this).
+        '''
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
@@ -12,15 +12,28 @@ import os
 # import datetime
 import time
 from pycodetool.parsing import (
+    CTX_QUOTE_MARK,
+    CTX_QUOTED,
+    BracketIndex,
+    CodeView,
+    LineScanner,
     find_unquoted_not_commented,
     find_unquoted_even_commented,
     find_any_not,
+    find_first_in_code,
     find_identifier,
+    get_indent_string,
     find_unquoted_not_commented_not_parenthetical,
     identifier_chars,
+    identifier_and_dot_chars,
     is_identifier_valid,
     digit_chars,
     explode_unquoted,
+    load_text,
+)
+from pycodetool.tracing import (
+    get_trace_level,
+    trace,
 )
 # import re  # re.escape
 # ^ why doesn't it work (printing result shows backslash then actually
@@ -369,16 +382,12 @@ class PCTParser:
         # self.data = None
         self.file_path = infile_path
         # pre-process file (get symbol names)
-        infile = open(infile_path, 'r')
-        while True:
-            line_original = infile.readline()
-            if line_original:
-                line_original = line_original.strip("\n").strip("\r")
-                self.lines.append(line_original)
-            else:
-                # no more lines in file
-                break
-        infile.close()
+        loaded = load_text(infile_path)
+        for line_original in loaded.lines:
+            self.lines.append(line_original.rstrip("\n"))
+        if loaded.bom and self.lines:
+            # Keep the BOM at the start so the output file starts with it.
+            self.lines[0] = u"\ufeff" + self.lines[0]
         self.pstat(str(len(self.lines)) + " line(s) detected")
         # with open (infile_path, "r") as myfile:
         #     self.data=myfile.read()
@@ -433,6 +442,7 @@ class PCTParser:
         # (get only symbol names that are always available)
         if participle is not None:
             self.pstat(""+participle+"...")
+            trace_level = get_trace_level()
             line_index = 0
             lineN = 1
             class_indent_count = None
@@ -505,20 +515,29 @@ class PCTParser:
             sr_linevar = None
             sw_object = None
             one_indent = "    "
+            line_scanner = LineScanner(triple_quotes=[mlD])
+            # ^ Only mlD continues onto the next line (as before).
             while line_index < len(self.lines):
                 # self.pstat(""+participle+" line "+str(lineN)+"...")
+                if trace_level:
+                    trace("pct.line", parser_op=parser_op, lineN=lineN,
+                          line=self.lines[line_index])
                 line_original = self.lines[line_index]
                 line = line_original
                 line_strip = line.strip()
+                code = line_scanner.feed(line)
+                # ^ The mask is scanned once per line and knows whether
+                #   the line starts in a multiline string.
                 if not is_multiline_string:
                     if line_strip[:1] != "#":
                         mloi = line.find(mlD)
-                        inline_comment_delimiter = "#"
-                        ici = line.find(inline_comment_delimiter)
-                        if (mloi > -1) and ((ici < 0) or (mloi < ici)):
+                        while ((mloi > -1)
+                                and not (code.mask()[mloi] & CTX_QUOTE_MARK)):
+                            # ^ skip mlD if in a comment or other quote
+                            mloi = line.find(mlD, mloi+1)
+                        if mloi > -1:
                             is_multiline_string = True
-                            multiline_ender_index = line.find(mlD, mloi+len(mlD))
-                            if multiline_ender_index > -1:
+                            if line_scanner.in_quote != mlD:
                                 is_multiline_string = False
                                 self.pstat("line " + str(lineN)
                                            + ": (source notice) triple-"
@@ -704,10 +723,18 @@ class PCTParser:
                                 if (line_strip == "except , :"):
                                     line = indent + "except:"
                                     self.lines[line_index] = line
-                                if (fUNC(line, "except ") > -1) or (fUNC(line, "except:") > -1) or (fUNC(line, "finally:") > -1):
+                                code = CodeView(line)
+                                # ^ scan once for the fUNC calls below
+                                #   (line doesn't change in this case).
+                                exn_i, exn_which = find_first_in_code(
+                                    code,
+                                    ["except ", "except:", "finally:"],
+                                    allow_quoted=False,
+                                )
+                                if exn_i > -1:
                                     next_line_indent = None
                                     except_string = "except"
-                                    if (fUNC(line, "finally:") > -1):
+                                    if exn_which == 2:
                                         except_string = "finally"
                                     next_line_number = self.find_line_nonblank_noncomment(line_index+1)
                                     if next_line_number > -1:
@@ -725,7 +752,7 @@ class PCTParser:
                                 # class_name_thendot = ""
                                 # if class_name is not None:
                                 #     class_name_thendot = class_name + "."
-                                local_assn_op_index = fUNC(line, "=")
+                                local_assn_op_index = fUNC(code, "=")
                                 if local_assn_op_index > -1:
                                     identifier_last_index = find_any_not(line, " \t", start=local_assn_op_index-1, step=-1)
                                     # print("    local_assn_op_index-1:"+str(local_assn_op_index-1))
@@ -752,10 +779,10 @@ class PCTParser:
                                 if method_name == "__init__":
                                     if class_name is not None:
                                         member_opener = "self."
-                                        member_opener_index = fUNC(line, member_opener)
+                                        member_opener_index = fUNC(code, member_opener)
                                         if member_opener_index > -1:
                                             ao = "="
-                                            aoi = fUNC(line, ao, start=member_opener_index+len(member_opener))
+                                            aoi = fUNC(code, ao, start=member_opener_index+len(member_opener))
                                             if aoi > member_opener_index:
                                                 lparm = line[0:aoi].strip()
                                                 rparm = line[aoi+len(ao):]
@@ -774,7 +801,7 @@ class PCTParser:
                                     # global line
                                     # check for global variable
                                     ao = "="
-                                    aoi = fUNC(line, ao)
+                                    aoi = fUNC(code, ao)
                                     if aoi > -1:
                                         lparm = line[0:aoi].strip()
                                         rparm = line[aoi+len(ao):]
@@ -861,11 +888,11 @@ class PCTParser:
                                     sr_class = "StreamReader"
                                     sr_start = 0
                                     while True:
-                                        sr_class_index = find_identifier(line, sr_class)
+                                        sr_class_index = find_identifier(line, sr_class, start=sr_start)
                                         if sr_class_index > -1:
                                             nonspace_index = find_any_not(line, " \t", start=sr_class_index+len(sr_class))
                                             if (nonspace_index > -1) and (line[nonspace_index] == "("):
-                                                parenthetical_len = get_operation_chunk_len(line, start=nonspace_index, lineN=lineN)
+                                                parenthetical_len = BracketIndex(line).chunk_len(nonspace_index)
                                                 if parenthetical_len > 0:
                                                     line = line[:sr_class_index]+"open"+line[nonspace_index:nonspace_index+parenthetical_len-1]+", 'r')"
                                                     # input("found 'StreamReader and changed line to "+line+": press enter to continue")
@@ -896,7 +923,7 @@ class PCTParser:
                                         if sw_writeline_index > -1:
                                             # input("    DETECTED '"+sw_writeline+"' at "+str(sw_writeline_index)+" in '"+line+"'")
                                             sw_writeline_oparen_index = sw_writeline_index+len(sw_writeline)-1
-                                            sw_writeline_parenthetical_len = get_operation_chunk_len(line, start=sw_writeline_oparen_index, lineN=lineN)
+                                            sw_writeline_parenthetical_len = BracketIndex(line).chunk_len(sw_writeline_oparen_index)
                                             if (sw_writeline_parenthetical_len > 0) and (line[sw_writeline_oparen_index+sw_writeline_parenthetical_len-1] == ")"):
                                                 sw_params_index = sw_writeline_index+len(sw_writeline)
                                                 sw_params_ender_index = sw_writeline_oparen_index+sw_writeline_parenthetical_len-1
@@ -920,11 +947,11 @@ class PCTParser:
                                     sw_class = "StreamWriter"
                                     sw_start = 0
                                     while True:
-                                        sw_class_index = find_identifier(line, sw_class)
+                                        sw_class_index = find_identifier(line, sw_class, start=sw_start)
                                         if sw_class_index > -1:
                                             nonspace_index = find_any_not(line, " \t", start=sw_class_index+len(sw_class))
                                             if (nonspace_index > -1) and (line[nonspace_index] == "("):
-                                                parenthetical_len = get_operation_chunk_len(line, start=nonspace_index, lineN=lineN)
+                                                parenthetical_len = BracketIndex(line).chunk_len(nonspace_index)
                                                 if parenthetical_len > 0:
                                                     line = line[:sw_class_index]+"open"+line[nonspace_index:nonspace_index+parenthetical_len-1]+", 'r')"
                                                     # input("found 'StreamReader and changed line to "+line+": press enter to continue")
@@ -1049,12 +1076,13 @@ class PCTParser:
                                                     operand_lastchar_index = find_any_not(line, " \t", start=dot_index-1, step=-1)
                                                     if operand_lastchar_index > -1:
                                                         operand_ender_index = operand_lastchar_index + 1
-                                                        operand_len = get_operation_chunk_len(line, start=operand_lastchar_index, step=-1)
+                                                        brackets = BracketIndex(line)
+                                                        operand_len = brackets.chunk_len(operand_lastchar_index, step=-1)
                                                         operand_index = operand_ender_index-operand_len
                                                         operand = line[operand_index:operand_ender_index]
                                                         open_paren_index = fUNC(line, "(", start=fwts_index+len(fwts))
                                                         if open_paren_index > -1:
-                                                            fwts_params_len = get_operation_chunk_len(line, start=open_paren_index)
+                                                            fwts_params_len = brackets.chunk_len(open_paren_index)
                                                             if fwts_params_len > 0:
                                                                 fwts_params = line[open_paren_index:open_paren_index+fwts_params_len]
                                                                 fw_line = line
@@ -1067,10 +1095,10 @@ class PCTParser:
                                                                     self.pinfo("line "+str(lineN)+": (changing) using 'str' function instead of '.ToString'")
                                                             else:
                                                                 self.pserr("line "+str(lineN)+": (source ERROR) expected close parenthesis after ToString( at ["+str(fwts_index)+"]")
-                                                                start_index = ftws_index + len(fwts)
+                                                                start_index = fwts_index + len(fwts)
                                                         else:
                                                             self.pserr("line "+str(lineN)+": (source ERROR) expected open parenthesis after ToString( at ["+str(fwts_index)+"]")
-                                                            start_index = ftws_index + len(fwts)
+                                                            start_index = fwts_index + len(fwts)
                                                     else:
                                                         start_index = fwts_index + len(fwts)
                                                 else:
@@ -1089,7 +1117,8 @@ class PCTParser:
                                             if line[dot_index:dot_index+1] == ".":
                                                 oparen_index = fUNC(line, "(", fwss_index+len(fwss))
                                                 if oparen_index >= 0:
-                                                    cparen_index = fUNC(line, ")", oparen_index+1)
+                                                    cparen_index = BracketIndex(line).closer_of(oparen_index)
+                                                    # ^ the matching one (not the first)
                                                     if cparen_index >= 0:
                                                         params = explode_unquoted(line[oparen_index+1:cparen_index], ",")
                                                         parent_start_after_index = find_any_not(line[0:dot_index], identifier_chars, step=-1)
@@ -1117,9 +1146,8 @@ class PCTParser:
                                                 else:
 
                                                     self.pserr("line "+str(lineN)+": (source ERROR) expected '(' after "+fwss+" at ["+str(fwss_index)+"]")
-                                                    is_mega_debug = True
-                                                    oparen_index = fUNC(line, "(", fwss_index+len(fwss))
-                                                    is_mega_debug = False
+                                                    if trace_level:
+                                                        trace("pct.missing_oparen", lineN=lineN, line=line, start=fwss_index+len(fwss))
                                                     break
                                             else:
 
@@ -1274,7 +1302,9 @@ class PCTParser:
                     # end if not comment (nor multiline string)
                 else:
                     # continue or end multiline string
-                    multiline_ender_index = line.find(mlD)
+                    multiline_ender_index = code.mask().find(
+                        CTX_QUOTED | CTX_QUOTE_MARK
+                    )
                     if multiline_ender_index > -1:
                         is_multiline_string = False
                         if mlsName is not None:
@@ -1353,8 +1383,8 @@ class PCTParser:
         fUNC = find_unquoted_not_commented
         fUNCNP = find_unquoted_not_commented_not_parenthetical
         result = None
-        if index < len(lines):
-            line = lines[index]
+        if index < len(self.lines):
+            line = self.lines[index]
             # assign_op = " = "
             # aoi = self.fUNC(assign_op)
             assign_op = None
@@ -1384,26 +1414,28 @@ class PCTParser:
                     while any_delimiter:
                         any_delimiter = False
                         delimiter_index = -1
-                        arithmetic_operator = None
                         for oSetI in range(0, len(self.operator_sets)):
                             oList = self.operator_sets[oSetI]
-                            for operator_number in range(0, len(oList)):
+                            # Scan for the whole set at once (the
+                            #   first one wins since they have the
+                            #   same precedence):
+                            delimiter_index, operator_number = \
+                                find_first_in_code(tmpRParm, oList,
+                                                   allow_quoted=False)
+                            if delimiter_index >= 0:
                                 op = oList[operator_number]
-                                oi = fUNC(tmpRParm, op)
-                                if delimiter_index >= 0:
-                                    operand = tmpRParm[0:oi].strip()
-                                    tmpRParm = tmpRParm[oi+len(op):]
-                                    if len(operand) > 0:
-                                        rparmParts.append(
-                                            operand
-                                        )
-                                        self.pstat(
-                                            "  found operand: "
-                                            + operand
-                                        )
-                                    break
-                                else:
-                                    arithmetic_operator = None
+                                oi = delimiter_index
+                                operand = tmpRParm[0:oi].strip()
+                                tmpRParm = tmpRParm[oi+len(op):]
+                                if len(operand) > 0:
+                                    rparmParts.append(
+                                        operand
+                                    )
+                                    self.pstat(
+                                        "  found operand: "
+                                        + operand
+                                    )
+                                break
                         if delimiter_index >= 0:
                             any_delimiter = True
                     # append last part of it (after last
@@ -1413,13 +1445,13 @@ class PCTParser:
                 elif strip_assign_op_index == 0:
 
                     self.pserr(
-                        "line " + str(line_index+1) + ": (source ERROR)"
+                        "line " + str(index+1) + ": (source ERROR)"
                         " unexpected assignment operator (expected"
                         " identifier first) at [" + str(aoi)
                         + "] (before identifier)"
                     )
                 else:
-                    self.pperr("line " + str(line_index+1)
+                    self.pperr("line " + str(index+1)
                                + ": (parsing error)"
                                " expected assignment"
                                " operator")
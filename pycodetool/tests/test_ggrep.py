@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from contextlib import redirect_stdout
+
+my_dir = os.path.dirname(os.path.abspath(__file__))
+module_dir = os.path.dirname(my_dir)
+repo_dir = os.path.dirname(module_dir)
+
+if __name__ == "__main__":
+    sys.path.insert(0, repo_dir)
+
+from pycodetool import (
+    echo0,
+)
+
+from pycodetool.ggrep import (
+    ggrep,
+    ggrep_file,
+    iter_source_paths,
+    main,
+)
+
+
+class TestGGrep(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, sub_path, data):
+        path = os.path.join(self.tmp_dir, sub_path)
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        with open(path, 'wb') as stream:
+            stream.write(data)
+        return path
+
+    def run_main(self, *args):
+        old_argv = sys.argv
+        sys.argv = ["ggrep"] + list(args)
+        out = io.StringIO()
+        try:
+            with redirect_stdout(out):
+                code = main()
+        finally:
+            sys.argv = old_argv
+        return code, out.getvalue()
+
+    def test_iter_source_paths(self):
+        a_path = self.write("a.py", b"x\n")
+        b_path = self.write(os.path.join("sub", "b.py"), b"x\n")
+        hidden_path = self.write(os.path.join(".git", "c.py"), b"x\n")
+        dot_path = self.write(".d.py", b"x\n")
+        self.assertEqual(list(iter_source_paths(self.tmp_dir)),
+                         [a_path, b_path])
+        self.assertEqual(
+            list(iter_source_paths(self.tmp_dir, include_hidden=True)),
+            [dot_path, hidden_path, a_path, b_path],
+        )
+        # A file is yielded even if it is hidden since it was requested:
+        self.assertEqual(list(iter_source_paths(dot_path)), [dot_path])
+
+    def test_ggrep_file(self):
+        py_path = self.write("a.py", b"x = 'x'  # x\nx\n")
+        self.assertEqual(
+            ggrep_file((py_path, "x", None, False, False)),
+            [(1, 0, "x = 'x'  # x"), (2, 0, "x")],
+        )
+        # An unknown language is searched as plain text so an apostrophe
+        #   or "#" doesn't hide a match:
+        txt_path = self.write("b.txt", b"don't x\n# x\n")
+        self.assertEqual(
+            ggrep_file((txt_path, "x", None, False, False)),
+            [(1, 6, "don't x"), (2, 2, "# x")],
+        )
+        self.assertEqual(
+            ggrep_file((txt_path, "x", "python", False, False)),
+            [],
+        )
+        bin_path = self.write("c.py", b"x = 1\n\0x")
+        self.assertEqual(ggrep_file((bin_path, "x", None, False, False)),
+                         [])
+
+    def test_ggrep_order(self):
+        paths = []
+        for index in range(40):
+            paths.append(self.write("{:02}.py".format(index),
+                                    b"x\n" * (40 - index)))
+        hits = list(ggrep("x", [self.tmp_dir], processes=4))
+        self.assertEqual(
+            hits,
+            [(path, line_n, 0, "x") for index, path in enumerate(paths)
+             for line_n in range(1, 41 - index)],
+        )
+
+    def test_main(self):
+        path = self.write("a.py", b"found = 1\n")
+        code, out = self.run_main("found", self.tmp_dir, "--jobs", "1")
+        self.assertEqual(code, 0)
+        self.assertEqual(out, 'geany "{}" -l 1  # found = 1\n'.format(path))
+        self.assertEqual(self.run_main("missing", path)[0], 1)
+        self.assertEqual(self.run_main("found", path, "--bad")[0], 1)
+        self.assertEqual(
+            self.run_main("found", os.path.join(self.tmp_dir, "no.py"))[0],
+            1,
+        )
+        self.assertEqual(self.run_main("found", path, "--jobs")[0], 1)
+        self.assertEqual(self.run_main("found", path, "--jobs", "x")[0], 1)
+        self.assertEqual(
+            self.run_main("found", path, "--language", "cobol")[0],
+            1,
+        )
+        self.assertEqual(self.run_main()[0], 1)
+
+
+if __name__ == "__main__":
+    testcase = TestGGrep()
+    for name in dir(testcase):
+        if name.startswith("test"):
+            echo0()
+            echo0("Running {}...".format(name))
+            testcase.setUp()
+            try:
+                getattr(testcase, name)()
+            finally:
+                testcase.tearDown()
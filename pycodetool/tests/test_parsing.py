@@ -5,10 +5,23 @@ Created on Tue Jul 19 18:29:39 2022
 @author: Jake "Poikilos" Gustafson
 """
 
+import codecs
+import pickle
+import shutil
+import tempfile
 import unittest
 import sys
 import os
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 my_dir = os.path.dirname(os.path.abspath(__file__))
 module_dir = os.path.dirname(my_dir)
 repo_dir = os.path.dirname(module_dir)
@@ -23,6 +36,7 @@ from pycodetool import (
     set_verbosity,
 )
 
+from pycodetool import parsing
 from pycodetool.parsing import (
     quoted_slices,
     get_quoted_slices_error,
@@ -38,6 +52,66 @@ from pycodetool.parsing import (
     slice_is_space,
     isnumber,
     explode_unquoted,
+    CodeView,
+    find_in_code,
+    find_first_in_code,
+    LineScanner,
+    LanguageProfile,
+    get_profile,
+    cached_searches,
+    get_search_cache,
+    BracketIndex,
+    get_operation_chunk_len,
+    IdentifierIndex,
+    find_identifier,
+    iexplode_unquoted,
+    parse_calls,
+    SliceSet,
+    iquoted_slices,
+    find_slice,
+    find_all_slices,
+    compile_pattern,
+    find_any_not,
+    find_whitespace,
+    find_non_whitespace,
+    get_indent_string,
+    indent_widths,
+    is_identifier_valid,
+    find_dup,
+    find_all_dups,
+    read_conf_file,
+    get_dict_modified_by_conf_file,
+    get_entries_modified_count,
+    set_numpy_min_length,
+    NUMPY_MIN_LENGTH,
+    search_file_in_code,
+    iter_logical_lines,
+    CLexedLines,
+    COMMENTED_DEF_WARNING,
+    block_uncomment_line,
+    cdefs_to_d,
+    get_cdef,
+    set_cdef,
+    detect_encoding,
+    detect_encoding_in_data,
+    load_text,
+    write_lines,
+    iter_lines,
+    LineStore,
+    MappedLineStore,
+    get_faux_word_counts,
+    register_faux_word,
+    replace_faux_words,
+    unregister_faux_word,
+)
+from pycodetool.tracing import (
+    TRACE_CALLS,
+    TRACE_OFF,
+    TRACE_STEPS,
+    collect_traces,
+    get_trace_level,
+    set_trace_level,
+    to_trace_level,
 )
 
 
@@ -481,6 +555,730 @@ class TestParsing(unittest.TestCase):
         self.assertEqual(parts[2], "'#d")
         self.assertEqual(parts[3], "#e'")
 
+    def test_code_view(self):
+        samples = [
+            "x = (i + a) + a # a",
+            'x = "a" + (i + a) + a # a',
+            'x = \'\\\'\' + a + (i + a) + \"a\" # a',
+            '<a href="#b" #a #b>',
+        ]
+        for sample in samples:
+            code = CodeView(sample)
+            for enclosures in (None, ["()"]):
+                for allow_quoted in (True, False):
+                    self.assertEqual(
+                        find_in_code(code, "a", enclosures=enclosures,
+                                     allow_quoted=allow_quoted),
+                        find_in_code(sample, "a", enclosures=enclosures,
+                                     allow_quoted=allow_quoted),
+                        "{} enclosures={} allow_quoted={}".format(
+                            sample, enclosures, allow_quoted),
+                    )
+            self.assertEqual(find_unquoted_even_commented(code, "b"),
+                             find_unquoted_even_commented(sample, "b"))
+        code = CodeView("x = (i + a) + a # a")
+        self.assertEqual(
+            find_unquoted_not_commented_not_parenthetical(code, "a",
+                                                          step=-1),
+            14,
+        )
+        # Unlike a plain string, the context comes from the whole
+        # string, so a reverse search skips the escaped quote:
+        code = CodeView('x = \'\\\'a\' + (i + a) + "a" # a')
+        self.assertEqual(
+            find_unquoted_not_commented_not_parenthetical(code, "a",
+                                                          step=-1),
+            -1,
+        )
+
+    def test_find_first_in_code(self):
+        line = 'try: print("finally:")  # except:'
+        needles = ["except:", "finally:", "print"]
+        self.assertEqual(find_first_in_code(line, needles), (5, 2))
+        self.assertEqual(find_first_in_code(line, needles[:2]), (12, 1))
+        self.assertEqual(
+            find_first_in_code(line, needles[:2], allow_quoted=False),
+            (-1, -1),
+        )
+        self.assertEqual(
+            find_first_in_code(line, needles, allow_commented=True,
+                               step=-1),
+            (26, 0),
+        )
+        # The first needle wins if more than one starts at the index:
+        self.assertEqual(find_first_in_code("a == b", ["=", "=="]),
+                         (2, 0))
+        self.assertEqual(find_first_in_code("f(a) + a", ["a", "+"],
+                                            enclosures=["()"]),
+                         (5, 1))
+        code = CodeView(line)
+        for start in range(len(line)):
+            for needle_i in range(len(needles)):
+                self.assertEqual(
+                    find_first_in_code(code, needles[needle_i:needle_i+1],
+                                       start=start)[0],
+                    find_in_code(code, needles[needle_i], start=start),
+                )
+
+    def test_tracing(self):
+        level = get_trace_level()
+        with collect_traces(TRACE_CALLS) as records:
+            self.assertEqual(find_in_code("a = b", "="), 2)
+        self.assertEqual(
+            [record[0] for record in records],
+            ["find_in_code", "find_in_code.result"],
+        )
+        self.assertEqual(records[1][1], {'result': 2})
+        with collect_traces() as records:
+            explode_unquoted("a, 'b,c'", ",")
+        self.assertIn("explode_unquoted.step",
+                      [record[0] for record in records])
+        self.assertEqual(get_trace_level(), level)
+
+    def test_trace_level_values(self):
+        # set_trace_level must accept anything PYCODETOOL_TRACE does.
+        for value, expected in (("", TRACE_OFF), ("0", TRACE_OFF),
+                                ("true", TRACE_CALLS), ("2", TRACE_STEPS),
+                                ("9", TRACE_STEPS), (-1, TRACE_OFF),
+                                (TRACE_CALLS, TRACE_CALLS)):
+            self.assertEqual(to_trace_level(value), expected)
+        with collect_traces(TRACE_OFF):
+            set_trace_level("true")
+            self.assertGreaterEqual(get_trace_level(), TRACE_CALLS)
+        self.assertRaises(ValueError, set_trace_level, 1.5)
+
+    def test_line_scanner(self):
+        lines = [
+            'x = """a = b # c\n',
+            'd = (e\n',
+            '""" + f(g,\n',
+            '  h = 1) # i = 2\n',
+            '"j = \\\n',
+            'k" = l\n',
+        ]
+        scanner = LineScanner(enclosures=["()"])
+        codes = list(scanner.scan(lines))
+        self.assertEqual(find_in_code(codes[0], "="), 2)
+        self.assertEqual(find_unquoted_not_commented(codes[0], "=", start=3),
+                         -1)
+        self.assertEqual(find_in_code(codes[1], "=", allow_quoted=False),
+                         -1)
+        self.assertEqual(codes[2].openers, ())
+        self.assertEqual(codes[3].openers, ("(",))
+        self.assertEqual(
+            find_unquoted_not_commented_not_parenthetical(codes[3], "="),
+            -1,
+        )
+        self.assertEqual(find_unquoted_not_commented(codes[3], "="), 4)
+        self.assertEqual(find_unquoted_not_commented(codes[5], "="), 3)
+        self.assertEqual(scanner.get_state(), (None, None, ()))
+        self.assertEqual(scanner.unclosed_quote_lines, [])
+
+        scanner = LineScanner(comment_delimiters=["//"],
+                              block_comments=[("/*", "*/")])
+        codes = list(scanner.scan(["a /* b = 1;\n", "c */ d = 2;\n"]))
+        self.assertEqual(find_in_code(codes[0], "="), -1)
+        self.assertEqual(find_in_code(codes[1], "="), 7)
+
+    def test_language_profile(self):
+        python = get_profile("python")
+        self.assertEqual(
+            find_unquoted_not_commented('x = "a" # =', "=",
+                                        start=3, profile=python),
+            -1,
+        )
+        self.assertEqual(find_in_code('f("=") = 1', "=", profile="python",
+                                      allow_quoted=False,
+                                      enclosures=["()"]),
+                         7)
+        line = 'f(a /* , */, "b, c"); // d, e'
+        self.assertEqual(explode_unquoted(line, ",", profile="c"),
+                         ['f(a /* , */', '"b, c");'])
+        self.assertEqual(quoted_slices(line, profile="cpp"), [(13, 19)])
+        self.assertEqual(quoted_slices('a """b"c""" # "d"', profile=python),
+                         [(2, 11)])
+        self.assertEqual(pickle.loads(pickle.dumps(python)), python)
+        with self.assertRaises(AttributeError):
+            python.comment_delimiters = ("//",)
+        with self.assertRaises(ValueError):
+            LanguageProfile("bad", quote_marks=['""'])
+        with self.assertRaises(ValueError):
+            get_profile("cobol")
+        # Profiles made from the custom rule arguments are reused:
+        self.assertIs(CodeView("a").profile, CodeView("b = 1").profile)
+        self.assertIs(CodeView("a", comment_delimiters=["//"]).profile,
+                      CodeView("b", comment_delimiters=("//",)).profile)
+        self.assertIsNot(CodeView("a").profile,
+                         CodeView("a", comment_delimiters=["//"]).profile)
+
+    def test_cached_searches(self):
+        self.assertIsNone(get_search_cache())
+        with cached_searches(maxsize=2) as cache:
+            self.assertIs(get_search_cache(), cache)
+            line = 'x = "=" # ='
+            self.assertEqual(find_unquoted_not_commented(line, "="), 2)
+            self.assertEqual(find_unquoted_not_commented(line, "="), 2)
+            self.assertEqual(find_in_code(line, "=", start=3), 5)
+            self.assertEqual(find_unquoted_even_commented(line, "="), 2)
+            self.assertEqual(cache.info(), {
+                'hits': 1,
+                'misses': 3,
+                'evictions': 1,
+                'size': 2,
+                'maxsize': 2,
+            })
+        self.assertIsNone(get_search_cache())
+
+    def test_bracket_index(self):
+        line = 'x = a.b(c[")"], {d: (e)}).f + "g(" + h'
+        brackets = BracketIndex(line)
+        self.assertEqual(brackets.closer_of(7), 24)
+        self.assertEqual(brackets.opener_of(24), 7)
+        self.assertEqual(brackets.closer_of(9), 13)
+        self.assertEqual(brackets.closer_of(16), 23)
+        self.assertEqual(brackets.closer_of(11), -1)  # quoted
+        for start in [4, 7, 9, 16, 30, 37]:
+            self.assertEqual(brackets.chunk_len(start),
+                             get_operation_chunk_len(line, start))
+        for start in [6, 13, 24, 26, 33, 37]:
+            self.assertEqual(brackets.chunk_len(start, step=-1),
+                             get_operation_chunk_len(line, start, step=-1))
+        self.assertEqual(line[7:7+brackets.chunk_len(7)],
+                         '(c[")"], {d: (e)}).f')
+        # A closer that doesn't match the innermost opener is ignored:
+        brackets = BracketIndex("([)]")
+        self.assertEqual(brackets.closer_of(0), -1)
+        self.assertEqual(brackets.closer_of(1), 3)
+        self.assertEqual(brackets.opener_of(2), 0)
+
+    def test_identifier_index(self):
+        lines = [
+            'import sys\n',
+            'sys.stdout.write("sys")  # sys\n',
+            'x = """\n',
+            'sys\n',
+            '""" + sys2.y + a.sys.stdout\n',
+        ]
+        index = IdentifierIndex(lines)
+        self.assertEqual(index.positions("sys"), [(0, 7), (1, 0), (4, 17)])
+        self.assertEqual(index.count("stdout"), 2)
+        self.assertEqual(index.positions("sys.stdout"), [(1, 0)])
+        self.assertEqual(index.positions("sys.stdout.write.x"), [])
+        self.assertEqual(index.names_with_prefix("sys"), ["sys", "sys2"])
+        self.assertNotIn("write2", index)
+        self.assertEqual(find_identifier("sys2.y + a.sys", "sys"), 11)
+        self.assertEqual(find_identifier(lines[1], "sys", start=1), -1)
+
+    def test_iexplode_unquoted(self):
+        line = 'a, "b, c", d # e, f'
+        parts = iexplode_unquoted(line, ",")
+        self.assertEqual(next(parts), ("a", 0, 1))
+        self.assertEqual(next(parts), ('"b, c"', 2, 9))
+        self.assertEqual(list(parts), [("d", 10, 13)])
+        self.assertEqual(
+            list(iexplode_unquoted(line, ",", strip=False,
+                                   allow_commented=True)),
+            [("a", 0, 1), (' "b, c"', 2, 9), (" d # e", 10, 16),
+             (" f", 17, 19)],
+        )
+        # A triple quote ends splitting (as in explode_unquoted):
+        self.assertEqual(explode_unquoted('a, """b, c""", d', ","),
+                         ["a", '"""b, c""", d'])
+
+    def test_parse_calls(self):
+        abstractfn = AbstractFn('f(a, g(")")) + 1')
+        self.assertEqual(abstractfn.after, " + 1")
+        self.assertEqual(abstractfn.raw_params, ["a", ' g(")")'])
+        self.assertEqual(abstractfn.raw_params_slices, [(2, 3), (4, 11)])
+        self.assertFalse(hasattr(abstractfn, "__dict__"))
+        abstractfn.raw_params = ["b"]
+        self.assertIsNone(abstractfn.raw_params_slices)
+        self.assertEqual(abstractfn.raw_params, ["b"])
+        abstractfn = AbstractFn('f(a, b)')
+        abstractfn.set_param(0, "c")
+        self.assertIsNone(abstractfn.raw_params_slices)
+        bare = AbstractFn("a, b", allow_bare_args=True)
+        self.assertEqual(bare.raw_params, ["a", " b"])
+        self.assertEqual(bare.after, "")
+        lines = [
+            'connect("localhost", user)',
+            "# not a call",
+            "x = 1",
+            "  close()",
+        ]
+        calls = parse_calls(lines)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls.names, ["connect", "close"])
+        self.assertEqual(list(calls.line_indices), [0, 3])
+        self.assertEqual(list(calls.counts), [2, 0])
+        self.assertEqual(calls.params(0), ['"localhost"', " user"])
+        self.assertEqual(calls.param_slices(0), [(8, 19), (20, 25)])
+        # A trailing comma splits the same way for a string and for a
+        #   LogicalLine (or CodeView), as in explode_unquoted:
+        for line, params in (("x = f(a,)\n", ["a"]),
+                             ("x = f(,)\n", [""]),
+                             ("x = f(a, )\n", ["a", " "])):
+            string_calls = parse_calls([line])
+            logical_calls = parse_calls(iter_logical_lines([line]))
+            self.assertEqual(list(string_calls.counts), [len(params)])
+            self.assertEqual(list(logical_calls.counts), [len(params)])
+            self.assertEqual(logical_calls.names, string_calls.names)
+            self.assertEqual(string_calls.params(0), params)
+            self.assertEqual(logical_calls.params(0), params)
+            call = line[4:].strip()
+            self.assertEqual(AbstractFn(CodeView(call)).raw_params, params)
+            self.assertEqual(AbstractFn(call).raw_params, params)
+        self.assertEqual(calls.params(1), [])
+
+    def test_slice_set(self):
+        line = 'a = "b" + \'c\' # "d"'
+        slices = quoted_slices(line)
+        self.assertIsInstance(slices, SliceSet)
+        self.assertEqual(slices, [(4, 7), (10, 13)])
+        self.assertEqual(list(iquoted_slices(line)), [(4, 7), (10, 13)])
+        self.assertEqual([i for i in range(len(line)) if i in slices],
+                         [4, 5, 6, 10, 11, 12])
+        self.assertEqual(which_slice(11, slices), 1)
+        self.assertEqual(which_slice(7, slices), -1)
+        self.assertTrue((10, 13) in slices)
+        self.assertEqual(slices[1], (10, 13))
+        other = SliceSet([(12, 20), (0, 2), (1, 5)])
+        self.assertEqual(other, [(0, 5), (12, 20)])
+        self.assertEqual(slices | other, [(0, 7), (10, 20)])
+        self.assertEqual(slices & other, [(4, 5), (12, 13)])
+        # Adjacent slices (such as two quoted strings) stay separate:
+        self.assertEqual(len(SliceSet([(3, 6), (0, 3)])), 2)
+        self.assertEqual(SliceSet([(-3, -1)], length=10), [(7, 9)])
+        with self.assertRaises(ValueError):
+            SliceSet([(-3, -1)])
+        # which_slice uses the normalized values for negative indices:
+        self.assertEqual(which_slice(8, [(-3, -1)], length=10), 0)
+
+    def test_find_all_slices(self):
+        line = "f(a) + g(b, c) + (d)"
+        self.assertEqual(find_slice(line, "(", ")"), (1, 4))
+        self.assertEqual(find_slice(line, "(", ")", start=5), (8, 14))
+        self.assertEqual(find_slice(line, "(", ")", start=5, endbefore=12),
+                         (-1, -1))
+        self.assertEqual(list(find_all_slices(line, "(", ")")),
+                         [(1, 4), (8, 14), (17, 20)])
+        self.assertEqual(list(find_all_slices(line, "(", ")", start=2,
+                                              endbefore=19)),
+                         [(8, 14)])
+        self.assertIs(compile_pattern(r"\s+"), compile_pattern(r"\s+"))
+
+    def test_char_class_primitives(self):
+        line = "\t  a.b c  "
+        self.assertEqual(find_any_not(line, " \t"), 3)
+        self.assertEqual(find_any_not(line, " \t", step=-1), 7)
+        self.assertEqual(find_any_not(line, [" ", "c"], start=8, step=-1), 5)
+        self.assertEqual(find_non_whitespace(line, 4), 4)
+        self.assertEqual(find_non_whitespace(line, 9, step=-1), 7)
+        self.assertEqual(find_whitespace(line, 3), 6)
+        self.assertEqual(find_whitespace(line, 5, step=-1), 2)
+        self.assertEqual(find_whitespace("abc", 2, step=-1), -1)
+        self.assertEqual(get_indent_string(line), "\t  ")
+        self.assertEqual(get_indent_string(" \t "), "")
+        self.assertTrue(is_identifier_valid("a.b_1", True))
+        self.assertFalse(is_identifier_valid("a.b_1", False))
+        self.assertFalse(is_identifier_valid("", False))
+        widths = indent_widths(["a", "    b", "\t\tc", "   ", "  \n"])
+        self.assertEqual(widths.typecode, "H")
+        self.assertEqual(list(widths), [0, 4, 2, 0, 2])
+
+    def test_find_all_dups(self):
+        symbols = ["a", " b", "1", "c", "b ", None, "a", None, "1", ""]
+        self.assertEqual(find_dup(symbols), 6)
+        self.assertEqual(find_all_dups(symbols), [[0, 6], [1, 4], [2, 8]])
+        self.assertEqual(find_all_dups(symbols, ignore_list=["a"],
+                                       ignore_numbers_enable=True),
+                         [[1, 4]])
+        self.assertEqual(
+            find_all_dups(symbols,
+                          discard_whitespace_ignore_None_enable=False),
+            [[0, 6], [2, 8], [5, 7]],
+        )
+        self.assertEqual(find_dup(["a", "b"]), -1)
+
+    def test_results_in_threads(self):
+        lines = []
+        for i in range(200):
+            if i % 3 == 0:
+                lines.append('x{} = "a" + \'b'.format(i))  # not closed
+            else:
+                lines.append('x{} = "a" + "{}" # "c"'.format(i, i))
+
+        def slices_and_error(line):
+            slices = quoted_slices(line)
+            return list(slices), slices.error, get_quoted_slices_error()
+
+        expected = [slices_and_error(line) for line in lines]
+        self.assertEqual(expected[0][1], END_BEFORE_QUOTE_ERR)
+        self.assertEqual(expected[1][1], None)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for _ in range(5):
+                got = list(executor.map(slices_and_error, lines))
+                self.assertEqual(got, expected)
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            paths = []
+            for i in range(40):
+                path = os.path.join(tmp_dir, "{}.conf".format(i))
+                with open(path, 'w') as stream:
+                    for n in range(i % 4):
+                        stream.write("key{}={}\n".format(n, n))
+                paths.append(path)
+
+            def read(path):
+                results = get_dict_modified_by_conf_file({}, path)
+                return read_conf_file({}, path), (
+                    results, get_entries_modified_count())
+
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                got = list(executor.map(read, paths))
+            for i, (returned, shim) in enumerate(got):
+                self.assertEqual(returned[1], i % 4)
+                self.assertEqual(shim, returned)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_numpy_scan(self):
+        line = ('x = "a, \\"b" + f(\'(\', """c""") # "d" ' * 50) + "'e"
+        cases = []
+        for min_length in (None, 0):
+            set_numpy_min_length(min_length)
+            try:
+                code = CodeView(line)
+                slices = quoted_slices(line)
+                cases.append((
+                    bytes(code.mask()),
+                    code.end_state(),
+                    code.find("f", step=-1),
+                    code.find(",", start=10, enclosures=["()"],
+                              allow_quoted=False),
+                    list(slices),
+                    slices.error,
+                    quoted_slices(line, profile="sh"),
+                ))
+            finally:
+                set_numpy_min_length(NUMPY_MIN_LENGTH)
+        self.assertEqual(cases[0], cases[1])
+        self.assertIsNone(cases[0][5])  # since the comment ends the search
+        self.assertEqual(len(cases[0][4]), 5)  # """c""" is 3 here
+
+    def test_search_file_in_code(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, "a.py")
+            with open(path, 'w') as stream:
+                stream.write('x = 1  # x\n'
+                             '"""\n'
+                             'x in a docstring\n'
+                             '"""\n'
+                             'print("x", x, x)\n'
+                             '# x\n'
+                             '\n'
+                             'yx')
+            expected = [(1, 0), (5, 11), (5, 14), (8, 1)]
+            for chunk_size in (1, 7, 1048576):
+                self.assertEqual(
+                    list(search_file_in_code(path, "x",
+                                             chunk_size=chunk_size)),
+                    expected,
+                )
+            self.assertEqual(
+                list(search_file_in_code(path, "x", allow_commented=True,
+                                         allow_quoted=True))[:4],
+                [(1, 0), (1, 9), (3, 0), (5, 7)],
+            )
+            # A line longer than chunk_size is lexed in parts, carrying
+            #   the quote and comment state (and needles) across them:
+            long_path = os.path.join(tmp_dir, "long.py")
+            with open(long_path, 'w') as stream:
+                stream.write('f("xy" + xy, \'a\\\'xy\') + xy  # xy "\nxy\n')
+            long_expected = [(1, 9), (1, 24), (2, 0)]
+            for chunk_size in (1, 2, 5, 1048576):
+                self.assertEqual(
+                    list(search_file_in_code(long_path, "xy",
+                                             chunk_size=chunk_size)),
+                    long_expected,
+                )
+                self.assertEqual(
+                    list(search_file_in_code(long_path, "xy",
+                                             chunk_size=chunk_size,
+                                             allow_quoted=True,
+                                             allow_commented=True,
+                                             include_line=True))[-2:],
+                    [(1, 30, 'f("xy" + xy, \'a\\\'xy\') + xy  # xy "'),
+                     (2, 0, "xy")],
+                )
+            empty_path = os.path.join(tmp_dir, "empty.py")
+            with open(empty_path, 'w') as stream:
+                pass
+            self.assertEqual(list(search_file_in_code(empty_path, "x")), [])
+            self.assertEqual(
+                list(search_file_in_code([empty_path, path], "x",
+                                         processes=2)),
+                [(path,) + hit for hit in expected],
+            )
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_iter_logical_lines(self):
+        lines = [
+            "x = 1\n",
+            "connect(host,  # (not closed here\n",
+            "        'a, b)',\n",
+            "        port)\n",
+            "y = 2 + \\\n",
+            "    3  # \\\n",
+            '"""a\n',
+            '(b"""\n',
+        ]
+        logical_lines = list(iter_logical_lines(lines))
+        self.assertEqual([line.line_index for line in logical_lines],
+                         [0, 1, 4, 6])
+        self.assertEqual([line.line_count for line in logical_lines],
+                         [1, 3, 2, 2])
+        call = logical_lines[1]
+        self.assertEqual(call.text, "".join(lines[1:4]).rstrip("\n"))
+        self.assertEqual(call.to_physical(call.text.find("port")), (3, 8))
+        self.assertEqual(call.to_physical(0), (1, 0))
+        abstractfn = AbstractFn(call)
+        self.assertEqual(abstractfn.line_n, 2)
+        self.assertEqual(abstractfn.name, "connect")
+        self.assertEqual([param.strip() for param in abstractfn.raw_params],
+                         ["host", "# (not closed here\n        'a, b)'",
+                          "port"])
+        self.assertEqual(find_unquoted_not_commented(call.code, "port"),
+                         call.text.find("port"))
+        calls = parse_calls(logical_lines)
+        self.assertEqual(calls.names, ["connect"])
+        self.assertEqual(list(calls.counts), [3])
+        # line_indices are positions in lines, even after a line that
+        #   was continued with a backslash:
+        lines = [
+            "a = 1 + \\\n",
+            "    2\n",
+            "f(a)\n",
+        ]
+        calls = parse_calls(iter_logical_lines(lines))
+        self.assertEqual(calls.names, ["f"])
+        self.assertEqual(list(calls.line_indices), [2])
+
+    def test_c_lexed_lines(self):
+        lines = [
+            "#define A 1 // one\n",
+            "/* #define A 2\n",
+            "   #define B 2 */ #define C \"//\"\n",
+            "  // #define D 4 /* four */\n",
+            "#define E\n",
+        ]
+        lexed = CLexedLines(lines)
+        self.assertEqual(lexed[0].tokens, ("#define", "A", "1"))
+        self.assertEqual(lexed[0].comments, [(12, 19)])
+        self.assertEqual(lexed[1].tokens, ())
+        self.assertEqual(lexed[2].code, '#define C "//"')
+        self.assertEqual(lexed[2].strings, [(28, 32)])
+        self.assertEqual(lexed[2].tokens, ())  # not the first token
+        self.assertTrue(lexed[3].commented)
+        self.assertEqual(get_cdef(None, "A", lexed=lexed),
+                         ("1", 1, None, None))
+        self.assertEqual(get_cdef(None, "B", lexed=lexed),
+                         (None, -1, None, None))
+        self.assertEqual(get_cdef(None, None, line_index=3, lexed=lexed),
+                         ("4", 4, "D", COMMENTED_DEF_WARNING))
+        self.assertEqual(cdefs_to_d(None, lexed=lexed),
+                         {"A": "1", "D": None, "E": ""})
+        self.assertEqual(block_uncomment_line("a /* b */ c // d"),
+                         ("a   c", False))
+        self.assertEqual(block_uncomment_line("a /* b"), ("a", True))
+        set_cdef(None, ["A", "D"], 10, lexed=lexed)
+        self.assertEqual(lines[0], "#define A 10 // one")
+        self.assertEqual(lines[3], "  #define D 10 /* four */")
+        lines.insert(0, "/*\n")
+        self.assertEqual(lexed.refresh(), 3)  # until back in sync
+        self.assertEqual(cdefs_to_d(None, lexed=lexed),
+                         {"D": "10", "E": ""})
+
+    def test_detect_encoding(self):
+        self.assertEqual(detect_encoding_in_data(b"#define A 1\n"),
+                         ("utf_8", 1.0))
+        self.assertEqual(detect_encoding_in_data(u"Průša".encode("utf-8")),
+                         ("utf_8", .99))
+        self.assertEqual(detect_encoding_in_data(u"\u00fc".encode("utf-16")),
+                         ("utf_16", 1.0))
+        self.assertEqual(
+            detect_encoding_in_data(u"“naïve”".encode("cp1252"))[0],
+            "cp1252",
+        )
+        data = b"x" * 10 + u"Grüße".encode("cp437")
+        encoding, confidence = detect_encoding_in_data(data, sample_size=4)
+        self.assertEqual(encoding, "cp437")
+        self.assertGreater(confidence, .5)
+        self.assertLess(confidence, 1)
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, "Configuration.h")
+            with open(path, 'wb') as stream:
+                stream.write(codecs.BOM_UTF8 + b"#define A 1\n")
+            self.assertEqual(detect_encoding(path), ("utf_8_sig", 1.0))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_load_text(self):
+        data = (codecs.BOM_UTF8
+                + u"#define A 1\r\n// Pr\u016f\u0161a\r\n".encode("utf-8"))
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, "Configuration.h")
+            with open(path, 'wb') as stream:
+                stream.write(data)
+            loaded = load_text(path)
+            self.assertEqual(loaded.lines,
+                             ["#define A 1\n", u"// Pr\u016f\u0161a\n"])
+            self.assertEqual(loaded.encoding, "utf_8")
+            self.assertEqual(loaded.newline, "\r\n")
+            self.assertEqual(loaded.bom, codecs.BOM_UTF8)
+            copy_path = os.path.join(tmp, "copy.h")
+            write_lines(copy_path, loaded.lines, encoding=loaded.encoding,
+                        newline=loaded.newline, bom=loaded.bom)
+            with open(copy_path, 'rb') as stream:
+                self.assertEqual(stream.read(), data)
+            with open(path, 'wb') as stream:
+                stream.write(u"x\ny \u00fc".encode("cp1252"))
+            loaded = load_text(path, encoding="utf-8")  # falls back
+            self.assertEqual(loaded.lines, ["x\n", u"y \u00fc"])
+            self.assertEqual(loaded.encoding, "cp1252")
+            self.assertEqual(loaded.bom, b"")
+            # The BOM wins over encoding (which set_cdef always passes):
+            path = os.path.join(tmp, "u16.h")
+            with open(path, 'wb') as stream:
+                stream.write(codecs.BOM_UTF16_BE
+                             + u"#define A 1\n".encode("utf-16-be"))
+            for encoding in ("utf-8", "utf-16", None):
+                loaded = load_text(path, encoding=encoding)
+                self.assertEqual(loaded.lines, ["#define A 1\n"])
+                self.assertEqual(loaded.encoding, "utf_16_be")
+                self.assertEqual(list(iter_lines(path, encoding=encoding)),
+                                 ["#define A 1\n"])
+            set_cdef(path, "A", "5")
+            with open(path, 'rb') as stream:
+                self.assertEqual(
+                    stream.read(),
+                    (codecs.BOM_UTF16_BE
+                     + u"#define A 5\n".encode("utf-16-be")),
+                )
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_iter_lines(self):
+        data = (u"#define A \u00fc\r\n".encode("utf-8") * 3
+                + u"// #define B \u00fc\n".encode("cp1252"))
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, "Configuration.h")
+            with open(path, 'wb') as stream:
+                stream.write(data)
+            fallbacks = []
+            lines = list(iter_lines(path, chunk_size=5, fallbacks=fallbacks))
+            self.assertEqual(lines, [u"#define A \u00fc\n"] * 3
+                             + [u"// #define B \u00fc\n"])
+            self.assertEqual(fallbacks,
+                             [(data.rfind(b"\xfc"), "utf_8", "latin_1")])
+            lines = iter_lines(path, chunk_size=5)
+            self.assertEqual(get_cdef(None, "A", lines=lines),
+                             (u"\u00fc", 1, None, None))
+            self.assertEqual(next(lines), u"#define A \u00fc\n")
+            # ^ get_cdef stopped reading at the first match
+            lines = iter_lines(path, chunk_size=5)
+            self.assertEqual(cdefs_to_d(None, lines=lines),
+                             {"A": u"\u00fc", "B": None})
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_line_store(self):
+        lines = ["#define A 1\n", "// #define B 2\n", "\n", "#define C"]
+        store = LineStore("".join(lines))
+        self.assertEqual(len(store), 4)
+        self.assertEqual(list(store), lines)
+        self.assertEqual(store[-1], "#define C")
+        self.assertEqual(list(store[1:3]), lines[1:3])
+        self.assertEqual(list(store[1:][1:]), lines[2:])
+        self.assertEqual(store[::2], lines[::2])
+        self.assertRaises(IndexError, store.__getitem__, 4)
+        self.assertEqual(list(LineStore.from_lines(["a", "b"])),
+                         ["a\n", "b"])
+        self.assertEqual(cdefs_to_d(None, lines=store),
+                         {"A": "1", "B": None, "C": ""})
+        # A store can't change, so it is only lexed again if replaced:
+        lexed = CLexedLines(store)
+        self.assertEqual(lexed.refresh(), 0)
+        self.assertEqual(get_cdef(None, "A", lexed=lexed),
+                         ("1", 1, None, None))
+        lexed.lines = LineStore("#define A 2\n")
+        self.assertEqual(lexed.refresh(), 1)
+        self.assertEqual(len(lexed), 1)
+        self.assertEqual(get_cdef(None, "A", lexed=lexed),
+                         ("2", 1, None, None))
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, "Configuration.h")
+            with open(path, 'wb') as stream:
+                stream.write("".join(lines).replace("\n", "\r\n")
+                             .encode("ascii"))
+            with MappedLineStore(path) as mapped:
+                self.assertEqual(list(mapped), lines)
+                self.assertEqual(get_cdef(None, "C", lines=mapped[2:]),
+                                 ("", 2, None, None))
+            loaded = load_text(path, line_store=True)
+            self.assertIsInstance(loaded.lines, LineStore)
+            self.assertEqual(list(loaded.lines), lines)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_replace_faux_words(self):
+        faux = u"Pr\u00c5\u00af\u00c5\u00a1a".encode("utf-8")
+        before = get_faux_word_counts()[faux]
+        self.assertEqual(replace_faux_words(faux + b" " + faux),
+                         (u"Pr\u016f\u0161a Pr\u016f\u0161a".encode("utf-8"),
+                          2))
+        self.assertEqual(get_faux_word_counts()[faux], before + 2)
+        # One pass, so "\u00d7" written by the longer pair stays:
+        self.assertEqual(
+            replace_faux_words(u"\u00b1 x \u00f7".encode("utf-8"))[0],
+            u"\u00b1 \u00d7 \u00f7".encode("utf-8"),
+        )
+        register_faux_word(u"\u00c3\u00bc", u"\u00fc")
+        try:
+            self.assertEqual(
+                replace_faux_words(
+                    u"Gr\u00c3\u00bc\u00c3\u00bc".encode("utf-8")
+                ),
+                (u"Gr\u00fc\u00fc".encode("utf-8"), 2),
+            )
+        finally:
+            unregister_faux_word(u"\u00c3\u00bc")
+        self.assertEqual(
+            replace_faux_words(u"Gr\u00c3\u00bc".encode("utf-8")),
+            (u"Gr\u00c3\u00bc".encode("utf-8"), 0),
+        )
+        # An empty table must not match (as b"" would) everywhere:
+        with mock.patch.object(parsing, "_faux_words", OrderedDict()), \
+                mock.patch.object(parsing, "_faux_words_rx", None):
+            self.assertEqual(replace_faux_words(b"ab"), (b"ab", 0))
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, "Configuration.h")
+            write_lines(path, [u"// Pr\u00c5\u00af\u00c5\u00a1a"])
+            with open(path, 'rb') as stream:
+                self.assertEqual(stream.read(),
+                                 u"// Pr\u016f\u0161a\n".encode("utf-8"))
+        finally:
+            shutil.rmtree(tmp)
+
 
 if __name__ == "__main__":
     testcase = TestParsing()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Structured tracing for the parsing hot loops.
+
+Trace points check the level once per call (see get_trace_level) so a
+disabled trace point only costs a bool check, and records are only
+formatted (see format_record) when they reach the sink.
+
+Set the PYCODETOOL_TRACE environment variable to 1 (TRACE_CALLS) or 2
+(TRACE_STEPS), or use set_trace_level or collect_traces. For
+compatibility with the old echo4 output, verbosity 4 or higher also
+enables TRACE_STEPS.
+'''
+from __future__ import print_function
+import os
+
+from .find_hierosoft import hierosoft  # noqa: F401
+
+from hierosoft import (
+    echo0,
+    get_verbosity,
+)
+
+TRACE_OFF = 0
+TRACE_CALLS = 1  # one record per call (arguments and result)
+TRACE_STEPS = 2  # also one record per step of a scan loop
+
+_trace_level = TRACE_OFF
+_sink = None
+
+
+def to_trace_level(value):
+    '''
+    Get a trace level from an int or a string such as the value of the
+    PYCODETOOL_TRACE environment variable. Empty values mean TRACE_OFF,
+    a number is limited to the range TRACE_OFF to TRACE_STEPS, and any
+    other string (such as "true") means TRACE_CALLS.
+    '''
+    if value is None:
+        return TRACE_OFF
+    if isinstance(value, str):
+        value = value.strip()
+        if not value:
+            return TRACE_OFF
+        try:
+            value = int(value)
+        except ValueError:
+            return TRACE_CALLS
+    elif not isinstance(value, int):
+        raise ValueError("The trace level must be an int or str not {}"
+                         "".format(type(value).__name__))
+    return min(max(int(value), TRACE_OFF), TRACE_STEPS)
+
+
+def _level_from_env():
+    return to_trace_level(os.environ.get("PYCODETOOL_TRACE"))
+
+
+_trace_level = _level_from_env()
+
+
+def get_trace_level():
+    '''
+    Get the effective trace level. Hot loops should call this once
+    (before the loop) and check the local result.
+    '''
+    if get_verbosity() >= 4:
+        return max(_trace_level, TRACE_STEPS)
+    return _trace_level
+
+
+def set_trace_level(level):
+    '''
+    Set the trace level (TRACE_OFF, TRACE_CALLS, or TRACE_STEPS), or
+    any value that PYCODETOOL_TRACE accepts (See to_trace_level).
+    '''
+    global _trace_level
+    _trace_level = to_trace_level(level)
+
+
+def set_trace_sink(sink):
+    '''
+    Send trace records to sink instead of stderr.
+
+    Sequential arguments:
+    sink -- A callable that accepts a record (See trace), or None to
+        print each formatted record to stderr.
+    '''
+    global _sink
+    _sink = sink
+
+
+def trace(event, **fields):
+    '''
+    Send a record to the sink. Only call this after checking the trace
+    level, since the caller already pays for gathering fields.
+
+    Sequential arguments:
+    event -- The name of the event, such as "find_in_code.step".
+
+    Keyword arguments:
+    (any) -- Values for the record. They are not converted to strings
+        here, so pass a copy of anything that the caller will mutate.
+    '''
+    record = (event, fields)
+    if _sink is not None:
+        _sink(record)
+    else:
+        echo0(format_record(record))
+
+
+def format_record(record):
+    '''
+    Get a single line describing a record from trace.
+    '''
+    event, fields = record
+    return "[{}] {}".format(
+        event,
+        " ".join("{}={!r}".format(key, value)
+                 for key, value in sorted(fields.items())),
+    )
+
+
+class collect_traces(object):
+    '''
+    Collect records in a list while in a with statement, then restore
+    the previous level and sink:
+
+    with collect_traces() as records:
+        find_in_code(line, "=")
+    '''
+    def __init__(self, level=TRACE_STEPS):
+        self.level = level
+        self.records = []
+        self._old = None
+
+    def __enter__(self):
+        self._old = (_trace_level, _sink)
+        set_trace_level(self.level)
+        set_trace_sink(self.records.append)
+        return self.records
+
+    def __exit__(self, exc_type, exc_value, tb):
+        level, sink = self._old
+        set_trace_level(level)
+        set_trace_sink(sink)
+        return False
@@ -48,6 +48,7 @@ setuptools.setup(
     entry_points={
         'console_scripts': [
             'changes=pycodetool.changes:main',
+            'ggrep=pycodetool.ggrep:main',
         ],
     },
     install_requires=install_requires,